@@ -8,6 +8,7 @@ from autopr.actions.utils.commit import CommitPlan
 from autopr.actions.utils.file import add_element_to_context_list, GeneratedHunkOutputParser, ContextFile, \
     ContextCodeHunk, make_file_context, GeneratedFileHunk
 from autopr.models.prompt_chains import PromptChain
+from autopr.utils.tokenizer import Tokenizer
 
 
 class RewriteCodeHunkChain(PromptChain):
@@ -45,6 +46,11 @@ RULES:
     hunk_contents: ContextCodeHunk
     plan: str
 
+    def estimate_max_tokens(self, tokenizer: Tokenizer) -> Optional[int]:
+        # Leave room for the hunk to double in size, and for the outcome
+        hunk_tokens = tokenizer.count_tokens('\n'.join(line for _, line in self.hunk_contents.code_hunk))
+        return 2 * hunk_tokens + 500
+
 
 class EditFile(Action):
     id = "edit_file"
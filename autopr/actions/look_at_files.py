@@ -8,7 +8,8 @@ from autopr.actions.utils.commit import PullRequestDescription
 from autopr.models.artifacts import Issue
 from autopr.models.prompt_rails import PromptRail
 from autopr.models.rail_objects import RailObject
-from autopr.utils.repo import repo_to_file_descriptors, trim_chunk, filter_seen_chunks, FileDescriptor
+from autopr.utils.repo import repo_to_file_descriptors, trim_chunks, FileDescriptor, SeenChunkIndex
+from autopr.utils.tokenizer import Tokenizer
 
 
 class InitialFileSelectResponse(RailObject):
@@ -157,11 +158,14 @@ If looking at files would be a waste of time with regard to the issue, respond w
     selected_file_contents: list[FileDescriptor]
     prospective_file_descriptors: list[FileDescriptor]
     token_limit: int
-    _filtered_prospective_file_descriptors: list[FileDescriptor] = pydantic.PrivateAttr(default_factory=list)
+    seen_chunks: SeenChunkIndex = pydantic.Field(default_factory=SeenChunkIndex)  # chunks seen in previous prompts
+
+    class Config:
+        arbitrary_types_allowed = True
 
     def get_string_params(self) -> dict[str, str]:
-        self._filtered_prospective_file_descriptors = filter_seen_chunks(
-            self.selected_file_contents, self.prospective_file_descriptors
+        unseen_file_descriptors = self.seen_chunks.unseen(
+            self.prospective_file_descriptors, also_seen_fds=self.selected_file_contents
         )
 
         return {
@@ -172,15 +176,15 @@ If looking at files would be a waste of time with regard to the issue, respond w
             ]),
             'filepaths_with_token_lengths': '\n'.join([
                 file_descriptor.filepaths_with_token_lengths_to_str()
-                for file_descriptor in self._filtered_prospective_file_descriptors
+                for file_descriptor in unseen_file_descriptors
             ]),
             'token_limit': str(self.token_limit),
         }
 
-    def trim_params(self) -> bool:
-        if trim_chunk(self.selected_file_contents):
+    def trim_params(self, excess_tokens: int, tokenizer: Tokenizer) -> bool:
+        if trim_chunks(self.selected_file_contents, excess_tokens, tokenizer):
             return True
-        return super().trim_params()
+        return super().trim_params(excess_tokens, tokenizer)
 
 
 class ContinueLookingAtFiles(PromptRail):
@@ -211,11 +215,14 @@ Also, let me know if we should take a look at any other files – our budget is
     selected_file_contents: list[FileDescriptor]
     prospective_file_descriptors: list[FileDescriptor]
     token_limit: int
-    _filtered_prospective_file_descriptors: list[FileDescriptor] = pydantic.PrivateAttr(default_factory=list)
+    seen_chunks: SeenChunkIndex = pydantic.Field(default_factory=SeenChunkIndex)  # chunks seen in previous prompts
+
+    class Config:
+        arbitrary_types_allowed = True
 
     def get_string_params(self) -> dict[str, str]:
-        self._filtered_prospective_file_descriptors = filter_seen_chunks(
-            self.selected_file_contents, self.prospective_file_descriptors
+        unseen_file_descriptors = self.seen_chunks.unseen(
+            self.prospective_file_descriptors, also_seen_fds=self.selected_file_contents
         )
 
         return {
@@ -227,15 +234,15 @@ Also, let me know if we should take a look at any other files – our budget is
             ]),
             'filepaths_with_token_lengths': '\n'.join([
                 file_descriptor.filepaths_with_token_lengths_to_str()
-                for file_descriptor in self._filtered_prospective_file_descriptors
+                for file_descriptor in unseen_file_descriptors
             ]),
             'token_limit': str(self.token_limit),
         }
 
-    def trim_params(self) -> bool:
-        if trim_chunk(self.selected_file_contents):
+    def trim_params(self, excess_tokens: int, tokenizer: Tokenizer) -> bool:
+        if trim_chunks(self.selected_file_contents, excess_tokens, tokenizer):
             return True
-        return super().trim_params()
+        return super().trim_params(excess_tokens, tokenizer)
 
 
 class InspectFiles(Action):
@@ -301,44 +308,35 @@ class InspectFiles(Action):
     ) -> str:
         self.log.debug('Looking at files...')
 
+        files_by_path = {f.path: f for f in files}
+        seen_chunks = SeenChunkIndex()
         file_contents = [
-            f.copy(deep=True) for f in files
-            if f.path in filepaths
+            files_by_path[fp].copy() for fp in dict.fromkeys(filepaths)
+            if fp in files_by_path
         ]
         rail = LookAtFiles(
             context=context,
             selected_file_contents=file_contents,
-            prospective_file_descriptors=[f.copy(deep=True) for f in files],
+            prospective_file_descriptors=files,
             token_limit=self.file_context_token_limit,
+            seen_chunks=seen_chunks,
         )
         response = self.rail_service.run_prompt_rail(rail)
         if response is None or not isinstance(response, LookAtFilesResponse):
             raise ValueError('Error looking at files')
+        seen_chunks.update(rail.selected_file_contents)
         filepaths = response.filepaths_we_should_look_at or []
         notes = response.notes
 
-        viewed_filepaths_up_to_chunk: dict[str, int] = {}
         reasks = self.rail_service.num_reasks
         while filepaths and reasks > 0:
             reasks -= 1
 
             # See if all requested files have already been viewed
-            for fp in rail.selected_file_contents:
-                viewed_filepaths_up_to_chunk[fp.path] = fp.end_chunk
-            file_contents = []
-            for f in files:
-                if f.path not in filepaths:
-                    continue
-                if f.path in viewed_filepaths_up_to_chunk:
-                    chunk_num = viewed_filepaths_up_to_chunk[f.path]
-                    if chunk_num == f.end_chunk:
-                        continue
-                    new_f = f.copy(deep=True)
-                    new_f.start_chunk = chunk_num
-                else:
-                    new_f = f.copy(deep=True)
-                file_contents.append(new_f)
-
+            file_contents = seen_chunks.unseen(
+                files_by_path[fp] for fp in dict.fromkeys(filepaths)
+                if fp in files_by_path
+            )
             if not file_contents:
                 break
 
@@ -348,14 +346,16 @@ class InspectFiles(Action):
             rail = ContinueLookingAtFiles(
                 context=context,
                 notes=notes,
-                selected_file_contents=file_contents,
-                prospective_file_descriptors=rail._filtered_prospective_file_descriptors,
+                selected_file_contents=[f.copy() for f in file_contents],
+                prospective_file_descriptors=files,
                 token_limit=self.file_context_token_limit,
+                seen_chunks=seen_chunks,
             )
             response = self.rail_service.run_prompt_rail(rail)
             if response is None or not isinstance(response, LookAtFilesResponse):
                 filepaths = []
             else:
+                seen_chunks.update(rail.selected_file_contents)
                 filepaths = response.filepaths_we_should_look_at or []
                 notes += f'\n{response.notes}'
 
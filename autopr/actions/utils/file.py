@@ -7,12 +7,10 @@ from git.repo import Repo
 
 from autopr.actions.base import ContextDict
 from autopr.actions.utils.commit import CommitPlan
-from autopr.models.prompt_chains import PromptChain
+from autopr.models.prompt_chains import PromptChain, StreamingOutputParser, OutputStream
 
 import pydantic
 
-from langchain.schema import BaseOutputParser
-
 import structlog
 log = structlog.get_logger()
 
@@ -31,7 +29,81 @@ class GeneratedFileHunk(pydantic.BaseModel):
     outcome: str
 
 
-class GeneratedHunkOutputParser(BaseOutputParser):
+class GeneratedHunkOutputStream(OutputStream):
+    """
+    Checks a streamed generated hunk, which is complete as soon as the outcome JSON after the code block is closed.
+
+    A fence that isn't followed by a JSON object with an `outcome` is part of the code
+    (e.g., a fenced JSON example in a markdown file), as `GeneratedHunkOutputParser` splits the code block
+    on the last fence.
+    Any number of lines may precede the code block, like the parser allows.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # One of `preamble`, `code`, `after_code` (right after a fence that might close the code), or `outcome`
+        self._phase = 'preamble'
+        self._line = ''
+        self._outcome = ''
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def _feed_char(self, char: str) -> str:
+        if self._phase == 'outcome':
+            return self._feed_outcome_char(char)
+
+        if self._phase == 'after_code' and not char.isspace():
+            if char == '{' and not self._line.strip():
+                self._phase = 'outcome'
+                self._outcome = char
+                self._depth = 1
+                return 'incomplete'
+            # The fence was part of the code
+            self._phase = 'code'
+
+        if char != '\n':
+            self._line += char
+            return 'incomplete'
+
+        line, self._line = self._line, ''
+        if line.startswith('```'):
+            self._phase = 'code' if self._phase == 'preamble' else 'after_code'
+        return 'incomplete'
+
+    def _feed_outcome_char(self, char: str) -> str:
+        self._outcome += char
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif char == '\\':
+                self._escaped = True
+            elif char == '"':
+                self._in_string = False
+        elif char == '"':
+            self._in_string = True
+        elif char == '{':
+            self._depth += 1
+        elif char == '}':
+            self._depth -= 1
+            if self._depth == 0:
+                return self._close_outcome()
+        return 'incomplete'
+
+    def _close_outcome(self) -> str:
+        try:
+            outcome = json.loads(self._outcome)
+        except json.JSONDecodeError:
+            outcome = None
+        if isinstance(outcome, dict) and 'outcome' in outcome:
+            return 'complete'
+        # The object was part of the code, continuing on its last line
+        self._phase = 'code'
+        self._line = self._outcome.rsplit('\n', 1)[-1]
+        return 'incomplete'
+
+
+class GeneratedHunkOutputParser(StreamingOutputParser):
     """
     An output parser for the generated hunk, in the format of:
         ```
@@ -41,6 +113,9 @@ class GeneratedHunkOutputParser(BaseOutputParser):
             "outcome": <string>
         }
     """
+    def get_output_stream(self) -> GeneratedHunkOutputStream:
+        return GeneratedHunkOutputStream()
+
     def parse(self, output: str) -> Optional[GeneratedFileHunk]:
         output_lines = output.split("\n")
 
@@ -22,7 +22,7 @@ class GitHubActionSettings(Settings):
 
         @classmethod
         def parse_env_var(cls, field_name: str, raw_val: str) -> Any:
-            if field_name.endswith('agent_config'):
+            if field_name.endswith('agent_config') or field_name.endswith('model_routes'):
                 return yaml.safe_load(raw_val)
             return cls.json_loads(raw_val)  # type: ignore
 
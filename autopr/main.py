@@ -1,10 +1,14 @@
+import json
+import os
 from typing import Optional, Any, Type
 
+import openai
 from git.repo import Repo
 from pydantic import BaseSettings
 
 from .models.events import EventUnion, IssueLabelEvent
-from .repos.completions_repo import get_completions_repo
+from .repos.completions_repo import get_completions_repo, SyntheticCompletionsRepo, CompletionsRepo, ModelRouter, \
+    model_context_limits
 from .services.action_service import ActionService
 from .services.agent_service import AgentService
 from .services.chain_service import ChainService
@@ -12,6 +16,12 @@ from .services.commit_service import CommitService
 from .services.diff_service import GitApplyService
 from .services.publish_service import PublishService
 from .services.rail_service import RailService
+from .utils.cassette import Cassette
+from .utils.rate_limiter import RateLimiter
+from .utils.repo import configure_indexing
+from .utils.response_cache import ResponseCache
+from .utils.tokenizer import configure_tokenizer
+from .utils.usage import UsageTracker
 
 import structlog
 
@@ -24,13 +34,32 @@ class Settings(BaseSettings):
     target_branch_name_template: str = 'autopr/{issue_number}'
     overwrite_existing: bool = False
     loading_gif_url: str = "https://media0.giphy.com/media/l3nWhI38IWDofyDrW/giphy.gif"
+    publish_interval: float = 5
     model: str = "gpt-4"
+    model_routes: Optional[dict[str, Any]] = None
     temperature: float = 0.8
     rail_temperature: float = 0.4
     context_limit: int = 8192
     min_tokens: int = 1000
     max_tokens: int = 2000
     num_reasks: int = 2
+    cache_dir: Optional[str] = None
+    indexing_workers: int = 1
+    tokenizer: Optional[str] = None
+    max_file_size: int = 1_000_000
+    skipped_file_extensions: str = ''
+    response_cache_policy: str = 'temperature_0'
+    response_cache_ttl: int = 7 * 24 * 60 * 60
+    response_cache_max_entries: int = 10000
+    cassette_mode: str = 'off'
+    cassette_path: Optional[str] = None
+    synthetic_latency: float = 0.5
+    synthetic_tokens_per_second: float = 50
+    max_concurrent_completions: int = 4
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
+    rate_limit_state_file: Optional[str] = None
+    usage_report_path: Optional[str] = None
 
 
 class MainService:
@@ -41,6 +70,7 @@ class MainService:
         self.log = structlog.get_logger()
 
         self.settings = settings = self.settings_class.parse_obj({})  # pyright workaround
+        self.cassette = self.get_cassette()
         self.event = self.get_event()
         self.repo_path = self.get_repo_path()
         self.repo = Repo(self.repo_path)
@@ -57,15 +87,47 @@ class MainService:
         )
         commit_service.ensure_branch_exists()
 
+        # Configure how files are tokenized for the model
+        configure_tokenizer(settings.model, settings.tokenizer or None)
+        configure_indexing(
+            cache_dir=settings.cache_dir,
+            num_workers=settings.indexing_workers,
+            max_file_size=settings.max_file_size,
+            skipped_file_extensions=[
+                ext.strip() for ext in settings.skipped_file_extensions.split(',') if ext.strip()
+            ],
+        )
+
+        # Cache language model responses across runs
+        response_cache = None
+        if settings.cache_dir and settings.response_cache_policy != 'off':
+            response_cache = ResponseCache(
+                cache_dir=settings.cache_dir,
+                policy=settings.response_cache_policy,
+                ttl=settings.response_cache_ttl,
+                max_entries=settings.response_cache_max_entries,
+            )
+
+        # Smooth language model requests to stay within the API's rate limits
+        rate_limiter = None
+        if settings.requests_per_minute or settings.tokens_per_minute:
+            rate_limiter = RateLimiter(
+                requests_per_minute=settings.requests_per_minute,
+                tokens_per_minute=settings.tokens_per_minute,
+                state_path=settings.rate_limit_state_file or None,
+            )
+
+        # Record the usage of every language model call
+        self.usage_tracker = UsageTracker()
+
         # Create completions repo
-        completions_repo = get_completions_repo(
-            publish_service=self.publish_service,
+        completions_repo = self.create_completions_repo(
             model=settings.model,
             context_limit=settings.context_limit,
-            min_tokens=settings.min_tokens,
-            max_tokens=settings.max_tokens,
-            temperature=settings.temperature,
+            response_cache=response_cache,
+            rate_limiter=rate_limiter,
         )
+        model_router = self.get_model_router(completions_repo)
 
         # Create rail and chain service
         rail_service = RailService(
@@ -75,12 +137,14 @@ class MainService:
             num_reasks=settings.num_reasks,
             temperature=settings.rail_temperature,
             publish_service=self.publish_service,
+            model_router=model_router,
         )
         chain_service = ChainService(
             completions_repo=completions_repo,
             publish_service=self.publish_service,
             context_limit=settings.context_limit,
             min_tokens=settings.min_tokens,
+            model_router=model_router,
         )
 
         # Create diff service
@@ -106,7 +170,73 @@ class MainService:
 
     def run(self):
         # Generate the PR
-        self.agent_service.run_agent(self.settings.agent_id, self.settings.agent_config, self.event)
+        try:
+            self.agent_service.run_agent(self.settings.agent_id, self.settings.agent_config, self.event)
+        finally:
+            if self.settings.usage_report_path:
+                self.usage_tracker.write_json(self.settings.usage_report_path)
+            if self.cassette is not None:
+                self.cassette.uninstall()
+
+    def create_completions_repo(self, model: str, **kwargs) -> CompletionsRepo:
+        completions_repo_kwargs = dict(
+            min_tokens=self.settings.min_tokens,
+            max_tokens=self.settings.max_tokens,
+            temperature=self.settings.temperature,
+            max_concurrency=self.settings.max_concurrent_completions,
+            usage_tracker=self.usage_tracker,
+        )
+        if model in SyntheticCompletionsRepo.models:
+            completions_repo_kwargs.update(
+                latency=self.settings.synthetic_latency,
+                tokens_per_second=self.settings.synthetic_tokens_per_second,
+            )
+        completions_repo_kwargs.update(kwargs)
+        return get_completions_repo(
+            publish_service=self.publish_service,
+            model=model,
+            **completions_repo_kwargs,
+        )
+
+    def get_model_router(self, completions_repo: CompletionsRepo) -> ModelRouter:
+        # Route stages to other models, each given by name or by a dict of completions repo options
+        routes = {}
+        completions_repos_by_options: dict[str, CompletionsRepo] = {}
+        for stage_name, route in (self.settings.model_routes or {}).items():
+            if isinstance(route, str):
+                route = {'model': route}
+            route = {
+                'context_limit': model_context_limits.get(route['model'], self.settings.context_limit),
+                **route,
+            }
+            # Stages routed alike share a completions repo
+            options_key = json.dumps(route, sort_keys=True)
+            if options_key not in completions_repos_by_options:
+                completions_repos_by_options[options_key] = self.create_completions_repo(
+                    response_cache=completions_repo.response_cache,
+                    rate_limiter=completions_repo.rate_limiter,
+                    **route,
+                )
+            routes[stage_name] = completions_repos_by_options[options_key]
+        if routes:
+            self.log.info("Routing stages to models", routes={
+                stage_name: routed_repo.model for stage_name, routed_repo in routes.items()
+            })
+        return ModelRouter(completions_repo, routes)
+
+    def get_cassette(self) -> Optional[Cassette]:
+        # Record or replay every HTTP request of the run, starting with the ones made to get the event
+        if self.settings.cassette_mode == 'off':
+            return None
+        if not self.settings.cassette_path:
+            raise ValueError("cassette_path must be set to record or replay a cassette")
+        cassette = Cassette(self.settings.cassette_path, self.settings.cassette_mode)
+        if cassette.mode == 'replay':
+            # The OpenAI client refuses to make requests without an API key, even replayed ones
+            os.environ.setdefault('OPENAI_API_KEY', 'replayed')
+            openai.api_key = openai.api_key or os.environ['OPENAI_API_KEY']
+        cassette.install()
+        return cassette
 
     def get_repo_path(self):
         raise NotImplementedError
@@ -135,6 +265,7 @@ class MainService:
             pull_request_number=pull_request_number,
             loading_gif_url=self.settings.loading_gif_url,
             overwrite_existing=self.settings.overwrite_existing,
+            publish_interval=self.settings.publish_interval,
             **additional_kwargs,
         )
 
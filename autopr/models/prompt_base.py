@@ -1,9 +1,9 @@
-from typing import ClassVar
+from typing import ClassVar, Optional
 
 import pydantic
 import structlog
 
-from autopr.utils.tokenizer import get_tokenizer
+from autopr.utils.tokenizer import get_tokenizer, Tokenizer
 
 log = structlog.get_logger()
 
@@ -32,6 +32,16 @@ class PromptBase(pydantic.BaseModel):
         prompt_params = self.get_string_params()
         return spec.format(**prompt_params)
 
+    def estimate_max_tokens(self, tokenizer: Tokenizer) -> Optional[int]:
+        """
+        Override this method to estimate the number of tokens the LLM needs to respond with,
+        e.g., from the size of the input the response transforms.
+        The estimate limits the response to at least the completions repo's `min_tokens`,
+        so that an underestimate doesn't cut it off, but a rambling response still stops sooner.
+        By default, the completions repo's `max_tokens` applies.
+        """
+        return None
+
     def get_string_params(self) -> dict[str, str]:
         """
         Get the parameters of the prompt as a dictionary of strings.
@@ -47,42 +57,59 @@ class PromptBase(pydantic.BaseModel):
                 prompt_params[key] = str(value)
         return prompt_params
 
-    def calculate_prompt_token_length(self) -> int:
+    def calculate_prompt_token_length(self, tokenizer: Optional[Tokenizer] = None) -> int:
         """
         Calculate the number of tokens in the prompt message.
         """
-        tokenizer = get_tokenizer()
+        if tokenizer is None:
+            tokenizer = get_tokenizer()
         prompt_message = self.get_prompt_message()
-        return len(tokenizer.encode(prompt_message))
+        return tokenizer.count_tokens(prompt_message)
 
-    def ensure_token_length(self, max_length: int) -> bool:
+    def ensure_token_length(self, max_length: int, tokenizer: Optional[Tokenizer] = None) -> bool:
         """
-        Ensure that the prompt message is no longer than `max_length` tokens.
+        Ensure that the prompt message is no longer than `max_length` tokens,
+        as counted by `tokenizer` (by default, the tokenizer of the configured model).
+
+        Trims in passes: each pass asks `trim_params` to trim the excess tokens in one go,
+        and counts the rendered prompt to verify it, until it fits.
         """
+        if tokenizer is None:
+            tokenizer = get_tokenizer()
         # Make sure there are at least `min_tokens` tokens left
-        while max_length < self.calculate_prompt_token_length():
-            # Iteratively trim the params
-            if not self.trim_params():
+        while (excess_tokens := self.calculate_prompt_token_length(tokenizer) - max_length) > 0:
+            if not self.trim_params(excess_tokens, tokenizer):
                 rail_name = self.__class__.__name__
                 log.debug(f'Could not trim params on rail {rail_name}: {self.get_string_params()}')
                 return False
         return True
 
-    def trim_params(self) -> bool:
+    def trim_params(self, excess_tokens: int, tokenizer: Tokenizer) -> bool:
         """
         Override this method to trim the parameters of the prompt.
-        This is called when the prompt is too long. By default, this method
-        removes the last element of the first list it finds.
+        This is called when the prompt is `excess_tokens` too long.
+        Estimate the token cost of the trimmed parameters to trim them all at once;
+        if the estimate falls short, this is called again with the remaining excess.
 
-        TODO give this method better heuristics for trimming, so it doesn't just
-         get called over and over again.
+        By default, this method removes elements from the end of the first list it finds,
+        bisecting the number of elements to keep with exact token counts.
         """
-
-        log.warning("Naively trimming params", rail=self)
         prompt_params = dict(self)
-        # If there are any lists, remove the last element of the first one you find
+        # If there are any lists, remove the last elements of the first one you find
         for key, value in prompt_params.items():
             if isinstance(value, list) and len(value) > 0:
-                setattr(self, key, value[:-1])
+                log.warning("Naively trimming params", rail=self, param=key)
+                max_length = self.calculate_prompt_token_length(tokenizer) - excess_tokens
+
+                # Find the most elements to keep, such that the prompt fits
+                lo, hi = 0, len(value) - 1
+                while lo < hi:
+                    mid = (lo + hi + 1) // 2
+                    setattr(self, key, value[:mid])
+                    if self.calculate_prompt_token_length(tokenizer) <= max_length:
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                setattr(self, key, value[:lo])
                 return True
         return False
@@ -8,6 +8,53 @@ import structlog
 log = structlog.get_logger()
 
 
+class OutputStream:
+    """
+    Incrementally checks a response as it's streamed from the language model,
+    to stop generating as soon as the expected structure is complete, or as soon as it's clearly malformed.
+
+    Subclass and implement `_feed_char`, returning the status after each character:
+    - `incomplete`: keep streaming
+    - `complete`: the response is complete, stop streaming
+    - `malformed`: the response won't parse, stop streaming
+    """
+
+    def __init__(self):
+        #: The response up to where the stream stopped
+        self.text = ''
+        self.status = 'incomplete'
+
+    def feed(self, chunk: str) -> str:
+        """
+        Feed the next chunk of the response, returning the status of the stream.
+        """
+        if self.status != 'incomplete':
+            return self.status
+        for i, char in enumerate(chunk):
+            self.status = self._feed_char(char)
+            if self.status != 'incomplete':
+                # Drop anything generated after the end of the response
+                self.text += chunk[:i + 1]
+                return self.status
+        self.text += chunk
+        return self.status
+
+    def _feed_char(self, char: str) -> str:
+        raise NotImplementedError
+
+
+class StreamingOutputParser(BaseOutputParser):
+    """
+    An output parser that can check the response while it's streamed (see `OutputStream`).
+    """
+
+    def get_output_stream(self) -> OutputStream:
+        """
+        Get a fresh stream checker for a response to be parsed by this parser.
+        """
+        raise NotImplementedError
+
+
 class PromptChain(PromptBase):
     """
     A prompt chain is a pydantic model used to specify a prompt for a langchain call.
@@ -17,6 +64,7 @@ class PromptChain(PromptBase):
     - write a prompt template in the `prompt_template` class variable, referencing parameters as {param}
     - define your parameters as pydantic instance attributes
     - optionally define an output parser as the `output_parser` class variable
+      (subclass `StreamingOutputParser` to stop generating as soon as the output is complete)
 
 
     """
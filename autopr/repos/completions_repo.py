@@ -1,22 +1,51 @@
-from typing import Optional
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import xml.etree.ElementTree as ET
+from typing import Optional, Any, Callable, TypeVar, Iterator
 
 import openai
 import openai.error
 import structlog
 from tenacity import retry, retry_if_exception_type, wait_random_exponential, stop_after_attempt
 
+from autopr.models.prompt_base import PromptBase
+from autopr.models.prompt_chains import OutputStream
 from autopr.services.publish_service import PublishService
 from autopr.utils import tokenizer
+from autopr.utils.rate_limiter import RateLimiter
+from autopr.utils.response_cache import ResponseCache
+from autopr.utils.usage import UsageTracker, count_retry, report_usage
+
+
+T = TypeVar('T')
 
 
 class CompletionsRepo:
     """
     Repository that handles running completions through a language model.
+
+    Call `complete` to run a completion, or await `acomplete` to run completions concurrently,
+    at most `max_concurrency` at a time.
+    Pass an `OutputStream` to `complete` to stream the completion, and stop it as soon as the output is complete.
+
+    Prompts are sent with `default_system_prompt`, unless another system prompt is given;
+    pass an empty system prompt to send the prompt without one.
+
+    Completions get at most `max_tokens` tokens (or as many as requested per call),
+    limited by the room left in the context window after the prompt.
+    If that leaves less than `min_tokens` (or the requested number, if lower), `complete` raises a ValueError
+    instead of making a request that would fail or be cut off.
     """
 
     #: A list of models that this repo implements. Set this in the subclass.
     models: list[str]
 
+    default_system_prompt = "You are a helpful assistant."
+
     def __init__(
         self,
         publish_service: PublishService,
@@ -25,6 +54,10 @@ class CompletionsRepo:
         min_tokens: int = 1000,
         context_limit: int = 8192,
         temperature: float = 0.8,
+        response_cache: Optional[ResponseCache] = None,
+        max_concurrency: int = 4,
+        rate_limiter: Optional[RateLimiter] = None,
+        usage_tracker: Optional[UsageTracker] = None,
     ):
         self.publish_service = publish_service
         self.model = model
@@ -32,8 +65,14 @@ class CompletionsRepo:
         self.min_tokens = min_tokens
         self.context_limit = context_limit
         self.temperature = temperature
+        self.response_cache = response_cache
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = rate_limiter
+        self.usage_tracker = usage_tracker or UsageTracker()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
 
-        self.tokenizer = tokenizer.get_tokenizer()
+        self.tokenizer = tokenizer.get_tokenizer(model)
         self.log = structlog.get_logger(repo=self.__class__.__name__)
 
     def complete(
@@ -42,6 +81,8 @@ class CompletionsRepo:
         system_prompt: Optional[str] = None,
         examples: Optional[list[tuple[str, str]]] = None,
         temperature: Optional[float] = None,
+        output_stream: Optional[OutputStream] = None,
+        max_tokens: Optional[int] = None,
     ) -> str:
         log = self.log.bind(
             model=self.model,
@@ -50,38 +91,78 @@ class CompletionsRepo:
         if examples is None:
             examples = []
         if system_prompt is None:
-            system_prompt = "You are a helpful assistant."
+            system_prompt = self.default_system_prompt
         if temperature is None:
             temperature = self.temperature
 
-        length = len(self.tokenizer.encode(prompt))
-        max_tokens = min(self.max_tokens, self.context_limit - length)
+        length = self.count_prompt_tokens(prompt, system_prompt, examples)
+        max_tokens = self.get_max_tokens(length, max_tokens)
 
-        self.log.info(
-            "Running completion",
-            prompt=prompt,
-        )
-        try:
-            result = self._complete(
-                system_prompt=system_prompt,
-                examples=examples,
+        with self.usage_tracker.track(self.model) as usage:
+            cache_key = None
+            if self.response_cache is not None and self.response_cache.should_cache(temperature):
+                cache_key = self.response_cache.get_key(
+                    model=self.model,
+                    system_prompt=system_prompt,
+                    examples=examples,
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                )
+                result = self.response_cache.get(cache_key)
+                if result is not None:
+                    usage.cache_hit = True
+                    log.info(
+                        "Completed from cache",
+                        result=result,
+                    )
+                    return result
+
+            if self.rate_limiter is not None:
+                usage.rate_limit_wait = self.rate_limiter.acquire(length + max_tokens)
+
+            self.log.info(
+                "Running completion",
                 prompt=prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
             )
-        except openai.error.InvalidRequestError as e:
-            if "`gpt-4` does not exist" not in str(e):
+            # Estimate usage with the tokenizer, in case the implementation doesn't report it
+            usage.prompt_tokens = length
+            try:
+                if output_stream is not None:
+                    result = self._complete_streamed(
+                        output_stream=output_stream,
+                        system_prompt=system_prompt,
+                        examples=examples,
+                        prompt=prompt,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                    )
+                else:
+                    result = self._complete(
+                        system_prompt=system_prompt,
+                        examples=examples,
+                        prompt=prompt,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                    )
+            except openai.error.InvalidRequestError as e:
+                if "`gpt-4` does not exist" not in str(e):
+                    raise e
+
+                # Warn that the user doesn't have access to gpt-4
+                while len(self.publish_service.sections_stack) > 1:
+                    self.publish_service.end_section()
+                self.publish_service.publish_update(
+                    "⚠️⚠️⚠️ Your OpenAI API key does not have access to the `gpt-4` model. "
+                    "Please note that ChatGPT Plus does not give you access to the `gpt-4` API; " 
+                    "you need to sign up on [the GPT-4 API waitlist](https://openai.com/waitlist/gpt-4-api). "
+                )
                 raise e
+            if not usage.completion_tokens:
+                usage.completion_tokens = self.tokenizer.count_tokens(result)
 
-            # Warn that the user doesn't have access to gpt-4
-            while len(self.publish_service.sections_stack) > 1:
-                self.publish_service.end_section()
-            self.publish_service.publish_update(
-                "⚠️⚠️⚠️ Your OpenAI API key does not have access to the `gpt-4` model. "
-                "Please note that ChatGPT Plus does not give you access to the `gpt-4` API; " 
-                "you need to sign up on [the GPT-4 API waitlist](https://openai.com/waitlist/gpt-4-api). "
-            )
-            raise e
+            if cache_key is not None and self.response_cache is not None:
+                self.response_cache.set(cache_key, result)
 
         log.info(
             "Completed",
@@ -89,6 +170,166 @@ class CompletionsRepo:
         )
         return result
 
+    def count_prompt_tokens(
+        self,
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+    ) -> int:
+        """
+        Count the tokens of the prompt as sent to the model, in chat format (by default).
+        Each message costs a few tokens on top of its role and content, and the reply is primed with a few more.
+        """
+        tokens_per_message = 4 if self.model == 'gpt-3.5-turbo-0301' else 3
+        num_tokens = 3
+        for message in self.get_messages(prompt, system_prompt, examples):
+            num_tokens += tokens_per_message
+            num_tokens += self.tokenizer.count_tokens(message['role'])
+            num_tokens += self.tokenizer.count_tokens(message['content'])
+        return num_tokens
+
+    def get_max_tokens(self, prompt_tokens: int, max_tokens: Optional[int] = None) -> int:
+        """
+        Get the number of tokens to allow the completion of a prompt of `prompt_tokens` tokens,
+        at most `max_tokens` (by default, the repo's `max_tokens`).
+        """
+        if max_tokens is None:
+            max_tokens = self.max_tokens
+        available_tokens = self.context_limit - prompt_tokens
+        required_tokens = min(self.min_tokens, max_tokens)
+        if available_tokens < required_tokens:
+            raise ValueError(
+                f"Prompt of {prompt_tokens} tokens leaves {available_tokens} tokens "
+                f"of the {self.context_limit} token context for the completion, fewer than {required_tokens}"
+            )
+        return min(max_tokens, available_tokens)
+
+    def ensure_prompt_length(
+        self,
+        prompt: PromptBase,
+        system_prompt: Optional[str] = None,
+        examples: Optional[list[tuple[str, str]]] = None,
+        min_tokens: Optional[int] = None,
+        context_limit: Optional[int] = None,
+    ) -> bool:
+        """
+        Trim `prompt` so that, sent with `system_prompt` and `examples`, it leaves at least `min_tokens` tokens
+        (by default, the repo's `min_tokens`) of the context for the completion.
+
+        Counts the prompt like `complete` does, including the system prompt, examples and per-message chat overhead,
+        so that `complete` doesn't refuse the trimmed prompt.
+        Returns False if the prompt can't be trimmed enough.
+        """
+        if examples is None:
+            examples = []
+        if system_prompt is None:
+            system_prompt = self.default_system_prompt
+        if min_tokens is None:
+            min_tokens = self.min_tokens
+        if context_limit is None:
+            context_limit = self.context_limit
+
+        # Budget the prompt message with the rest of the request's tokens taken out
+        overhead_tokens = self.count_prompt_tokens('', system_prompt, examples)
+        max_length = context_limit - min_tokens - overhead_tokens
+        while True:
+            if not prompt.ensure_token_length(max_length, self.tokenizer):
+                return False
+            # Tokens may merge differently around the prompt message, so check the whole request
+            prompt_tokens = self.count_prompt_tokens(prompt.get_prompt_message(), system_prompt, examples)
+            excess_tokens = prompt_tokens + min_tokens - context_limit
+            if excess_tokens <= 0:
+                return True
+            max_length -= excess_tokens
+
+    def get_estimated_max_tokens(self, estimated_tokens: Optional[int]) -> Optional[int]:
+        """
+        Get the `max_tokens` to request for a completion estimated to need `estimated_tokens` tokens.
+        Estimates are only hints, so the completion gets at least `min_tokens` (and at most `max_tokens`),
+        instead of being cut off when the estimate falls short.
+        """
+        if estimated_tokens is None:
+            return None
+        return min(max(estimated_tokens, self.min_tokens), self.max_tokens)
+
+    @staticmethod
+    def get_messages(
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+    ) -> list[dict[str, str]]:
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        for example in examples:
+            messages.append({"role": "user", "content": example[0]})
+            messages.append({"role": "assistant", "content": example[1]})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    async def acomplete(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = None,
+        examples: Optional[list[tuple[str, str]]] = None,
+        temperature: Optional[float] = None,
+        output_stream: Optional[OutputStream] = None,
+        max_tokens: Optional[int] = None,
+    ) -> str:
+        """
+        Like `complete`, but awaitable, so that independent completions can run concurrently.
+        """
+        return await self.run_concurrently(
+            self.complete,
+            prompt=prompt,
+            system_prompt=system_prompt,
+            examples=examples,
+            temperature=temperature,
+            output_stream=output_stream,
+            max_tokens=max_tokens,
+        )
+
+    async def run_concurrently(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Run a blocking function that calls the language model (e.g., `RailService.run_prompt_rail`) in a thread.
+        At most `max_concurrency` of these run at a time, across everything that shares this completions repo.
+        """
+        def run_forked():
+            # Publish the function's sections under the current section, regardless of what else is running
+            self.publish_service.fork_sections_stack()
+            return func(*args, **kwargs)
+
+        async with self._get_semaphore():
+            return await asyncio.to_thread(run_forked)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Semaphores are bound to the event loop they're first used in
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    def _complete_streamed(self, output_stream: OutputStream, **kwargs) -> str:
+        chunks = self._stream(**kwargs)
+        try:
+            for chunk in chunks:
+                status = output_stream.feed(chunk)
+                if status != 'incomplete':
+                    self.log.info("Stopped streaming completion", status=status)
+                    break
+        finally:
+            # Stop generating the rest of the completion
+            chunks.close()
+        return output_stream.text
+
+    def _report_usage(self, openai_response: dict[str, Any]):
+        if 'usage' in openai_response:
+            report_usage(
+                prompt_tokens=openai_response['usage']['prompt_tokens'],
+                completion_tokens=openai_response['usage']['completion_tokens'],
+            )
+
     def _complete(
         self,
         system_prompt: str,
@@ -102,6 +343,26 @@ class CompletionsRepo:
         """
         raise NotImplementedError
 
+    def _stream(
+        self,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+    ) -> Iterator[str]:
+        """
+        Subclass this method to stream the language model call, yielding chunks of the completion as they're generated.
+        By default, yields the whole completion at once.
+        """
+        yield self._complete(
+            system_prompt=system_prompt,
+            examples=examples,
+            prompt=prompt,
+            max_tokens=max_tokens,
+            temperature=temperature,
+        )
+
 
 openai_retry_if_union = (
     retry_if_exception_type(openai.error.Timeout)
@@ -121,7 +382,8 @@ class OpenAIChatCompletionsRepo(CompletionsRepo):
     @retry(
         retry=openai_retry_if_union,
         wait=wait_random_exponential(min=1, max=240),
-        stop=stop_after_attempt(8)
+        stop=stop_after_attempt(8),
+        before_sleep=count_retry,
     )
     def _complete(
         self,
@@ -131,17 +393,9 @@ class OpenAIChatCompletionsRepo(CompletionsRepo):
         max_tokens: int,
         temperature: float,
     ) -> str:
-        messages = [
-            {"role": "system", "content": system_prompt},
-        ]
-        for example in examples:
-            messages.append({"role": "user", "content": example[0]})
-            messages.append({"role": "assistant", "content": example[1]})
-        messages.append({"role": "user", "content": prompt})
-
         openai_response = openai.ChatCompletion.create(
             model=self.model,
-            messages=messages,
+            messages=self.get_messages(prompt, system_prompt, examples),
             temperature=temperature,
             max_tokens=max_tokens,
         )
@@ -155,18 +409,67 @@ class OpenAIChatCompletionsRepo(CompletionsRepo):
             "Ran OpenAI chat completion",
             openai_response=openai_response,
         )
+        self._report_usage(openai_response)
         return openai_response["choices"][0]["message"]["content"]
 
+    # Retry starting the stream; once it's started, chunks are yielded to the caller and can't be retried
+    @retry(
+        retry=openai_retry_if_union,
+        wait=wait_random_exponential(min=1, max=240),
+        stop=stop_after_attempt(8),
+        before_sleep=count_retry,
+    )
+    def _start_stream(self, **kwargs) -> Iterator[dict[str, Any]]:
+        return openai.ChatCompletion.create(stream=True, **kwargs)  # type: ignore
+
+    def _stream(
+        self,
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+        max_tokens: int,
+        temperature: float,
+    ) -> Iterator[str]:
+        openai_stream = self._start_stream(
+            model=self.model,
+            messages=self.get_messages(prompt, system_prompt, examples),
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        for openai_response in openai_stream:
+            yield openai_response["choices"][0]["delta"].get("content", "")
+
 
 class OpenAICompletionsRepo(CompletionsRepo):
     models = [
         'text-davinci-003',
     ]
 
+    @staticmethod
+    def _get_text_prompt(
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+    ) -> str:
+        parts = [system_prompt] if system_prompt else []
+        for example in examples:
+            parts.append(f"{example[0]}\n{example[1]}")
+        parts.append(prompt)
+        return "\n\n".join(parts)
+
+    def count_prompt_tokens(
+        self,
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+    ) -> int:
+        return self.tokenizer.count_tokens(self._get_text_prompt(prompt, system_prompt, examples))
+
     @retry(
         retry=openai_retry_if_union,
         wait=wait_random_exponential(min=1, max=240),
-        stop=stop_after_attempt(8)
+        stop=stop_after_attempt(8),
+        before_sleep=count_retry,
     )
     def _complete(
         self,
@@ -176,14 +479,9 @@ class OpenAICompletionsRepo(CompletionsRepo):
         max_tokens: int,
         temperature: float,
     ) -> str:
-        prompt = system_prompt
-        for example in examples:
-            prompt += f"\n\n{example[0]}\n{example[1]}"
-        prompt += f"\n\n{prompt}"
-
         openai_response = openai.Completion.create(
             model=self.model,
-            prompt=prompt,
+            prompt=self._get_text_prompt(prompt, system_prompt, examples),
             temperature=temperature,
             max_tokens=max_tokens,
         )
@@ -197,9 +495,178 @@ class OpenAICompletionsRepo(CompletionsRepo):
                 openai_response=openai_response,
             )
             return ""
+        self._report_usage(openai_response)
         return openai_response["choices"][0]["text"]
 
 
+class SyntheticCompletionsRepo(CompletionsRepo):
+    """
+    Stand-in for a language model, to benchmark AutoPR's own overhead without paying for tokens.
+
+    Responses are derived from the output format requested in the prompt,
+    so that they parse: JSON matching the guardrails output schema,
+    or a code block followed by an outcome, as requested by `GeneratedHunkOutputParser`.
+    The same prompt always gets the same response.
+
+    Parameters
+    ----------
+    latency: float
+        Simulated seconds before the first token is generated.
+    tokens_per_second: float
+        Simulated throughput of generated tokens.
+    """
+
+    models = [
+        'synthetic',
+    ]
+
+    words = ['update', 'the', 'file', 'handler', 'to', 'fix', 'issue', 'with', 'config', 'and', 'tests']
+
+    def __init__(
+        self,
+        *args,
+        latency: float = 0.5,
+        tokens_per_second: float = 50,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+
+    def _complete(
+        self,
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+        max_tokens: int,
+        temperature: float,
+    ) -> str:
+        response = self._synthesize(prompt, system_prompt)
+
+        # Simulate generation time, as if words were tokens
+        num_tokens = min(len(response.split()), max_tokens)
+        time.sleep(self.latency + num_tokens / self.tokens_per_second)
+        return response
+
+    def _stream(
+        self,
+        prompt: str,
+        system_prompt: str,
+        examples: list[tuple[str, str]],
+        max_tokens: int,
+        temperature: float,
+    ) -> Iterator[str]:
+        response = self._synthesize(prompt, system_prompt)
+
+        # Simulate generation time, yielding a word (and the whitespace after it) at a time
+        time.sleep(self.latency)
+        for word in re.findall(r'\s*\S+\s*', response)[:max_tokens]:
+            time.sleep(1 / self.tokens_per_second)
+            yield word
+
+    def _synthesize(self, prompt: str, system_prompt: str) -> str:
+        rng = random.Random(hashlib.sha256(f'{system_prompt}\n{prompt}'.encode()).digest())
+
+        # Refer to paths from the prompt, as the response would
+        paths = sorted(set(re.findall(r'[\w\-]+(?:/[\w\-.]+)*\.\w+', prompt))) or ['README.md']
+
+        output_schema = re.findall(r'<output>.*?</output>', prompt, re.DOTALL)
+        if output_schema:
+            response = json.dumps(
+                self._synthesize_children(ET.fromstring(output_schema[-1]), rng, paths),
+                indent=2,
+            )
+        elif '```\n<string>\n```' in prompt:
+            code = '\n'.join(self._synthesize_words(rng) for _ in range(rng.randint(1, 10)))
+            response = f'```\n{code}\n```\n{json.dumps({"outcome": self._synthesize_words(rng)})}'
+        else:
+            response = f'{self._synthesize_words(rng, max_words=50)} {rng.choice(paths)}'
+        return response
+
+    def _synthesize_words(self, rng: random.Random, max_words: int = 8) -> str:
+        return ' '.join(rng.choice(self.words) for _ in range(rng.randint(1, max_words)))
+
+    def _synthesize_children(self, element: ET.Element, rng: random.Random, paths: list[str]) -> dict[str, Any]:
+        values: dict[str, Any] = {}
+        for child in element:
+            if 'name' not in child.attrib:
+                continue
+            # Guardrails renders choices as a string with `choices`, followed by an object per choice with `if`
+            if 'if' in child.attrib:
+                choice_name, choice = child.attrib['if'].split('==')
+                if values.get(choice_name) != choice:
+                    continue
+            values[child.attrib['name']] = self._synthesize_value(child, rng, paths, child.attrib['name'])
+        return values
+
+    def _synthesize_value(self, element: ET.Element, rng: random.Random, paths: list[str], name: str) -> Any:
+        if element.tag == 'string':
+            if 'choices' in element.attrib:
+                return rng.choice(element.attrib['choices'].split(','))
+            if element.attrib.get('format') == 'filepath' or 'path' in name:
+                return rng.choice(paths)
+            return self._synthesize_words(rng)
+        if element.tag == 'integer':
+            return rng.randint(1, 100)
+        if element.tag == 'float':
+            return rng.random()
+        if element.tag == 'bool':
+            return rng.random() < 0.5
+        if element.tag == 'list':
+            # Items are named after their list
+            return [
+                self._synthesize_value(element[0], rng, paths, name) if len(element) else self._synthesize_words(rng)
+                for _ in range(rng.randint(1, 3))
+            ]
+        if element.tag == 'object':
+            return self._synthesize_children(element, rng, paths)
+        return self._synthesize_words(rng)
+
+
+class ModelRouter:
+    """
+    Routes stages to the completions repos of other models, e.g., to run simple stages on a cheaper, faster model.
+
+    Stages are named like in the usage summary (see `UsageTracker`):
+    prompt rails and chains by their class name (e.g., `InitialFileSelect`, `RewriteCodeHunkChain`),
+    rail strings by their heading (e.g., `action choice`),
+    and guardrails' JSON extraction of a prompt rail's response by its output type (e.g., `InitialFileSelectResponse`).
+    The `guardrails` stage routes the JSON extraction of two-step prompt rails that isn't routed more specifically.
+
+    Parameters
+    ----------
+    default: CompletionsRepo
+        The completions repo of stages without a route.
+    routes: dict[str, CompletionsRepo]
+        Completions repos by stage name.
+    """
+
+    def __init__(
+        self,
+        default: CompletionsRepo,
+        routes: Optional[dict[str, CompletionsRepo]] = None,
+    ):
+        self.default = default
+        self.routes = routes or {}
+
+    def get_completions_repo(self, *stage_names: str) -> CompletionsRepo:
+        """
+        Get the completions repo of the first routed stage in `stage_names`, or the default one.
+        """
+        for stage_name in stage_names:
+            if stage_name in self.routes:
+                return self.routes[stage_name]
+        return self.default
+
+
+#: Context limits of models, for routed models without one configured
+model_context_limits = {
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 4096,
+    'text-davinci-003': 4097,
+}
+
+
 def get_completions_repo(
     publish_service: PublishService,
     model: str = "gpt-4",
@@ -207,7 +674,16 @@ def get_completions_repo(
     min_tokens: int = 1000,
     context_limit: int = 8192,
     temperature: float = 0.8,
+    response_cache: Optional[ResponseCache] = None,
+    max_concurrency: int = 4,
+    rate_limiter: Optional[RateLimiter] = None,
+    usage_tracker: Optional[UsageTracker] = None,
+    **kwargs,
 ):
+    """
+    Get the completions repo that implements `model`.
+    Additional keyword arguments are passed to the repo (e.g., `latency` for the `synthetic` model).
+    """
     repo_implementations = CompletionsRepo.__subclasses__()
     for repo_implementation in repo_implementations:
         if model in repo_implementation.models:
@@ -218,5 +694,10 @@ def get_completions_repo(
                 min_tokens=min_tokens,
                 context_limit=context_limit,
                 temperature=temperature,
+                response_cache=response_cache,
+                max_concurrency=max_concurrency,
+                rate_limiter=rate_limiter,
+                usage_tracker=usage_tracker,
+                **kwargs,
             )
     raise ValueError(f"Model {model} not implemented")
@@ -60,7 +60,7 @@ class AgentService:
         )
 
         # Publish an empty pull request
-        self.publish_service.update()
+        self.publish_service.flush()
 
         # Publish a warning if using gpt-3.5-turbo
         if self.rail_service.completions_repo.model == "gpt-3.5-turbo":
@@ -78,10 +78,33 @@ class AgentService:
             agent.handle_event(event)
         except Exception as e:
             self.log.exception("Agent failed", event_=event, exc_info=e)
-            self.publish_service.finalize(success=False)
+            self.publish_usage()
+            # Raise the agent's error, even if publishing failed too
+            try:
+                self.publish_service.finalize(success=False)
+            except Exception:
+                self.log.exception("Failed to finalize pull request")
             raise e
 
         self.log.info("Generated changes", event_=event)
 
         # Finalize the pull request (put progress updates in a collapsible)
+        self.publish_usage()
         self.publish_service.finalize(success=True)
+
+    def publish_usage(self):
+        """
+        Publish a summary of the run's language model usage, by stage, as a top-level section.
+        Best-effort, so that the pull request is finalized regardless.
+        """
+        usage_tracker = self.rail_service.completions_repo.usage_tracker
+        if not usage_tracker.records:
+            return
+        try:
+            while len(self.publish_service.sections_stack) > 1:
+                self.publish_service.end_section()
+            self.publish_service.start_section("📊 Language model usage")
+            self.publish_service.publish_update(usage_tracker.to_markdown())
+            self.publish_service.end_section()
+        except Exception:
+            self.log.exception("Failed to publish language model usage")
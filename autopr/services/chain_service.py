@@ -13,8 +13,9 @@ from langchain.chat_models.base import BaseChatModel
 
 from langchain.schema import BaseOutputParser, PromptValue
 
-from autopr.models.prompt_chains import PromptChain
-from autopr.repos.completions_repo import CompletionsRepo
+from autopr.models.prompt_chains import PromptChain, StreamingOutputParser
+from autopr.repos.completions_repo import CompletionsRepo, ModelRouter
+from autopr.utils.usage import count_retry
 from langchain import PromptTemplate, OpenAI
 from langchain.chat_models import ChatOpenAI as LangChainChatOpenAI
 from langchain.prompts import ChatPromptTemplate, HumanMessagePromptTemplate
@@ -31,6 +32,7 @@ class ChatOpenAI(LangChainChatOpenAI):
             reraise=True,
             stop=stop_after_attempt(self.max_retries),
             wait=wait_exponential(multiplier=1, min=min_seconds, max=max_seconds),
+            before_sleep=count_retry,
             retry=(
                 retry_if_exception_type(openai.error.Timeout)
                 | retry_if_exception_type(openai.error.APIError)
@@ -47,9 +49,12 @@ class ChainService:
 
     This service is responsible for:
     - compiling the prompt according to `PromptChain.prompt_template` and `PromptChain.get_string_params()`
-    - running the prompt through langchain
+    - running the prompt through langchain,
+      or streaming it through the completions repo if the output parser can check it while it's streamed
     - parsing the output according to `PromptChain.output_parser`
     - Keeping `publish_service` informed of what's going on
+
+    Chains run on `completions_repo`'s model, unless `model_router` routes them to another.
     """
 
     def __init__(
@@ -58,43 +63,57 @@ class ChainService:
         publish_service: PublishService,
         context_limit: int = 8192,
         min_tokens: int = 2000,
+        model_router: Optional[ModelRouter] = None,
     ):
         self.completions_repo = completions_repo
         self.publish_service = publish_service
         self.context_limit = context_limit
         self.min_tokens = min_tokens
+        self.model_router = model_router or ModelRouter(completions_repo)
+
+        # Langchain models by the completions repo they mirror
+        self._models: dict[int, Optional[Union[BaseChatModel, BaseLLM]]] = {}
+        self.model = self._get_model(completions_repo)
+
+        self.log = structlog.get_logger().bind(
+            model=completions_repo.model,
+            service="ChainService",
+        )
 
+    def _get_model(self, completions_repo: CompletionsRepo) -> Optional[Union[BaseChatModel, BaseLLM]]:
         # TODO find a better way to integrate completions repo with langchain
         #   can we make a BaseLanguageModel that takes a completions repo?
         #   or should we replace completions repo with BaseLanguageModel?
-        self.model: Union[BaseChatModel, BaseLLM]
+        if id(completions_repo) in self._models:
+            return self._models[id(completions_repo)]
+
+        model: Optional[Union[BaseChatModel, BaseLLM]]
         if completions_repo.model in [
             "gpt-4",
             "gpt-3.5-turbo"
         ]:
-            self.model = ChatOpenAI(
+            model = ChatOpenAI(
                 model_name=completions_repo.model,
                 temperature=completions_repo.temperature,
                 max_tokens=completions_repo.max_tokens,
             )  # type: ignore
         elif completions_repo.model == "text-davinci-003":
-            self.model = OpenAI(
+            model = OpenAI(
                 model_name=completions_repo.model,
                 temperature=completions_repo.temperature,
                 max_tokens=completions_repo.max_tokens,
             )  # type: ignore
         else:
-            raise ValueError(f"Unsupported model {completions_repo.model}")
-
-        self.log = structlog.get_logger().bind(
-            model=completions_repo.model,
-            service="ChainService",
-        )
+            # Run models without a langchain integration (e.g., `synthetic`) through the completions repo
+            model = None
+        self._models[id(completions_repo)] = model
+        return model
 
     def _get_model_template(
         self,
         chain: PromptChain,
         parser: Optional[BaseOutputParser],
+        model: Optional[Union[BaseChatModel, BaseLLM]],
     ) -> PromptValue:
         variables = dict(chain.get_string_params())
         variable_names = list(variables.keys())
@@ -102,7 +121,7 @@ class ChainService:
         if parser is not None:
             partial_variables["format_instructions"] = parser.get_format_instructions()
 
-        if isinstance(self.model, BaseChatModel):
+        if isinstance(model, BaseChatModel):
             template = ChatPromptTemplate(
                 messages=[
                     HumanMessagePromptTemplate.from_template(chain.prompt_template)
@@ -118,17 +137,98 @@ class ChainService:
             )
         return template.format_prompt(**variables)
 
-    def _run_model(self, template: PromptValue) -> Any:
-        if isinstance(self.model, BaseChatModel):
-            return self.model(template.to_messages()).content
+    def _run_model(
+        self,
+        template: PromptValue,
+        parser: Optional[BaseOutputParser] = None,
+        max_tokens: Optional[int] = None,
+        completions_repo: Optional[CompletionsRepo] = None,
+    ) -> Any:
+        if completions_repo is None:
+            completions_repo = self.completions_repo
+        model = self._get_model(completions_repo)
+
+        # The prompt as the completions repo sends it, without a system prompt,
+        # making the same request as langchain (the chat prompt template has a single message)
+        if isinstance(model, BaseChatModel):
+            prompt = '\n\n'.join(message.content for message in template.to_messages())
         else:
-            return self.model(template.to_string())
+            prompt = template.to_string()
+
+        output_stream = None
+        if isinstance(parser, StreamingOutputParser):
+            output_stream = parser.get_output_stream()
+        if model is None or output_stream is not None:
+            # Langchain can't stop generating early, so stream through the completions repo instead
+            return completions_repo.complete(
+                prompt=prompt,
+                system_prompt='',
+                temperature=completions_repo.temperature,
+                output_stream=output_stream,
+                max_tokens=max_tokens,
+            )
+
+        # Limit the response like the completions repo would
+        prompt_length = completions_repo.count_prompt_tokens(prompt, '', [])
+        max_tokens = completions_repo.get_max_tokens(prompt_length, max_tokens)
+        if max_tokens != completions_repo.max_tokens:
+            model = model.copy(update={'max_tokens': max_tokens})
+
+        with completions_repo.usage_tracker.track(completions_repo.model) as usage:
+            # Cache responses with the completions repo's cache, keyed like the same request without a system prompt
+            response_cache = completions_repo.response_cache
+            cache_key = None
+            if response_cache is not None and response_cache.should_cache(completions_repo.temperature):
+                cache_key = response_cache.get_key(
+                    model=completions_repo.model,
+                    system_prompt='',
+                    examples=[],
+                    prompt=prompt,
+                    temperature=completions_repo.temperature,
+                    max_tokens=max_tokens,
+                )
+                cached_output = response_cache.get(cache_key)
+                if cached_output is not None:
+                    usage.cache_hit = True
+                    self.log.info("Using cached result")
+                    return cached_output
+
+            rate_limiter = completions_repo.rate_limiter
+            if rate_limiter is not None:
+                usage.rate_limit_wait = rate_limiter.acquire(prompt_length + max_tokens)
+
+            if isinstance(model, BaseChatModel):
+                output = model(template.to_messages()).content
+            else:
+                output = model(template.to_string())
+
+            # Langchain doesn't report usage through its call interface, so estimate it with the tokenizer
+            usage.prompt_tokens = prompt_length
+            usage.completion_tokens = completions_repo.tokenizer.count_tokens(output)
+
+            if cache_key is not None and response_cache is not None:
+                response_cache.set(cache_key, output)
+            return output
 
     def run_chain(self, chain: PromptChain) -> Any:
+        with self.completions_repo.usage_tracker.stage(chain.__class__.__name__):
+            return self._run_chain(chain)
+
+    def _run_chain(self, chain: PromptChain) -> Any:
         self.publish_service.start_section(f"⛓ Running {chain.__class__.__name__} chain")
-        # Make sure the prompt is not too long
-        max_length = self.context_limit - self.min_tokens
-        success = chain.ensure_token_length(max_length)
+        completions_repo = self.model_router.get_completions_repo(chain.__class__.__name__)
+
+        # Make sure the prompt is not too long (routed models have their own context limit),
+        # counting it as it's sent, without a system prompt
+        context_limit = completions_repo.context_limit
+        if completions_repo is self.completions_repo:
+            context_limit = min(context_limit, self.context_limit)
+        success = completions_repo.ensure_prompt_length(
+            chain,
+            system_prompt='',
+            min_tokens=max(self.min_tokens, completions_repo.min_tokens),
+            context_limit=context_limit,
+        )
         if not success:
             return None
 
@@ -136,7 +236,7 @@ class ChainService:
             parser = chain.output_parser
         else:
             parser = None
-        prompt_value = self._get_model_template(chain, parser)
+        prompt_value = self._get_model_template(chain, parser, self._get_model(completions_repo))
         str_prompt = prompt_value.to_string()
 
         self.publish_service.publish_code_block(
@@ -145,7 +245,20 @@ class ChainService:
         )
         self.log.info("Running chain", prompt=str_prompt)
 
-        raw_output = self._run_model(prompt_value)
+        try:
+            raw_output = self._run_model(
+                prompt_value,
+                parser,
+                max_tokens=completions_repo.get_estimated_max_tokens(
+                    chain.estimate_max_tokens(completions_repo.tokenizer),
+                ),
+                completions_repo=completions_repo,
+            )
+        except ValueError:
+            # The prompt couldn't be trimmed enough to leave room for the completion
+            self.log.exception("Prompt too long", prompt=str_prompt)
+            self.publish_service.end_section(f"❌ Chain {chain.__class__.__name__} failed (prompt too long)")
+            return None
 
         self.publish_service.publish_code_block(
             heading="Output",
@@ -168,3 +281,10 @@ class ChainService:
             output = raw_output
         self.publish_service.end_section(f"⛓ {chain.__class__.__name__} completed")
         return output
+
+    async def arun_chain(self, chain: PromptChain) -> Any:
+        """
+        Like `run_chain`, but awaitable, so that independent chains can run concurrently.
+        Shares its concurrency limit with `CompletionsRepo.acomplete`.
+        """
+        return await self.completions_repo.run_concurrently(self.run_chain, chain)
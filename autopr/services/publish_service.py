@@ -1,5 +1,9 @@
+import contextvars
+import hashlib
 import json
 import sys
+import threading
+import time
 import traceback
 from typing import Optional, Union, Any, Type
 
@@ -39,6 +43,25 @@ class UpdateSection(pydantic.BaseModel):
     title: str
     updates: list[Union[str, CodeBlock, 'UpdateSection']] = pydantic.Field(default_factory=list)
 
+    # Rendering cache, invalidated whenever the section or one of its descendants changes
+    _dirty: bool = pydantic.PrivateAttr(default=True)
+    _rendered_updates: str = pydantic.PrivateAttr(default="")
+    _contains_last_code_block: bool = pydantic.PrivateAttr(default=False)
+    _num_leaves: int = pydantic.PrivateAttr(default=0)
+
+
+class _Packing:
+    """
+    State of packing the updates into bodies (see `PublishService._build_bodies`).
+    Updates that aren't sections (leaves) are numbered in order, and bodies are identified by their first leaf.
+    """
+
+    def __init__(self, success: Optional[bool], forced_breaks: set[int]):
+        self.success = success
+        self.forced_breaks = forced_breaks
+        self.breaks: set[int] = set()
+        self.leaf_index = 0
+
 
 class PublishService:
     """
@@ -52,6 +75,10 @@ class PublishService:
     To publish updates to the current section, call:
     - `publish_update` to publish a simple textual update
     - `publish_code_block` to publish text in a triple-backtick-style code block
+
+    Updates are published by a background thread, so that the agent doesn't wait on the provider.
+    They are coalesced, publishing the pull request at most once per `publish_interval` seconds.
+    Call `flush` to publish pending updates right away; `finalize` always does.
     """
 
     def __init__(
@@ -64,6 +91,8 @@ class PublishService:
         pull_request_number: Optional[int] = None,
         loading_gif_url: str = "https://media.giphy.com/media/3oEjI6SIIHBdRxXI40/giphy.gif",
         overwrite_existing: bool = False,
+        publish_interval: float = 0,
+        finalize_timeout: float = 60,
     ):
         self.owner = owner
         self.repo_name = repo_name
@@ -76,6 +105,10 @@ class PublishService:
 
         # GitHub comment length limit is ~262144, not 65536 as stated in the docs
         self.max_comment_length = 260000
+        # Longer code blocks are truncated, so that each fits within a comment
+        self.max_code_block_length = 60000
+        # First leaf updates of the bodies after the first, kept in place while repacking (see `_build_bodies`)
+        self._body_breaks: set[int] = set()
 
         if issue is not None:
             self.title: str = f"Fix #{issue.number}: {issue.title}"
@@ -85,11 +118,30 @@ class PublishService:
             level=0,
             title="root",
         )
-        self.sections_stack: list[UpdateSection] = [self.root_section]
+        self._root_sections_stack: list[UpdateSection] = [self.root_section]
+        # Concurrently running rails and chains each get their own stack (see `fork_sections_stack`)
+        self._forked_sections_stack: contextvars.ContextVar[Optional[list[UpdateSection]]] = \
+            contextvars.ContextVar(f'sections_stack_{id(self)}', default=None)
+
+        # Publishing state, shared with the background publisher thread (see `update`)
+        self.publish_interval = publish_interval
+        self.finalize_timeout = finalize_timeout
+        self._publish_condition = threading.Condition(threading.RLock())
+        self._publisher_thread: Optional[threading.Thread] = None
+        self._dirty = False
+        self._force_publish = False
+        self._stopping = False
+        self._requested_publishes = 0
+        self._completed_publishes = 0
+        self._last_published_at = -float('inf')
+        self._final_bodies: Optional[tuple[list[str], bool]] = None
+        self._publish_error: Optional[Exception] = None
 
         self.log = structlog.get_logger(service="publish")
 
         self._last_code_block: Optional[CodeBlock] = None
+        # Sections from the root to the last code block, which render differently once it's no longer the last
+        self._last_code_block_path: list[UpdateSection] = []
 
         self.error_report_template = """
 ## Traceback
@@ -103,6 +155,17 @@ class PublishService:
                                               "labels=bug&" \
                                               "body={body}"
 
+    @property
+    def sections_stack(self) -> list[UpdateSection]:
+        return self._forked_sections_stack.get() or self._root_sections_stack
+
+    def fork_sections_stack(self):
+        """
+        Give the current context (e.g., thread or asyncio task) its own copy of the sections stack,
+        so that sections started concurrently nest under the current section, instead of under each other.
+        """
+        self._forked_sections_stack.set(list(self.sections_stack))
+
     def set_title(self, title: str):
         """
         Set the pull request title and body.
@@ -116,7 +179,7 @@ class PublishService:
             The body of the pull request
         """
         if self.pr_number is None:
-            self.update()
+            self.flush()
             if self.pr_number is None:
                 raise RuntimeError("Error creating pull request")
         else:
@@ -137,13 +200,15 @@ class PublishService:
         section_title: str, optional
             The title that the parent section should be updated to
         """
-        self.sections_stack[-1].updates.append(text)
-        if section_title:
-            if self.sections_stack is self.root_section:
-                raise ValueError("Cannot set section title on root section")
-            self.sections_stack[-1].title = section_title
-        self.log.debug("Publishing update", text=text)
-        self.update()
+        with self._publish_condition:
+            self._mark_dirty(self.sections_stack)
+            self.sections_stack[-1].updates.append(text)
+            if section_title:
+                if self.sections_stack is self.root_section:
+                    raise ValueError("Cannot set section title on root section")
+                self.sections_stack[-1].title = section_title
+            self.log.debug("Publishing update", text=text)
+            self.update()
 
     def publish_code_block(
         self,
@@ -175,13 +240,17 @@ class PublishService:
             language=language,
             default_open=default_open,
         )
-        self._last_code_block = block
-        self.sections_stack[-1].updates.append(block)
-        if section_title:
-            if self.sections_stack is self.root_section:
-                raise ValueError("Cannot set section title on root section")
-            self.sections_stack[-1].title = section_title
-        self.update()
+        with self._publish_condition:
+            self._mark_dirty(self._last_code_block_path)
+            self._mark_dirty(self.sections_stack)
+            self._last_code_block = block
+            self._last_code_block_path = list(self.sections_stack)
+            self.sections_stack[-1].updates.append(block)
+            if section_title:
+                if self.sections_stack is self.root_section:
+                    raise ValueError("Cannot set section title on root section")
+                self.sections_stack[-1].title = section_title
+            self.update()
 
     def start_section(
         self,
@@ -200,9 +269,11 @@ class PublishService:
             level=len(self.sections_stack),
             title=title,
         )
-        self.sections_stack[-1].updates.append(new_section)  # Add the new section as a child
-        self.sections_stack.append(new_section)
-        self.update()
+        with self._publish_condition:
+            self._mark_dirty(self.sections_stack)
+            self.sections_stack[-1].updates.append(new_section)  # Add the new section as a child
+            self.sections_stack.append(new_section)
+            self.update()
 
     def update_section(self, title: str):
         """
@@ -216,8 +287,10 @@ class PublishService:
         if len(self.sections_stack) == 1:
             raise ValueError("Cannot set section title on root section")
         self.log.debug("Updating section", title=title)
-        self.sections_stack[-1].title = title
-        self.update()
+        with self._publish_condition:
+            self._mark_dirty(self.sections_stack)
+            self.sections_stack[-1].title = title
+            self.update()
 
     def end_section(
         self,
@@ -236,106 +309,290 @@ class PublishService:
         if len(self.sections_stack) == 1:
             raise ValueError("Cannot end root section")
         self.log.debug("Ending section", title=title)
-        if title:
-            self.sections_stack[-1].title = title
-        self.sections_stack.pop()
+        with self._publish_condition:
+            self._mark_dirty(self.sections_stack)
+            if title:
+                self.sections_stack[-1].title = title
+            self.sections_stack.pop()
+
+            self.update()
 
-        self.update()
+    @staticmethod
+    def _mark_dirty(sections: list[UpdateSection]):
+        for section in sections:
+            section._dirty = True
 
-    def _contains_last_code_block(self, parent: UpdateSection) -> bool:
-        for section in reversed(parent.updates):
-            if isinstance(section, CodeBlock):
-                return section is self._last_code_block
-            elif isinstance(section, UpdateSection):
-                return self._contains_last_code_block(section)
+    def _contains_last_code_block(self, section: UpdateSection) -> bool:
+        self._render_updates(section)
+        return section._contains_last_code_block
+
+    def _count_leaves(self, section: UpdateSection) -> int:
+        self._render_updates(section)
+        return section._num_leaves
+
+    def _is_open(self, section: UpdateSection, update: Union[str, CodeBlock, UpdateSection],
+                 success: Optional[bool] = None) -> bool:
+        """
+        Whether `update` is rendered open by default within `section`.
+        """
+        if isinstance(update, UpdateSection):
+            if section is self.root_section:
+                # Leave the last section open if we're not finalizing (i.e. if we're still running or errored)
+                return not success and (update is section.updates[-1] or self._contains_last_code_block(update))
+            return self._contains_last_code_block(update) or update is section.updates[-1]
+        if isinstance(update, CodeBlock):
+            if section is self.root_section:
+                return update.default_open
+            return self._last_code_block is None or update is self._last_code_block or update is section.updates[-1]
         return False
 
+    def _render_update(self, section: UpdateSection, update: Union[str, CodeBlock, UpdateSection],
+                       success: Optional[bool] = None) -> str:
+        """
+        Render an update of `section`, unquoted.
+        """
+        if isinstance(update, UpdateSection):
+            return self._build_progress_update(update, open_default=self._is_open(section, update, success))
+        if isinstance(update, CodeBlock):
+            open_default = self._is_open(section, update, success)
+            if len(update.code) > self.max_code_block_length:
+                # Fold the rest of oversized code blocks, so that each fits within a comment
+                num_truncated = len(update.code) - self.max_code_block_length
+                update = update.copy(update={
+                    'code': f"{update.code[:self.max_code_block_length]}\n... ({num_truncated} characters truncated)",
+                })
+            if open_default and not update.default_open:
+                # Clone the block and set default_open to True
+                update = update.copy(update={'default_open': True})
+            return str(update)
+        return update
+
+    @staticmethod
+    def _quote(text: str, depth: int) -> str:
+        if depth == 0:
+            return text
+        return '\n'.join([f"{'> ' * depth}{line}" for line in text.splitlines()])
+
+    def _render_updates(self, section: UpdateSection) -> str:
+        """
+        Render the updates of a section, quoted, reusing the cached rendering if the section hasn't changed.
+        Changes mark the sections from the root to the changed section as dirty,
+        so only those are re-rendered, instead of the whole tree.
+        """
+        if not section._dirty:
+            return section._rendered_updates
+
+        # Prefix updates with quotation
+        updates = '\n\n'.join([self._render_update(section, update) for update in section.updates])
+        section._rendered_updates = self._quote(updates, 1)
+
+        # The last code block is open by default, along with the sections leading to it
+        section._contains_last_code_block = False
+        for update in reversed(section.updates):
+            if isinstance(update, CodeBlock):
+                section._contains_last_code_block = update is self._last_code_block
+                break
+            elif isinstance(update, UpdateSection):
+                section._contains_last_code_block = update._contains_last_code_block
+                break
+
+        section._num_leaves = sum(
+            update._num_leaves if isinstance(update, UpdateSection) else 1
+            for update in section.updates
+        )
+        section._dirty = False
+        return section._rendered_updates
+
     def _build_progress_update(self, section: UpdateSection, open_default: bool = False) -> str:
-        progress = ""
-        # Get list of steps
-        updates = []
+        updates = self._render_updates(section)
+        return self._wrap_progress_update(section.title, updates, open_default)
+
+    @staticmethod
+    def _wrap_progress_update(title: str, updates: str, open_default: bool, depth: int = 0) -> str:
+        prefix = '> ' * depth
+        return f"""{prefix}<details{' open' if open_default else ''}>
+{prefix}<summary>{title}</summary>
+{prefix}
+{updates}
+{prefix}</details>"""
+
+    def _pack_updates(
+        self,
+        section: UpdateSection,
+        depth: int,
+        first_room: int,
+        next_room: int,
+        packing: '_Packing',
+    ) -> list[list[str]]:
+        """
+        Greedily pack the updates of `section`, rendered at quotation `depth`, into as few parts as possible.
+        The first part fits within `first_room` characters, and the rest within `next_room`
+        (except for single updates that don't fit anywhere).
+        Sections that don't fit are split between parts, each starting a new body.
+
+        Returns the updates of each part. The first part is empty if not even the first update fits into it.
+        """
+        separator = f"\n{'> ' * depth}\n"
+        parts: list[list[str]] = [[]]
+        length = 0
+
+        def start_part():
+            nonlocal length
+            parts.append([])
+            length = 0
+            packing.breaks.add(packing.leaf_index)
+
+        def add(rendered: str):
+            nonlocal length
+            length += len(rendered) + (len(separator) if parts[-1] else 0)
+            parts[-1].append(rendered)
+
         for update in section.updates:
+            room = first_room if len(parts) == 1 else next_room
+            free_room = room - length - (len(separator) if parts[-1] else 0)
+            can_start_part = bool(parts[-1]) or len(parts) == 1
+            num_leaves = self._count_leaves(update) if isinstance(update, UpdateSection) else 1
+            start, end = packing.leaf_index, packing.leaf_index + num_leaves
+
+            # Keep the bodies that are already published where they are, so appends only change the last one
+            if start in packing.forced_breaks and can_start_part and start not in packing.breaks:
+                start_part()
+                free_room = next_room
+                can_start_part = False
+
+            rendered = self._quote(self._render_update(section, update, packing.success), depth)
+            splits_within = any(start < break_ < end for break_ in packing.forced_breaks)
+            if len(rendered) <= free_room and not splits_within:
+                add(rendered)
+                packing.leaf_index = end
+                continue
+
             if isinstance(update, UpdateSection):
-                # Recursively build updates
-                updates += [self._build_progress_update(
+                # Split the section, continuing it in the following parts
+                section_parts = self._split_section(
                     update,
-                    open_default=(
-                        self._contains_last_code_block(update) or update is section.updates[-1]
-                    ),
-                )]
-                continue
-            if isinstance(update, CodeBlock):
-                # If is the last code block
-                if self._last_code_block is None or update is self._last_code_block or update is section.updates[-1]:
-                    # Clone the block and set default_open to True
-                    update = update.copy()
-                    update.default_open = True
-                updates += [str(update)]
+                    open_default=self._is_open(section, update, packing.success),
+                    depth=depth,
+                    first_room=free_room,
+                    next_room=next_room,
+                    packing=packing,
+                )
+                for i, section_part in enumerate(section_parts):
+                    if section_part is None:
+                        continue
+                    if i > 0 and (parts[-1] or len(parts) == 1):
+                        # The section's parts each started a new body, which this level has to follow
+                        parts.append([])
+                        length = 0
+                    add(section_part)
                 continue
-            updates += [update]
 
-        # Prefix updates with quotation
-        updates = '\n\n'.join(updates)
-        updates = '\n'.join([f"> {line}" for line in updates.splitlines()])
+            # Start a new part for the update, even if it doesn't fit there either
+            if can_start_part and len(rendered) > free_room:
+                start_part()
+            add(rendered)
+            packing.leaf_index = end
 
-        # Leave the last section open if we're not finalizing (i.e. if we're still running or errored)
-        progress += f"""<details{' open' if open_default else ''}>
-<summary>{section.title}</summary>
+        return parts
 
-{updates}
-</details>"""
+    def _split_section(
+        self,
+        section: UpdateSection,
+        open_default: bool,
+        depth: int,
+        first_room: int,
+        next_room: int,
+        packing: '_Packing',
+    ) -> list[Optional[str]]:
+        """
+        Render a section at quotation `depth`, split into parts that fit within
+        `first_room` and `next_room` characters (see `_pack_updates`).
+        Parts after the first are titled as continuations.
 
-        return progress
+        Returns None for the first part if it doesn't fit at all.
+        """
+        continued_title = f"{section.title} (continued)"
+        wrapper_length = len(self._wrap_progress_update(section.title, '', open_default, depth))
+        continued_wrapper_length = len(self._wrap_progress_update(continued_title, '', open_default, depth))
+
+        updates_parts = self._pack_updates(
+            section,
+            depth=depth + 1,
+            first_room=first_room - wrapper_length,
+            next_room=next_room - continued_wrapper_length,
+            packing=packing,
+        )
+        if len(updates_parts) == 1 and not updates_parts[0] and first_room < wrapper_length:
+            # Not even an empty section fits
+            packing.breaks.add(packing.leaf_index)
+            return [None, self._wrap_progress_update(section.title, '', open_default, depth)]
+
+        parts: list[Optional[str]] = []
+        for updates in updates_parts:
+            if not updates and len(updates_parts) > 1 and not parts:
+                parts.append(None)
+                continue
+            title = section.title if not any(parts) else continued_title
+            parts.append(self._wrap_progress_update(
+                title,
+                f"\n{'> ' * (depth + 1)}\n".join(updates),
+                open_default,
+                depth,
+            ))
+        return parts
 
     def _build_bodies(self, success: Optional[bool] = None) -> list[str]:
         """
         Builds the body of the pull request, splitting it into multiple bodies if necessary.
-        Assumes that the top-level section groups are each small enough to fit within `max_comment_length`.
-        """
-        bodies = []
 
-        body = ""
+        Updates are packed into as few bodies as fit within `max_comment_length`,
+        splitting sections between bodies at any of their updates.
+        The bodies published before keep their updates, so that new updates only change the last body.
+        """
+        header = ""
         if self.issue is not None:
             # Add Fixes magic word
-            body += f"Fixes #{self.issue.number}\n\n"
+            header += f"Fixes #{self.issue.number}\n\n"
 
         # Build status
-        body += f"## Status\n\n"
+        header += f"## Status\n\n"
         if success is None:
-            body += "This pull request is being autonomously generated by [AutoPR](https://github.com/irgolic/AutoPR)."
+            header += "This pull request is being autonomously generated by [AutoPR](https://github.com/irgolic/AutoPR)."
         elif not success:
-            body += f"This pull request was being autonomously generated by " \
-                    f"[AutoPR](https://github.com/irgolic/AutoPR), but it encountered an error."
+            header += f"This pull request was being autonomously generated by " \
+                      f"[AutoPR](https://github.com/irgolic/AutoPR), but it encountered an error."
             if sys.exc_info()[0] is not None:
-                body += f"\n\nError:\n\n```\n{traceback.format_exc()}\n```"
-            body += f'\n\nPlease <a href="{self._build_issue_template_link()}">open an issue</a> to report this.'
+                header += f"\n\nError:\n\n```\n{traceback.format_exc()}\n```"
+            header += f'\n\nPlease <a href="{self._build_issue_template_link()}">open an issue</a> to report this.'
         elif success:
-            body += f"This pull request was autonomously generated by [AutoPR](https://github.com/irgolic/AutoPR).\n\n" \
-                    f"If there's a problem with this pull request, please " \
-                    f"[open an issue]({self._build_issue_template_link()})."
-
-        for section in self.root_section.updates:
-            if isinstance(section, UpdateSection):
-                progress_update = self._build_progress_update(
-                    section,
-                    open_default=(
-                        not success and
-                        (section is self.root_section.updates[-1] or self._contains_last_code_block(section))
-                    ),
-                )
-            else:
-                progress_update = str(section)
-            if len(body) + len('\n\n' + progress_update) > self.max_comment_length:
-                bodies += [body]
-                body = f"## Status (continued)\n\n{progress_update}"
-            else:
-                body += f"\n\n{progress_update}"
+            header += f"This pull request was autonomously generated by [AutoPR](https://github.com/irgolic/AutoPR).\n\n" \
+                      f"If there's a problem with this pull request, please " \
+                      f"[open an issue]({self._build_issue_template_link()})."
+        continued_header = "## Status (continued)"
 
+        footer = ""
         if success is None:
-            body += f"\n\n" \
-                    f'<img src="{self.loading_gif_url}"' \
-                    f' width="200" height="200"/>'
-        bodies += [body]
+            footer += f"\n\n" \
+                      f'<img src="{self.loading_gif_url}"' \
+                      f' width="200" height="200"/>'
+
+        packing = _Packing(success=success, forced_breaks=self._body_breaks)
+        parts = self._pack_updates(
+            self.root_section,
+            depth=0,
+            first_room=self.max_comment_length - len(header) - len('\n\n') - len(footer),
+            next_room=self.max_comment_length - len(continued_header) - len('\n\n') - len(footer),
+            packing=packing,
+        )
+        self._body_breaks = packing.breaks
+
+        bodies = []
+        for i, updates in enumerate(parts):
+            body = header if i == 0 else continued_header
+            if updates:
+                body += '\n\n' + '\n\n'.join(updates)
+            bodies += [body]
+        bodies[-1] += footer
         # self.log.debug("Built bodies", bodies=bodies)
         return bodies
 
@@ -365,27 +622,118 @@ class PublishService:
     def update(self):
         """
         Update the PR body with the current progress.
+
+        Returns right away, leaving the publishing to a background thread.
+        It publishes right away if the last publish was at least `publish_interval` seconds ago,
+        otherwise once the interval is up, including any updates made in the meantime.
+        Raises the error of a failed background publish, if any.
         """
-        bodies = self._build_bodies()
-        self._publish_progress(bodies)
+        with self._publish_condition:
+            self._raise_publish_error()
+            self._request_publish()
+
+    def flush(self):
+        """
+        Publish the current progress right away, waiting until it's published.
+        """
+        with self._publish_condition:
+            self._raise_publish_error()
+            publish_number = self._request_publish(force=True)
+            self._publish_condition.wait_for(lambda: self._completed_publishes >= publish_number)
+            self._raise_publish_error()
 
     def finalize(self, success: bool):
         """
         Finalize the PR, either successfully or unsuccessfully.
         Will render the final PR description without the loading gif.
 
+        Waits up to `finalize_timeout` seconds for pending updates and the final description to be published.
+
         Parameters
         ----------
         success: bool
             Whether the PR was successful or not
         """
-        bodies = self._build_bodies(success=success)
-        self._publish_progress(bodies, success=success)
+        with self._publish_condition:
+            # Build the bodies here, as the error report reads the exception being handled in this thread
+            self._final_bodies = (self._build_bodies(success=success), success)
+            publish_number = self._request_publish(force=True)
+            published = self._publish_condition.wait_for(
+                lambda: self._completed_publishes >= publish_number,
+                timeout=self.finalize_timeout,
+            )
+            self._stopping = True
+            self._publish_condition.notify_all()
+            if not published:
+                self.log.error("Timed out publishing the final pull request description",
+                               timeout=self.finalize_timeout)
+            self._raise_publish_error()
+
+    def _request_publish(self, force: bool = False) -> int:
+        """
+        Mark the progress as changed, returning the number of the publish that will include the change.
+        Only the latest state is published, so several requests may be served by a single publish.
+        """
+        self._dirty = True
+        self._force_publish |= force
+        self._stopping = False
+        self._requested_publishes += 1
+        if self._publisher_thread is None or not self._publisher_thread.is_alive():
+            self._publisher_thread = threading.Thread(
+                target=self._run_publisher,
+                name=f'publisher_{id(self)}',
+                daemon=True,
+            )
+            self._publisher_thread.start()
+        self._publish_condition.notify_all()
+        return self._requested_publishes
+
+    def _run_publisher(self):
+        while True:
+            with self._publish_condition:
+                # Wait for changes, and for the interval since the last publish to be up
+                while True:
+                    if self._dirty:
+                        wait_seconds = self._last_published_at + self.publish_interval - time.monotonic()
+                        if self._force_publish or wait_seconds <= 0:
+                            break
+                        self._publish_condition.wait(wait_seconds)
+                    elif self._stopping:
+                        return
+                    else:
+                        self._publish_condition.wait()
+
+                if self._final_bodies is not None:
+                    bodies, success = self._final_bodies
+                else:
+                    bodies, success = self._build_bodies(), False
+                publish_number = self._requested_publishes
+                self._dirty = False
+                self._force_publish = False
+
+            # Talk to the provider without holding the lock, so the agent can keep making updates meanwhile
+            try:
+                self._publish_progress(bodies, success=success)
+            except Exception as e:
+                # Raise it in the agent's thread on the next update
+                self.log.exception("Failed to publish progress")
+                with self._publish_condition:
+                    self._publish_error = e
+
+            with self._publish_condition:
+                self._completed_publishes = publish_number
+                self._last_published_at = time.monotonic()
+                self._publish_condition.notify_all()
+
+    def _raise_publish_error(self):
+        if self._publish_error is not None:
+            error, self._publish_error = self._publish_error, None
+            raise error
 
     def publish_comment(self, text: str, issue_number: Optional[int] = None) -> Optional[str]:
         if issue_number is None:
             if self.pr_number is None:
-                self.update()
+                self.flush()
                 if self.pr_number is None:
                     raise RuntimeError("Error creating pull request")
             issue_number = self.pr_number
@@ -461,6 +809,8 @@ class GitHubPublishService(PublishService):
         pull_request_number: Optional[int] = None,
         loading_gif_url: str = "https://media.giphy.com/media/3oEjI6SIIHBdRxXI40/giphy.gif",
         overwrite_existing: bool = False,
+        publish_interval: float = 0,
+        finalize_timeout: float = 60,
     ):
         super().__init__(
             owner=owner,
@@ -471,6 +821,8 @@ class GitHubPublishService(PublishService):
             pull_request_number=pull_request_number,
             loading_gif_url=loading_gif_url,
             overwrite_existing=overwrite_existing,
+            publish_interval=publish_interval,
+            finalize_timeout=finalize_timeout,
         )
         self.token = token
         self.run_id = run_id
@@ -481,6 +833,9 @@ class GitHubPublishService(PublishService):
 
         # list of comment IDs, incl. PRBodySentinel to denote the body of the PR
         self._comment_ids: list[Union[str, Type[GitHubPublishService.PRBodySentinel]]] = []
+        # Hashes of the last published body of each comment ID, and the last set draft status, to skip unchanged writes
+        self._published_body_hashes: dict[Union[str, Type[GitHubPublishService.PRBodySentinel]], str] = {}
+        self._is_draft: Optional[bool] = None
 
         self.max_char_length = 65536
 
@@ -576,25 +931,36 @@ Pull Request: {pr_link}
             self.pr_node_id = pr['node_id']
             return
 
-        # Update the comments
+        # Update the comments that changed
         for i, body in enumerate(bodies):
+            body_hash = self._hash_body(body)
             if i >= len(self._comment_ids):
                 comment_id = self.publish_comment(body, self.pr_number)
                 if comment_id is None:
                     raise RuntimeError("Failed to publish progress comment")
                 self._comment_ids.append(comment_id)
+                self._published_body_hashes[comment_id] = body_hash
                 continue
             comment_id = self._comment_ids[i]
+            if self._published_body_hashes.get(comment_id) == body_hash:
+                continue
             if comment_id is self.PRBodySentinel:
-                self._update_pr_body(self.pr_number, body)
+                updated = self._update_pr_body(self.pr_number, body)
             else:
-                self._update_pr_comment(str(comment_id), body)
+                updated = self._update_pr_comment(str(comment_id), body)
+            if updated:
+                self._published_body_hashes[comment_id] = body_hash
 
-        # Update draft status
-        if self._drafts_supported:
+        # Update draft status, if it changed
+        if self._drafts_supported and self._is_draft != (not success):
             if self.pr_node_id is None:
                 self.pr_node_id = self._get_pull_request_node_id(self.pr_number)
             self._set_pr_draft_status(self.pr_node_id, not success)
+            self._is_draft = not success
+
+    @staticmethod
+    def _hash_body(body: str) -> str:
+        return hashlib.sha256(body.encode()).hexdigest()
 
     def _find_existing_pr(self) -> Optional[dict[str, Any]]:
         """
@@ -664,6 +1030,9 @@ Pull Request: {pr_link}
         pr_number = pr['number']
 
         self._comment_ids = [self.PRBodySentinel]
+        self._published_body_hashes = {self.PRBodySentinel: self._hash_body(bodies[0])}
+        if 'draft' in data:
+            self._is_draft = not success
 
         # Add additional bodies as comments
         for body in bodies[1:]:
@@ -671,17 +1040,18 @@ Pull Request: {pr_link}
             if id_ is None:
                 raise RuntimeError("Failed to publish progress comment")
             self._comment_ids.append(id_)
+            self._published_body_hashes[id_] = self._hash_body(body)
 
         return pr
 
-    def _patch_pr(self, pr_number: int, data: dict[str, Any]):
+    def _patch_pr(self, pr_number: int, data: dict[str, Any]) -> bool:
         url = f'https://api.github.com/repos/{self.owner}/{self.repo_name}/pulls/{pr_number}'
         headers = self._get_headers()
         response = requests.patch(url, json=data, headers=headers)
 
         if response.status_code == 200:
             self.log.debug('Pull request updated successfully')
-            return
+            return True
 
         self._log_failed_request(
             'Failed to update pull request',
@@ -690,6 +1060,7 @@ Pull Request: {pr_link}
             request_body=data,
             response=response,
         )
+        return False
 
     def _is_draft_error(self, response_text: str):
         response_obj = json.loads(response_text)
@@ -762,20 +1133,20 @@ Pull Request: {pr_link}
 
         self._drafts_supported = False
 
-    def _update_pr_body(self, pr_number: int, body: str):
-        self._patch_pr(pr_number, {'body': body})
+    def _update_pr_body(self, pr_number: int, body: str) -> bool:
+        return self._patch_pr(pr_number, {'body': body})
 
     def _update_pr_title(self, pr_number: int, title: str):
         self._patch_pr(pr_number, {'title': title})
 
-    def _update_pr_comment(self, comment_id: str, body: str):
+    def _update_pr_comment(self, comment_id: str, body: str) -> bool:
         url = f'https://api.github.com/repos/{self.owner}/{self.repo_name}/issues/comments/{comment_id}'
         headers = self._get_headers()
         response = requests.patch(url, json={'body': body}, headers=headers)
 
         if response.status_code == 200:
             self.log.debug('Comment updated successfully')
-            return
+            return True
 
         self._log_failed_request(
             'Failed to update comment',
@@ -784,6 +1155,7 @@ Pull Request: {pr_link}
             request_body={'body': body},
             response=response,
         )
+        return False
 
     def _publish_comment(self, text: str, issue_number: int) -> Optional[str]:
         url = f'https://api.github.com/repos/{self.owner}/{self.repo_name}/issues/{issue_number}/comments'
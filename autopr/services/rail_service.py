@@ -1,6 +1,7 @@
 import pkg_resources
 import lxml.etree as ET
 
+import functools
 import json
 import traceback
 from typing import Callable, Any, Optional, TypeVar, Type
@@ -8,12 +9,13 @@ from typing import Callable, Any, Optional, TypeVar, Type
 import pydantic
 
 import guardrails as gr
+from guardrails.rail import Rail
 from autopr.models.rail_objects import RailObject
 from autopr.models.prompt_rails import PromptRail
 
 import structlog
 
-from autopr.repos.completions_repo import CompletionsRepo
+from autopr.repos.completions_repo import CompletionsRepo, ModelRouter
 from autopr.services.publish_service import PublishService
 from guardrails.utils.constants import constants
 
@@ -23,6 +25,13 @@ RailObjectSubclass = TypeVar('RailObjectSubclass', bound=RailObject)
 BaseModelSubclass = TypeVar('BaseModelSubclass', bound=pydantic.BaseModel)
 
 
+@functools.lru_cache(maxsize=128)
+def _compile_rail(rail_spec: str) -> Rail:
+    # Most rail specs are static (e.g., `RailObject.get_rail_spec()`), so parse each only once;
+    # make sure to import custom validators before compiling
+    return Rail.from_string(rail_spec)
+
+
 class RailService:
     """
     Service for invoking guardrails according to PromptRail and RailObject subclasses.
@@ -74,6 +83,8 @@ class RailService:
         Temperature to use for guardrails calls
     raw_system_prompt: str
         System prompt to use for ordinary LLM calls (if `PromptRail.two_step` is True)
+    model_router: ModelRouter, optional
+        Routes rails to the completions repos of other models (by default, all rails use `completions_repo`)
     """
 
     _constants_imported = False
@@ -87,8 +98,10 @@ class RailService:
         num_reasks: int = 2,
         temperature: float = 0.8,
         raw_system_prompt: str = 'You are a software developer and git nerd, a helpful planning and coding assistant.',
+        model_router: Optional[ModelRouter] = None,
     ):
         self.completions_repo = completions_repo
+        self.model_router = model_router or ModelRouter(completions_repo)
         self.publish_service = publish_service
         self.min_tokens = min_tokens
         self.context_limit = context_limit
@@ -131,6 +144,15 @@ class RailService:
         """
         Run a guardrails call with the given rail spec and prompt parameters.
         """
+        with self.completions_repo.usage_tracker.stage(heading):
+            return self._run_rail_string(rail_spec, prompt_params, heading)
+
+    def _run_rail_string(
+        self,
+        rail_spec: str,
+        prompt_params: dict[str, Any],
+        heading: str,
+    ) -> Optional[dict[str, Any]]:
         title_heading = heading[0].upper() + heading[1:]
         self.publish_service.start_section(f"🛤 Running {heading} rail")
 
@@ -149,18 +171,17 @@ class RailService:
             language='xml',  # xml for nice guardrails highlighting
         )
 
+        completions_repo = self.model_router.get_completions_repo(heading)
+
         def completion_func(prompt: str, instructions: str):
-            return self.completions_repo.complete(
+            return completions_repo.complete(
                 prompt=prompt,
                 system_prompt=instructions,
                 temperature=self.temperature,
             )
 
         try:
-            pr_guard = gr.Guard.from_rail_string(
-                rail_spec,  # make sure to import custom validators before this
-                num_reasks=self.num_reasks,
-            )
+            pr_guard = self.get_guard(rail_spec, num_reasks=self.num_reasks)
 
             log.debug(
                 'Running rail',
@@ -212,24 +233,40 @@ class RailService:
         self,
         model: Type[BaseModelSubclass],
         rail_spec: str,
-        prompt_params: dict[str, Any]
+        prompt_params: dict[str, Any],
+        max_tokens: Optional[int] = None,
+        completions_repo: Optional[CompletionsRepo] = None,
     ) -> Optional[BaseModelSubclass]:
         """
         Run a guardrails call with a pydantic model to parse the response into.
+        Responses are limited to `max_tokens` tokens, if given.
+        The call runs on `completions_repo`, if given, or else on the model routed for `model`.
         """
+        with self.completions_repo.usage_tracker.stage(model.__name__):
+            return self._run_rail_model(model, rail_spec, prompt_params, max_tokens, completions_repo)
+
+    def _run_rail_model(
+        self,
+        model: Type[BaseModelSubclass],
+        rail_spec: str,
+        prompt_params: dict[str, Any],
+        max_tokens: Optional[int],
+        completions_repo: Optional[CompletionsRepo],
+    ) -> Optional[BaseModelSubclass]:
         self.publish_service.start_section(f"🛤 Running {model.__name__} on rail")
 
+        if completions_repo is None:
+            completions_repo = self._get_rail_model_completions_repo(model)
+
         def completion_func(prompt: str, instructions: str):
-            return self.completions_repo.complete(
+            return completions_repo.complete(
                 prompt=prompt,
                 system_prompt=instructions,
                 temperature=self.temperature,
+                max_tokens=max_tokens,
             )
 
-        pr_guard = gr.Guard.from_rail_string(
-            rail_spec,  # make sure to import custom validators before this
-            num_reasks=self.num_reasks,
-        )
+        pr_guard = self.get_guard(rail_spec, num_reasks=self.num_reasks)
 
         prompt = self.get_rail_message(rail_spec, prompt_params)
         log.debug('Running rail',
@@ -311,18 +348,43 @@ class RailService:
     def run_rail_object(
         self,
         rail_object: Type[RailObjectSubclass],
-        raw_document: str
+        raw_document: str,
+        extraction: bool = False,
     ) -> Optional[RailObjectSubclass]:
         """
         Transforms the `raw_document` into a pydantic instance described by `rail_object`.
+        Set `extraction` if the document is an earlier response to extract JSON from,
+        to fall back to the model routed for the `guardrails` stage.
         """
         rail_spec = rail_object.get_rail_spec()
+        if extraction:
+            completions_repo = self._get_rail_model_completions_repo(rail_object, 'guardrails')
+        else:
+            completions_repo = self._get_rail_model_completions_repo(rail_object)
+        # The JSON restates the document, with room for keys and escaping
+        max_tokens = completions_repo.get_estimated_max_tokens(
+            2 * completions_repo.tokenizer.count_tokens(raw_document) + 500,
+        )
         return self.run_rail_model(
             model=rail_object,
             rail_spec=rail_spec,
             prompt_params={
                 'raw_document': raw_document,
             },
+            max_tokens=max_tokens,
+            completions_repo=completions_repo,
+        )
+
+    def _get_rail_model_completions_repo(
+        self,
+        model: Type[pydantic.BaseModel],
+        *fallback_stage_names: str,
+    ) -> CompletionsRepo:
+        # Route by the output type, then by the prompt rail that's asking for it, then by the fallbacks
+        return self.model_router.get_completions_repo(
+            model.__name__,
+            self.completions_repo.usage_tracker.current_stage,
+            *fallback_stage_names,
         )
 
     def run_prompt_rail(
@@ -335,9 +397,25 @@ class RailService:
         :param rail:
         :return:
         """
-        # Make sure the prompt is not too long
-        max_length = self.context_limit - self.min_tokens
-        success = rail.ensure_token_length(max_length)
+        with self.completions_repo.usage_tracker.stage(rail.__class__.__name__):
+            return self._run_prompt_rail(rail)
+
+    def _run_prompt_rail(
+        self,
+        rail: PromptRail
+    ) -> Optional[RailObject]:
+        completions_repo = self.model_router.get_completions_repo(rail.__class__.__name__)
+
+        # Make sure the prompt is not too long (routed models have their own context limit)
+        context_limit = completions_repo.context_limit
+        if completions_repo is self.completions_repo:
+            context_limit = min(context_limit, self.context_limit)
+        success = completions_repo.ensure_prompt_length(
+            rail,
+            system_prompt=self.raw_system_prompt,
+            min_tokens=max(self.min_tokens, completions_repo.min_tokens),
+            context_limit=context_limit,
+        )
         if not success:
             return None
 
@@ -352,30 +430,62 @@ class RailService:
                 code=prompt,
                 language="",
             )
-            prompt = self.completions_repo.complete(
-                prompt=initial_prompt,
-                system_prompt=self.raw_system_prompt,
-            )
+            try:
+                prompt = completions_repo.complete(
+                    prompt=initial_prompt,
+                    system_prompt=self.raw_system_prompt,
+                    max_tokens=completions_repo.get_estimated_max_tokens(
+                        rail.estimate_max_tokens(completions_repo.tokenizer),
+                    ),
+                )
+            except ValueError:
+                # The prompt couldn't be trimmed enough to leave room for the completion
+                log.exception('Prompt too long', rail=rail.__class__.__name__)
+                self.publish_service.end_section(f"💥 {rail.__class__.__name__} derailed (prompt too long)")
+                return None
             self.publish_service.publish_code_block(
                 heading="Response",
                 code=prompt,
                 language="",
             )
             self.publish_service.end_section(f"💬 Asked for {rail.__class__.__name__}")
-        return self.run_rail_object(rail.output_type, prompt)
+        return self.run_rail_object(rail.output_type, prompt, extraction=rail.two_step)
+
+    async def arun_prompt_rail(
+        self,
+        rail: PromptRail
+    ) -> Optional[RailObject]:
+        """
+        Like `run_prompt_rail`, but awaitable, so that independent rails can run concurrently.
+        Shares its concurrency limit with `CompletionsRepo.acomplete`.
+        """
+        return await self.completions_repo.run_concurrently(self.run_prompt_rail, rail)
 
     @staticmethod
+    def get_guard(
+        rail_spec: str,
+        num_reasks: int = 1,
+    ) -> gr.Guard:
+        """
+        Get a guard for the rail spec, compiling the spec only the first time it's seen.
+        Each call gets its own guard, as guards keep the history of their calls.
+        """
+        return gr.Guard(_compile_rail(rail_spec), num_reasks=num_reasks)
+
+    @classmethod
     def get_rail_instructions(
+        cls,
         rail_spec: str,
         prompt_params: dict[str, Any]
     ) -> str:
-        pr_guard = gr.Guard.from_rail_string(rail_spec)
+        pr_guard = cls.get_guard(rail_spec)
         return str(pr_guard.instructions.format(**prompt_params))
 
-    @staticmethod
+    @classmethod
     def get_rail_message(
+        cls,
         rail_spec: str,
         prompt_params: dict[str, Any]
     ) -> str:
-        pr_guard = gr.Guard.from_rail_string(rail_spec)
+        pr_guard = cls.get_guard(rail_spec)
         return str(pr_guard.prompt.format(**prompt_params))
@@ -0,0 +1,48 @@
+"""
+Helpers shared by the tests and the benchmarks.
+"""
+import random
+import re
+
+from autopr.utils.tokenizer import Tokenizer
+
+
+class RegexTokenizer(Tokenizer):
+    """
+    Stand-in for the GPT-2 tokenizer, pre-tokenizing with a similar regex.
+    Like BPE, token lengths are not additive across joined lines.
+    """
+    id = 'regex'
+    pattern = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\w+| ?[^\s\w]+|\s+(?!\S)|\s+""")
+
+    def encode(self, text: str) -> list[int]:
+        return [len(token) for token in self.pattern.findall(text)]
+
+
+def quadratic_chunk_file_content(content: str, tokenizer: Tokenizer, file_chunk_size: int) -> list[list[tuple[int, str]]]:
+    # The original implementation, re-encoding the growing chunk after every line
+    chunks: list[list[tuple[int, str]]] = []
+    line_buffer = []
+    for i, line in enumerate(content.splitlines()):
+        line_buffer.append((i, line))
+        token_length = tokenizer.count_tokens(
+            '\n'.join([l[1] for l in line_buffer])
+        )
+        if token_length >= file_chunk_size:
+            chunks.append(line_buffer)
+            line_buffer = []
+    if line_buffer:
+        chunks.append(line_buffer)
+    return chunks
+
+
+def random_file_content(rng: random.Random, num_lines: int) -> str:
+    words = ['def', 'foo', 'return', '(', ')', ':', 'x', '+=', '1', '"bar"', "isn't", '#', '']
+    lines = []
+    for _ in range(num_lines):
+        indent = ' ' * rng.choice([0, 0, 2, 4, 8])
+        line = indent + ' '.join(rng.choice(words) for _ in range(rng.randint(0, 12)))
+        if rng.random() < 0.1:
+            line += '   '
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,123 @@
+import io
+import itertools
+import json
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+from autopr.services.publish_service import GitHubPublishService
+from autopr.utils.cassette import Cassette
+
+
+def test_replays_recorded_requests(tmp_path, monkeypatch):
+    cassette_path = str(tmp_path / 'cassette.jsonl')
+
+    num_sent = 0
+
+    def fake_send(adapter, request, *args, **kwargs):
+        nonlocal num_sent
+        num_sent += 1
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response.raw = io.BytesIO(json.dumps([{'number': num_sent, 'node_id': 'node1'}]).encode())
+        response.request = request
+        response.url = request.url
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', fake_send)
+
+    publish_service = GitHubPublishService(
+        token='my_token',
+        run_id='123',
+        owner='user',
+        repo_name='repo',
+        head_branch='branch1',
+        base_branch='branch2',
+        issue=None,
+        pull_request_number=None,
+        loading_gif_url="https://media.giphy.com/media/3oEjI6SIIHBdRxXI40/giphy.gif",
+        overwrite_existing=False,
+    )
+    with Cassette(cassette_path, 'record'):
+        recorded_prs = [publish_service._find_existing_pr() for _ in range(2)]
+        requests.post('https://api.openai.com/v1/chat/completions', json={'prompt': 'hello'})
+    assert [pr['number'] for pr in recorded_prs] == [1, 2]  # type: ignore
+    with open(cassette_path) as f:
+        assert 'my_token' not in f.read()
+
+    def failing_send(adapter, request, *args, **kwargs):
+        raise AssertionError("Replayed requests should not be sent")
+
+    monkeypatch.setattr(HTTPAdapter, 'send', failing_send)
+    with Cassette(cassette_path, 'replay'):
+        assert [publish_service._find_existing_pr() for _ in range(2)] == recorded_prs
+        with pytest.raises(RuntimeError):
+            requests.post('https://api.openai.com/v1/chat/completions', json={'prompt': 'goodbye'})
+
+
+def test_replays_github_writes_regardless_of_their_body(tmp_path, monkeypatch):
+    cassette_path = str(tmp_path / 'cassette.jsonl')
+    url = 'https://api.github.com/repos/user/repo/pulls/1'
+
+    def fake_send(adapter, request, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response.raw = io.BytesIO(request.body)
+        response.request = request
+        response.url = request.url
+        return response
+
+    monkeypatch.setattr(HTTPAdapter, 'send', fake_send)
+    with Cassette(cassette_path, 'record'):
+        requests.patch(url, json={'body': 'Latency: 1.2s'})
+        requests.patch(url, json={'body': 'Latency: 3.4s'})
+
+    def failing_send(adapter, request, *args, **kwargs):
+        raise AssertionError("Replayed requests should not be sent")
+
+    monkeypatch.setattr(HTTPAdapter, 'send', failing_send)
+    with Cassette(cassette_path, 'replay'):
+        # Published bodies differ between runs, and may be published more often than when recording
+        assert requests.patch(url, json={'body': 'Latency: 5.6s'}).json() == {'body': 'Latency: 1.2s'}
+        assert requests.patch(url, json={'body': 'Latency: 7.8s'}).json() == {'body': 'Latency: 3.4s'}
+        assert requests.patch(url, json={'body': 'Latency: 9.0s'}).json() == {'body': 'Latency: 3.4s'}
+
+
+def test_records_streamed_responses_as_far_as_they_are_read(tmp_path, monkeypatch):
+    cassette_path = str(tmp_path / 'cassette.jsonl')
+    url = 'https://api.openai.com/v1/chat/completions'
+    body = b''.join(f'data: {{"token": {i}}}\n\n'.encode() for i in range(1000))
+
+    def fake_send(adapter, request, *args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'text/event-stream'
+        response.raw = HTTPResponse(body=io.BytesIO(body), preload_content=False)
+        response.request = request
+        response.url = request.url
+        return response
+
+    def read_lines(num_lines: int) -> list[bytes]:
+        response = requests.post(url, json={'stream': True}, stream=True)
+        lines = [line for line in itertools.islice(response.iter_lines(), num_lines)]
+        response.close()
+        return lines
+
+    monkeypatch.setattr(HTTPAdapter, 'send', fake_send)
+    with Cassette(cassette_path, 'record'):
+        recorded_lines = read_lines(3)
+    assert recorded_lines == [b'data: {"token": 0}', b'', b'data: {"token": 1}']
+    with open(cassette_path) as f:
+        recorded_text = json.loads(f.read())['response']['text']
+    assert body.decode().startswith(recorded_text) and len(recorded_text) < len(body)
+
+    def failing_send(adapter, request, *args, **kwargs):
+        raise AssertionError("Replayed requests should not be sent")
+
+    monkeypatch.setattr(HTTPAdapter, 'send', failing_send)
+    with Cassette(cassette_path, 'replay'):
+        assert read_lines(3) == recorded_lines
@@ -0,0 +1,414 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from autopr.actions.base import ContextDict
+from autopr.actions.edit_file import RewriteCodeHunkChain
+from autopr.actions.look_at_files import InitialFileSelect, InitialFileSelectResponse
+from autopr.actions.utils.file import ContextCodeHunk, GeneratedFileHunk, GeneratedHunkOutputParser
+from autopr.repos.completions_repo import get_completions_repo, SyntheticCompletionsRepo, CompletionsRepo, ModelRouter
+from autopr.services.action_service import ActionService
+from autopr.services.chain_service import ChainService
+from autopr.services.publish_service import DummyPublishService, UpdateSection
+from autopr.services.rail_service import RailService
+from autopr.tests.helpers import RegexTokenizer
+from autopr.utils.repo import FileDescriptor
+from autopr.utils.response_cache import ResponseCache
+
+
+def get_synthetic_completions_repo(**kwargs) -> SyntheticCompletionsRepo:
+    completions_repo = get_completions_repo(
+        publish_service=DummyPublishService(),
+        model='synthetic',
+        **kwargs,
+    )
+    assert isinstance(completions_repo, SyntheticCompletionsRepo)
+    completions_repo.tokenizer = RegexTokenizer()
+    return completions_repo
+
+
+def test_synthetic_responses_parse():
+    completions_repo = get_synthetic_completions_repo(latency=0, tokens_per_second=float('inf'))
+    publish_service = completions_repo.publish_service
+    rail_service = RailService(completions_repo=completions_repo, publish_service=publish_service)
+    chain_service = ChainService(completions_repo=completions_repo, publish_service=publish_service)
+
+    file_select = InitialFileSelect(
+        context=ContextDict(issue='Fix the bug'),
+        file_descriptors=[FileDescriptor.from_text('src/app.py', 'x = 1', 3, [1])],
+        token_limit=5000,
+    )
+    response = rail_service.run_prompt_rail(file_select)
+    assert isinstance(response, InitialFileSelectResponse)
+    assert set(response.filepaths) <= {'src/app.py'}
+    assert rail_service.run_prompt_rail(file_select) == response
+
+    # Choices name the chosen case, and fill in its fields
+    action_service = ActionService(
+        repo=None,  # type: ignore
+        completions_repo=completions_repo,
+        publish_service=publish_service,
+        rail_service=rail_service,
+        chain_service=chain_service,
+    )
+    rail_spec = action_service._write_action_selection_rail_spec(['new_file', 'edit_file'], include_finished=True)
+    dict_o = rail_service.run_rail_string(rail_spec, {'context': 'Fix the bug'}, heading='action selection')
+    assert dict_o is not None
+    assert dict_o['action'] in ['new_file', 'edit_file', 'finished']
+    assert set(dict_o) == {'action', dict_o['action']}
+
+    hunk = chain_service.run_chain(RewriteCodeHunkChain(
+        context=ContextDict(issue='Fix the bug'),
+        context_hunks=[],
+        hunk_contents=ContextCodeHunk(code_hunk=[(1, 'x = 1')]),
+        plan='Fix it',
+    ))
+    assert isinstance(hunk, GeneratedFileHunk)
+    assert hunk.contents
+
+
+def test_synthetic_latency(monkeypatch):
+    completions_repo = get_synthetic_completions_repo(latency=0.1, tokens_per_second=10)
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    response = completions_repo.complete('Hello')
+    assert sum(sleeps) == pytest.approx(0.1 + len(response.split()) / 10)
+
+
+class ConcurrencyRecordingRepo(SyntheticCompletionsRepo):
+    models = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, latency=0, tokens_per_second=float('inf'), **kwargs)
+        self.num_running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+        # Completions wait for each other, so that as many run at once as are allowed to
+        self._barrier = threading.Barrier(self.max_concurrency, timeout=5)
+
+    def _complete(self, **kwargs):
+        with self._lock:
+            self.num_running += 1
+            self.max_running = max(self.max_running, self.num_running)
+        try:
+            self._barrier.wait()
+            return super()._complete(**kwargs)
+        finally:
+            with self._lock:
+                self.num_running -= 1
+
+
+def test_concurrent_completions_are_bounded():
+    completions_repo = ConcurrencyRecordingRepo(
+        publish_service=DummyPublishService(), model='synthetic', max_concurrency=2,
+    )
+    completions_repo.tokenizer = RegexTokenizer()
+
+    async def complete_all():
+        return await asyncio.gather(*[
+            completions_repo.acomplete(f'Prompt {i}') for i in range(4)
+        ])
+
+    responses = asyncio.run(complete_all())
+    assert completions_repo.max_running == 2
+    assert responses == [completions_repo._synthesize(f'Prompt {i}', completions_repo.default_system_prompt)
+                         for i in range(4)]
+
+
+def test_concurrent_rails_publish_separate_sections():
+    completions_repo = get_synthetic_completions_repo(latency=0.05, tokens_per_second=float('inf'))
+    publish_service = completions_repo.publish_service
+    rail_service = RailService(completions_repo=completions_repo, publish_service=publish_service)
+
+    async def run_rails():
+        return await asyncio.gather(*[
+            rail_service.arun_prompt_rail(InitialFileSelect(
+                context=ContextDict(issue=f'Fix bug {i}'),
+                file_descriptors=[],
+                token_limit=5000,
+            ))
+            for i in range(3)
+        ])
+
+    publish_service.start_section('Selecting files')
+    responses = asyncio.run(run_rails())
+    publish_service.end_section()
+    assert all(isinstance(response, InitialFileSelectResponse) for response in responses)
+
+    # Each rail's sections are nested under the section that was current when it started
+    assert publish_service.sections_stack == [publish_service.root_section]
+    [parent_section] = publish_service.root_section.updates
+    assert isinstance(parent_section, UpdateSection)
+    assert len(parent_section.updates) == 6  # An ask section and a rail section per rail
+    assert all(isinstance(section, UpdateSection) and section.level == 2 for section in parent_section.updates)
+
+
+def test_usage_is_recorded_by_stage(tmp_path):
+    completions_repo = get_synthetic_completions_repo(
+        latency=0, tokens_per_second=float('inf'),
+        response_cache=ResponseCache(str(tmp_path), policy='always'),
+    )
+    publish_service = completions_repo.publish_service
+    rail_service = RailService(completions_repo=completions_repo, publish_service=publish_service)
+    file_select = InitialFileSelect(
+        context=ContextDict(issue='Fix the bug'),
+        file_descriptors=[FileDescriptor.from_text('src/app.py', 'x = 1', 3, [1])],
+        token_limit=5000,
+    )
+    rail_service.run_prompt_rail(file_select)
+    rail_service.run_prompt_rail(file_select)
+    completions_repo.complete('Hello')
+
+    # The two-step rail's calls are all attributed to the rail
+    records = completions_repo.usage_tracker.records
+    assert [(usage.stage, usage.cache_hit) for usage in records] == [
+        ('InitialFileSelect', False), ('InitialFileSelect', False),
+        ('InitialFileSelect', True), ('InitialFileSelect', True),
+        ('other', False),
+    ]
+    assert all(usage.prompt_tokens and usage.completion_tokens for usage in records if not usage.cache_hit)
+
+    summary = completions_repo.usage_tracker.summarize()
+    assert summary['InitialFileSelect']['calls'] == 4
+    assert summary['InitialFileSelect']['cache_hits'] == 2
+    assert summary['InitialFileSelect']['prompt_tokens'] == records[0].prompt_tokens + records[1].prompt_tokens
+
+    table = completions_repo.usage_tracker.to_markdown().splitlines()
+    assert len(table) == 5
+    assert table[2].startswith('| InitialFileSelect | 4 | 2 |')
+    assert table[4].startswith('| **Total** | 5 | 2 |')
+
+
+def test_generated_hunk_output_stream_stops_after_outcome():
+    parser = GeneratedHunkOutputParser()
+    response = 'Here is the rewritten hunk:\n' \
+               '```\n' \
+               'Usage:\n' \
+               '```\n' \
+               'make test\n' \
+               '```\n' \
+               '```\n' \
+               '{\n' \
+               '    "outcome": "Documented {braces} and \\"quotes\\""\n' \
+               '}'
+    output_stream = parser.get_output_stream()
+    statuses = [output_stream.feed(response[i:i + 3]) for i in range(0, len(response), 3)]
+    assert statuses[-1] == 'complete'
+    assert output_stream.feed('\nI hope this helps!') == 'complete'
+    assert output_stream.text == response
+    assert parser.parse(output_stream.text) == GeneratedFileHunk(
+        contents='Usage:\n```\nmake test\n```',
+        outcome='Documented {braces} and "quotes"',
+    )
+
+    # Fenced JSON in the code doesn't end the response, nor does any number of lines before the code
+    response = 'Let me think about this.\n' * 30 + \
+               '```\n' \
+               '# Title\n' \
+               '```json\n' \
+               '{"a": 1}\n' \
+               '```\n' \
+               'more text\n' \
+               '```\n' \
+               '{"outcome": "ok"}'
+    output_stream = parser.get_output_stream()
+    statuses = [output_stream.feed(char) for char in response]
+    assert statuses[-1] == 'complete' and statuses.count('complete') == 1
+    assert parser.parse(output_stream.text) == GeneratedFileHunk(
+        contents='# Title\n```json\n{"a": 1}\n```\nmore text',
+        outcome='ok',
+    )
+
+
+class RamblingCompletionsRepo(CompletionsRepo):
+    models = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_chunks = 0
+        self.closed = False
+        self.system_prompts = []
+
+    def _stream(self, system_prompt: str, **kwargs):
+        self.system_prompts.append(system_prompt)
+        try:
+            for chunk in ['```\nx = 1\n', '```\n{"outcome": ', '"Done"}', '\n\nLet me also explain']:
+                self.num_chunks += 1
+                yield chunk
+            while True:
+                self.num_chunks += 1
+                yield ' and explain'
+        finally:
+            self.closed = True
+
+
+def test_streamed_completion_stops_when_output_is_complete():
+    completions_repo = RamblingCompletionsRepo(publish_service=DummyPublishService(), model='synthetic')
+    completions_repo.tokenizer = RegexTokenizer()
+    chain_service = ChainService(completions_repo=completions_repo, publish_service=completions_repo.publish_service)
+    hunk = chain_service.run_chain(RewriteCodeHunkChain(
+        context=ContextDict(issue='Fix the bug'),
+        context_hunks=[],
+        hunk_contents=ContextCodeHunk(code_hunk=[(1, 'x = 0')]),
+        plan='Fix it',
+    ))
+    assert hunk == GeneratedFileHunk(contents='x = 1', outcome='Done')
+    assert completions_repo.num_chunks == 3
+    assert completions_repo.closed
+
+    # Streamed chains are sent like langchain sends them, as a single message without a system prompt
+    assert completions_repo.system_prompts == ['']
+    assert completions_repo.get_messages('Hello', '', []) == [{'role': 'user', 'content': 'Hello'}]
+
+
+class MaxTokensRecordingRepo(SyntheticCompletionsRepo):
+    models = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, latency=0, tokens_per_second=float('inf'), **kwargs)
+        self.max_tokens_used = []
+
+    def _stream(self, max_tokens: int, **kwargs):
+        self.max_tokens_used.append(max_tokens)
+        return super()._stream(max_tokens=max_tokens, **kwargs)
+
+
+def test_max_tokens_account_for_the_whole_chat():
+    completions_repo = MaxTokensRecordingRepo(
+        publish_service=DummyPublishService(), model='synthetic',
+        max_tokens=2000, min_tokens=1000, context_limit=4000,
+    )
+    completions_repo.tokenizer = tokenizer = RegexTokenizer()
+    examples = [('What is 1 + 1?', '2')]
+    prompt_tokens = completions_repo.count_prompt_tokens('Hello', 'Be helpful.', examples)
+    assert prompt_tokens == 3 + sum(
+        3 + tokenizer.count_tokens(role) + tokenizer.count_tokens(content)
+        for role, content in [
+            ('system', 'Be helpful.'), ('user', 'What is 1 + 1?'), ('assistant', '2'), ('user', 'Hello'),
+        ]
+    )
+
+    # The completion gets what's left of the context, if it's at least `min_tokens`, or as much as requested
+    assert completions_repo.get_max_tokens(1000) == 2000
+    assert completions_repo.get_max_tokens(2500) == 1500
+    assert completions_repo.get_max_tokens(1000, max_tokens=300) == 300
+    assert completions_repo.get_max_tokens(3600, max_tokens=300) == 300
+    with pytest.raises(ValueError):
+        completions_repo.get_max_tokens(3500)
+
+    # Rewriting a hunk asks for as many tokens as the rewritten hunk is estimated to need, but at least `min_tokens`
+    chain_service = ChainService(completions_repo=completions_repo, publish_service=completions_repo.publish_service)
+    chain = RewriteCodeHunkChain(
+        context=ContextDict(issue='Fix the bug'),
+        context_hunks=[],
+        hunk_contents=ContextCodeHunk(code_hunk=[(1, 'x = 0')]),
+        plan='Fix it',
+    )
+    assert chain_service.run_chain(chain) is not None
+    assert completions_repo.max_tokens_used == [1000]
+    assert completions_repo.get_estimated_max_tokens(1200) == 1200
+    assert completions_repo.get_estimated_max_tokens(3000) == 2000
+
+
+def test_stages_are_routed_to_their_models():
+    completions_repo = get_synthetic_completions_repo(latency=0, tokens_per_second=float('inf'))
+    routed_completions_repo = get_synthetic_completions_repo(
+        latency=0, tokens_per_second=float('inf'), usage_tracker=completions_repo.usage_tracker,
+    )
+    routed_prompts = []
+    complete = routed_completions_repo._complete
+
+    def record_routed_complete(prompt: str, **kwargs):
+        routed_prompts.append(prompt)
+        return complete(prompt=prompt, **kwargs)
+
+    routed_completions_repo._complete = record_routed_complete  # type: ignore
+    model_router = ModelRouter(completions_repo, {'guardrails': routed_completions_repo})
+    publish_service = completions_repo.publish_service
+    rail_service = RailService(
+        completions_repo=completions_repo, publish_service=publish_service, model_router=model_router,
+    )
+
+    # Only the JSON extraction step runs on the routed model
+    response = rail_service.run_prompt_rail(InitialFileSelect(
+        context=ContextDict(issue='Fix the bug'),
+        file_descriptors=[FileDescriptor.from_text('src/app.py', 'x = 1', 3, [1])],
+        token_limit=5000,
+    ))
+    assert isinstance(response, InitialFileSelectResponse)
+    assert len(completions_repo.usage_tracker.records) == 2
+    assert len(routed_prompts) == 1
+    assert '<output>' in routed_prompts[0]
+
+    # Single-step rails aren't extracting JSON from an earlier response, so they run on the default model
+    class SingleStepFileSelect(InitialFileSelect):
+        two_step = False
+
+    rail_service.run_prompt_rail(SingleStepFileSelect(
+        context=ContextDict(issue='Fix the bug'),
+        file_descriptors=[],
+        token_limit=5000,
+    ))
+    assert len(completions_repo.usage_tracker.records) == 3
+    assert len(routed_prompts) == 1
+
+    # More specific routes take precedence
+    model_router.routes['InitialFileSelect'] = completions_repo
+    rail_service.run_prompt_rail(InitialFileSelect(
+        context=ContextDict(issue='Fix another bug'),
+        file_descriptors=[],
+        token_limit=5000,
+    ))
+    assert len(routed_prompts) == 1
+
+
+def test_trimmed_prompts_leave_min_tokens_for_the_completion():
+    completions_repo = get_synthetic_completions_repo(
+        latency=0, tokens_per_second=float('inf'), min_tokens=1000, context_limit=4000,
+    )
+    publish_service = completions_repo.publish_service
+    rail_service = RailService(
+        completions_repo=completions_repo, publish_service=publish_service, min_tokens=1000, context_limit=4000,
+    )
+
+    # Trimming counts the system prompt and chat overhead, so the two-step rail's completion isn't refused
+    file_select = InitialFileSelect(
+        context=ContextDict(issue='Fix the bug'),
+        file_descriptors=[
+            FileDescriptor.from_text(f'src/module_{i}.py', 'x = 1', 3, [1])
+            for i in range(2000)
+        ],
+        token_limit=5000,
+    )
+    assert isinstance(rail_service.run_prompt_rail(file_select), InitialFileSelectResponse)
+    assert 0 < len(file_select.file_descriptors) < 2000
+    prompt_tokens = completions_repo.count_prompt_tokens(
+        file_select.get_prompt_message(), rail_service.raw_system_prompt, [],
+    )
+    assert prompt_tokens + 1000 <= 4000
+
+
+def test_prompts_without_room_for_the_completion_fail_their_rail_or_chain():
+    completions_repo = get_synthetic_completions_repo(
+        latency=0, tokens_per_second=float('inf'), min_tokens=1000, context_limit=1100,
+    )
+    publish_service = completions_repo.publish_service
+    rail_service = RailService(completions_repo=completions_repo, publish_service=publish_service)
+    chain_service = ChainService(completions_repo=completions_repo, publish_service=publish_service)
+
+    # Prompts that couldn't be trimmed enough fail like other derailed rails and chains, instead of raising
+    completions_repo.ensure_prompt_length = lambda *args, **kwargs: True  # type: ignore
+    assert rail_service.run_prompt_rail(InitialFileSelect(
+        context=ContextDict(issue='Fix the bug ' * 200),
+        file_descriptors=[],
+        token_limit=5000,
+    )) is None
+    assert chain_service.run_chain(RewriteCodeHunkChain(
+        context=ContextDict(issue='Fix the bug ' * 200),
+        context_hunks=[],
+        hunk_contents=ContextCodeHunk(code_hunk=[(1, 'x = 0')]),
+        plan='Fix it',
+    )) is None
+    assert not completions_repo.usage_tracker.records
@@ -0,0 +1,52 @@
+from typing import Optional
+
+from autopr.actions.base import ContextDict
+from autopr.actions.look_at_files import InspectFiles, LookAtFilesResponse, LookAtFiles, ContinueLookingAtFiles
+from autopr.models.prompt_rails import PromptRail
+from autopr.utils.repo import FileDescriptor
+
+
+class FakeRailService:
+    num_reasks = 3
+
+    def __init__(self, responses: list[LookAtFilesResponse]):
+        self.responses = responses
+        self.rails: list[PromptRail] = []
+
+    def run_prompt_rail(self, rail: PromptRail) -> Optional[LookAtFilesResponse]:
+        if isinstance(rail, LookAtFiles):
+            # Only the first half of the file fits in the first prompt
+            rail.selected_file_contents[0].end_chunk = 2
+        rail.get_prompt_message()
+        self.rails.append(rail)
+        return self.responses.pop(0)
+
+
+def test_write_notes_continues_where_it_left_off():
+    files = [
+        FileDescriptor.from_text(f'file_{i}.py', '\n'.join(['x = 1'] * 4), 0, [1] * 4)
+        for i in range(3)
+    ]
+    rail_service = FakeRailService([
+        LookAtFilesResponse(notes='first', filepaths_we_should_look_at=['file_0.py', 'file_1.py']),
+        LookAtFilesResponse(notes='second', filepaths_we_should_look_at=['file_0.py']),
+    ])
+    action = InspectFiles(
+        repo=None,  # type: ignore
+        rail_service=rail_service,  # type: ignore
+        chain_service=None,  # type: ignore
+        publish_service=None,  # type: ignore
+    )
+
+    notes = action.write_notes_about_files(files, ContextDict(), ['file_0.py'])
+
+    assert notes == 'first\nsecond'
+    assert len(rail_service.rails) == 2
+    continue_rail = rail_service.rails[1]
+    assert isinstance(continue_rail, ContinueLookingAtFiles)
+    assert [(f.path, f.start_chunk, f.end_chunk) for f in continue_rail.selected_file_contents] == \
+        [('file_0.py', 2, 4), ('file_1.py', 0, 4)]
+    assert files[0].end_chunk == 4
+
+    # Files that have been seen in full are no longer listed
+    assert 'file_1.py' not in continue_rail.get_string_params()['filepaths_with_token_lengths']
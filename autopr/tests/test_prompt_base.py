@@ -0,0 +1,95 @@
+from autopr.actions.base import ContextDict
+from autopr.actions.look_at_files import LookAtFiles
+from autopr.models.prompt_base import PromptBase
+from autopr.tests.helpers import RegexTokenizer
+from autopr.utils.repo import FileDescriptor
+import autopr.utils.tokenizer
+from autopr.repos.completions_repo import SyntheticCompletionsRepo
+from autopr.services.publish_service import DummyPublishService
+from autopr.utils.tokenizer import CharRatioTokenizer, configure_tokenizer, get_tokenizer_id
+
+
+class CountingTokenizer(RegexTokenizer):
+    def __init__(self, prompt_prefix: str):
+        self.prompt_prefix = prompt_prefix
+        self.num_prompts_counted = 0
+
+    def count_tokens(self, text: str) -> int:
+        if text.startswith(self.prompt_prefix):
+            self.num_prompts_counted += 1
+        return super().count_tokens(text)
+
+
+class ListPrompt(PromptBase):
+    prompt_template = "Prompt with items:\n\n{items}"
+
+    items: list[str]
+
+
+def test_naive_trimming_keeps_most_items():
+    tokenizer = CountingTokenizer('Prompt')
+    prompt = ListPrompt(items=[f'item number {i}' for i in range(1000)])
+    max_length = 1000
+    assert prompt.ensure_token_length(max_length, tokenizer)
+
+    # Keeps as many items as fit
+    assert prompt.calculate_prompt_token_length(tokenizer) <= max_length
+    prompt_with_another_item = ListPrompt(items=[f'item number {i}' for i in range(len(prompt.items) + 1)])
+    assert prompt_with_another_item.calculate_prompt_token_length(tokenizer) > max_length
+
+    # Bisects instead of trimming one item at a time
+    assert tokenizer.num_prompts_counted < 30
+
+
+def test_chunk_trimming_fits_in_few_passes():
+    tokenizer = CountingTokenizer(LookAtFiles.prompt_template[:10])
+    file_descriptors = [
+        FileDescriptor.from_text(
+            path=f'file_{i}.py',
+            text='\n'.join(f'x = {line_number} + y' for line_number in range(300)),
+            token_length=0,
+            chunk_line_counts=[10] * 30,
+        )
+        for i in range(5)
+    ]
+    rail = LookAtFiles(
+        context=ContextDict(issue='Fix the bug'),
+        selected_file_contents=[fd.copy() for fd in file_descriptors],
+        prospective_file_descriptors=[fd.copy() for fd in file_descriptors],
+        token_limit=5000,
+    )
+    max_length = 3000
+    assert rail.ensure_token_length(max_length, tokenizer)
+    assert rail.calculate_prompt_token_length(tokenizer) <= max_length
+    assert tokenizer.num_prompts_counted < 10
+
+    # Trims files evenly
+    assert len(rail.selected_file_contents) == 5
+    num_chunks = [fd.end_chunk - fd.start_chunk for fd in rail.selected_file_contents]
+    assert max(num_chunks) - min(num_chunks) <= 1
+
+
+def test_char_ratio_tokenizer_encodes_as_many_tokens_as_it_counts():
+    tokenizer = CharRatioTokenizer(chars_per_token=3.5)
+    for text in ['', 'a', 'abcd', 'item number 1' * 7]:
+        assert len(tokenizer.encode(text)) == tokenizer.count_tokens(text)
+    assert tokenizer.encode('abcdefgh')[0] == tokenizer.encode('abcdxyz')[0]
+
+    prompt = ListPrompt(items=[f'item number {i}' for i in range(1000)])
+    assert prompt.ensure_token_length(1000, tokenizer)
+    assert tokenizer.count_tokens(prompt.get_prompt_message()) <= 1000
+
+
+def test_configured_tokenizer_counts_for_every_model(monkeypatch):
+    monkeypatch.setattr(autopr.utils.tokenizer, '_default_tokenizer_id', 'cl100k_base')
+    monkeypatch.setattr(autopr.utils.tokenizer, '_configured_tokenizer_id', None)
+
+    configure_tokenizer('gpt-4', 'char_ratio')
+    assert get_tokenizer_id() == get_tokenizer_id('text-davinci-003') == 'char_ratio'
+    completions_repo = SyntheticCompletionsRepo(publish_service=DummyPublishService(), model='synthetic')
+    assert isinstance(completions_repo.tokenizer, CharRatioTokenizer)
+
+    # Without a configured tokenizer, each model counts with its own
+    configure_tokenizer('text-davinci-003')
+    assert get_tokenizer_id() == 'p50k_base'
+    assert get_tokenizer_id('gpt-4') == 'cl100k_base'
@@ -1,6 +1,13 @@
+import threading
+import time
 from unittest.mock import patch, Mock
 
-from autopr.services.publish_service import GitHubPublishService
+import pytest
+
+from autopr.agents.base import Agent
+from autopr.services.agent_service import AgentService
+from autopr.services.publish_service import GitHubPublishService, DummyPublishService, UpdateSection
+from autopr.utils.usage import UsageTracker
 
 
 @patch('requests.get')
@@ -56,3 +63,307 @@ def test_github_publish_service(mock_patch, mock_post, mock_get):
     # Test _publish_comment
     comment_id = service._publish_comment('new comment', 1)
     assert comment_id == 'comment1'
+
+
+class RecordingPublishService(DummyPublishService):
+    def __init__(self, publish_interval: float = 0):
+        super().__init__()
+        self.publish_interval = publish_interval
+        self.published_bodies = []
+        # Publishes wait until this is set, and set `publishing` while they wait
+        self.publish_allowed = threading.Event()
+        self.publish_allowed.set()
+        self.publishing = threading.Event()
+
+    def _publish_progress(self, bodies: list[str], success: bool = False):
+        self.publishing.set()
+        assert self.publish_allowed.wait(timeout=5)
+        self.published_bodies.append(bodies)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.services: list[RecordingPublishService] = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        # Wake up the publishers waiting for their interval to be up
+        self.now += seconds
+        for service in self.services:
+            with service._publish_condition:
+                service._publish_condition.notify_all()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def wait_for_completed_publishes(service: RecordingPublishService, num_publishes: int):
+    with service._publish_condition:
+        assert service._publish_condition.wait_for(
+            lambda: service._completed_publishes >= num_publishes,
+            timeout=5,
+        )
+
+
+def wait_for_publishes(service: RecordingPublishService):
+    # Wait for the background publisher to publish everything that's due
+    with service._publish_condition:
+        service._publish_condition.wait_for(
+            lambda: service._completed_publishes >= service._requested_publishes or (
+                not service._force_publish
+                and service._last_published_at + service.publish_interval > time.monotonic()
+            ),
+            timeout=5,
+        )
+
+
+def test_updates_are_debounced(clock):
+    service = RecordingPublishService(publish_interval=0.5)
+    clock.services.append(service)
+    service.start_section('Section')
+    # The first update is published right away
+    wait_for_publishes(service)
+    assert len(service.published_bodies) == 1
+
+    # The rest are published together once the interval is up
+    for i in range(5):
+        service.publish_update(f'Update {i}')
+    clock.advance(0.4)
+    wait_for_publishes(service)
+    assert len(service.published_bodies) == 1
+    clock.advance(0.1)
+    wait_for_publishes(service)
+    assert len(service.published_bodies) == 2
+    assert 'Update 4' in service.published_bodies[-1][-1]
+
+    # Finalizing publishes right away
+    service.end_section()
+    service.finalize(success=True)
+    assert len(service.published_bodies) == 3
+    clock.advance(0.6)
+    wait_for_publishes(service)
+    assert len(service.published_bodies) == 3
+
+
+def test_updates_are_published_in_the_background():
+    service = RecordingPublishService()
+    service.publish_allowed.clear()
+    service.start_section('Section')
+    assert service.publishing.wait(timeout=5)
+
+    # Updates don't wait for the publish in flight
+    for i in range(5):
+        service.publish_update(f'Update {i}')
+    assert service.published_bodies == []
+
+    # Only the latest state is published once it's done
+    service.publish_allowed.set()
+    service.flush()
+    assert len(service.published_bodies) == 2
+    assert 'Update 4' in service.published_bodies[-1][-1]
+
+    service.end_section()
+    service.finalize(success=True)
+    assert len(service.published_bodies) == 3
+
+
+def test_publish_errors_are_raised_in_the_agent_thread():
+    service = RecordingPublishService()
+    service._publish_progress = Mock(side_effect=RuntimeError("Failed to create PR"))
+    with pytest.raises(RuntimeError, match="Failed to create PR"):
+        service.flush()
+
+    # Errors of background publishes are raised on the next update
+    service.start_section('Section')
+    wait_for_completed_publishes(service, 2)
+    with pytest.raises(RuntimeError, match="Failed to create PR"):
+        service.publish_update('Update')
+
+
+class FailingAgent(Agent):
+    id = 'failing'
+
+    def handle_event(self, event):
+        # Start a section whose background publish fails, then fail
+        self.publish_service.start_section('Section')
+        wait_for_completed_publishes(self.publish_service, 2)
+        raise ValueError("Agent failed")
+
+
+def test_failed_agents_are_finalized_despite_publish_errors():
+    service = RecordingPublishService()
+    publish_progress = service._publish_progress
+
+    def fail_second_publish(bodies: list[str], success: bool = False):
+        if service._completed_publishes == 1:
+            raise RuntimeError("Failed to publish")
+        publish_progress(bodies, success)
+
+    service._publish_progress = fail_second_publish
+    usage_tracker = UsageTracker()
+    with usage_tracker.track('gpt-4'):
+        pass
+    agent_service = AgentService(
+        rail_service=Mock(completions_repo=Mock(model='gpt-4', usage_tracker=usage_tracker)),
+        chain_service=Mock(),
+        diff_service=Mock(),
+        commit_service=Mock(),
+        publish_service=service,
+        action_service=Mock(),
+        repo=Mock(),
+    )
+    agent_service.agents = {'failing': FailingAgent}
+
+    # The agent's error is raised, after finalizing the pull request
+    with pytest.raises(ValueError, match="Agent failed"):
+        agent_service.run_agent('failing', None, Mock())
+    assert len(service.published_bodies) == 2
+    assert service._final_bodies is not None and not service._final_bodies[1]
+
+
+def test_incremental_rendering_matches_full_rendering():
+    service = RecordingPublishService(publish_interval=60)
+
+    def assert_matches_full_rendering():
+        bodies = service._build_bodies()
+        sections = [service.root_section]
+        while sections:
+            section = sections.pop()
+            section._dirty = True
+            sections += [update for update in section.updates if isinstance(update, UpdateSection)]
+        assert bodies == service._build_bodies()
+
+    service.start_section('Planning')
+    service.publish_code_block('Prompt', 'prompt 1')
+    assert_matches_full_rendering()
+    service.publish_update('Thinking')
+    service.start_section('Nested')
+    service.publish_code_block('Prompt', 'prompt 2')
+    assert_matches_full_rendering()
+    service.end_section('Nested done')
+    assert_matches_full_rendering()
+    service.publish_code_block('Response', 'response 1')
+    service.end_section()
+    assert_matches_full_rendering()
+
+    service.start_section('Editing')
+    service.update_section('Editing file')
+    service.publish_update('Edited', section_title='Edited file')
+    assert_matches_full_rendering()
+    service.end_section()
+    assert_matches_full_rendering()
+
+
+def test_unchanged_sections_are_not_rerendered():
+    service = RecordingPublishService(publish_interval=60)
+    service.start_section('First')
+    service.publish_update('Done')
+    service.end_section()
+    service.start_section('Second')
+    service._build_bodies()
+
+    first_section = service.root_section.updates[0]
+    assert not first_section._dirty
+    service.publish_update('Running')
+    assert not first_section._dirty
+    assert service.root_section.updates[1]._dirty
+
+
+@patch('requests.get')
+@patch('requests.post')
+@patch('requests.patch')
+def test_unchanged_bodies_are_not_republished(mock_patch, mock_post, mock_get):
+    mock_post.return_value = Mock(status_code=201, json=lambda: {'number': 2, 'node_id': 'node2', 'id': 'comment1'})
+    mock_patch.return_value = Mock(status_code=200, json=lambda: {})
+
+    service = GitHubPublishService(
+        token='my_token',
+        run_id='123',
+        owner='user',
+        repo_name='repo',
+        head_branch='branch1',
+        base_branch='branch2',
+    )
+
+    # Creating the pull request publishes the body as a draft, and the rest as comments
+    service._publish_progress(['body1', 'body2'])
+    assert mock_post.call_count == 2
+    assert mock_patch.call_count == 0
+
+    # Only the changed comment is updated, and the draft status is left alone
+    service._publish_progress(['body1', 'body2 updated'])
+    assert mock_post.call_count == 2
+    mock_patch.assert_called_once_with(
+        'https://api.github.com/repos/user/repo/issues/comments/comment1',
+        headers=service._get_headers(),
+        json={'body': 'body2 updated'},
+    )
+    service._publish_progress(['body1', 'body2 updated'])
+    assert mock_patch.call_count == 1
+
+    # Finalizing marks it ready for review
+    service._publish_progress(['body1', 'body2 updated'], success=True)
+    assert mock_patch.call_count == 1
+    assert mock_post.call_count == 3
+    assert 'markPullRequestReadyForReview' in mock_post.call_args.kwargs['json']['query']
+
+
+def test_bodies_are_packed_within_max_comment_length():
+    service = RecordingPublishService(publish_interval=60)
+    service.max_comment_length = 2000
+    service.start_section('Big section')
+    for i in range(10):
+        service.start_section(f'Nested section {i}')
+        for j in range(10):
+            service.publish_update(f'Update {i}.{j} ' + 'x' * 50)
+        service.end_section()
+    service.end_section()
+
+    bodies = service._build_bodies()
+    assert len(bodies) > 1
+    assert all(len(body) <= service.max_comment_length for body in bodies)
+    # No more bodies are used than needed
+    assert len(bodies) <= len(''.join(bodies)) // service.max_comment_length + 2
+    # Every update is published, in order
+    published = '\n'.join(bodies)
+    positions = [published.index(f'Update {i}.{j} ') for i in range(10) for j in range(10)]
+    assert positions == sorted(positions)
+    assert 'Big section (continued)' in bodies[1]
+    # Split sections are closed at the end of each body
+    assert all(body.count('<details') == body.count('</details>') for body in bodies)
+
+
+def test_published_bodies_are_kept_stable():
+    service = RecordingPublishService(publish_interval=60)
+    service.max_comment_length = 2000
+    service.start_section('Section')
+    for i in range(60):
+        service.publish_update(f'Update {i} ' + 'x' * 50)
+    bodies = service._build_bodies()
+    assert len(bodies) > 2
+
+    # Shrinking an earlier update doesn't pull content back into the published bodies
+    service.root_section.updates[0].updates[0] = 'Update 0'
+    service._mark_dirty([service.root_section, service.root_section.updates[0]])
+    for i in range(60, 65):
+        service.publish_update(f'Update {i} ' + 'x' * 50)
+    new_bodies = service._build_bodies()
+    assert new_bodies[1:len(bodies) - 1] == bodies[1:-1]
+    assert 'Update 64' in new_bodies[-1]
+
+
+def test_oversized_code_blocks_are_truncated():
+    service = RecordingPublishService(publish_interval=60)
+    service.max_code_block_length = 100
+    service.start_section('Section')
+    service.publish_code_block('Prompt', 'x' * 150)
+    body, = service._build_bodies()
+    assert 'x' * 100 + '\n> ... (50 characters truncated)' in body
+    assert 'x' * 101 not in body
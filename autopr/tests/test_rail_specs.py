@@ -83,4 +83,31 @@ def test_mock_action_service_spec_validity(rail_spec):
 )
 def test_real_action_service_spec_validity(rail_spec):
     print(rail_spec)
-    gr.Guard.from_rail_string(rail_spec)
\ No newline at end of file
+    gr.Guard.from_rail_string(rail_spec)
+
+
+def test_rail_specs_are_compiled_once(monkeypatch):
+    from guardrails.rail import Rail
+    from autopr.actions.look_at_files import LookAtFilesResponse
+    from autopr.services.rail_service import RailService
+
+    compiled_specs = []
+    from_string = Rail.from_string
+
+    def record_from_string(rail_spec):
+        compiled_specs.append(rail_spec)
+        return from_string(rail_spec)
+
+    monkeypatch.setattr(Rail, 'from_string', record_from_string)
+    rail_spec = LookAtFilesResponse.get_rail_spec() + '\n'  # Not compiled by other tests
+    prompt_params = {'raw_document': 'Look at app.py'}
+    message = RailService.get_rail_message(rail_spec, prompt_params)
+    assert RailService.get_rail_message(rail_spec, prompt_params) == message
+    assert 'Look at app.py' in message
+    RailService.get_rail_instructions(rail_spec, prompt_params)
+
+    # Each call gets its own guard, so that their histories don't mix
+    guard = RailService.get_guard(rail_spec, num_reasks=2)
+    assert guard is not RailService.get_guard(rail_spec, num_reasks=2)
+    assert guard.num_reasks == 2
+    assert compiled_specs == [rail_spec]
@@ -0,0 +1,90 @@
+import json
+import time
+
+import pytest
+
+from autopr.repos.completions_repo import get_completions_repo
+from autopr.services.publish_service import DummyPublishService
+from autopr.tests.helpers import RegexTokenizer
+from autopr.utils.rate_limiter import RateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(time, 'time', clock.time)
+    monkeypatch.setattr(time, 'sleep', clock.sleep)
+    return clock
+
+
+def test_requests_per_minute_spreads_requests(clock):
+    rate_limiter = RateLimiter(requests_per_minute=2)
+    rate_limiter.acquire(1000)
+    rate_limiter.acquire(1000)
+    assert clock.sleeps == []
+
+    # The third request waits for the bucket to refill by one request
+    rate_limiter.acquire(1000)
+    assert clock.sleeps == [pytest.approx(30)]
+
+
+def test_tokens_per_minute_waits_for_tokens(clock):
+    rate_limiter = RateLimiter(tokens_per_minute=1000)
+    rate_limiter.acquire(800)
+    rate_limiter.acquire(400)
+    assert clock.sleeps == [pytest.approx(12)]
+
+    # Requests larger than the limit go through once the bucket is full
+    rate_limiter.acquire(5000)
+    assert clock.sleeps[-1] == pytest.approx(60)
+
+
+def test_state_file_is_shared_between_limiters(clock, tmp_path):
+    state_path = str(tmp_path / 'rate_limits.json')
+    first = RateLimiter(requests_per_minute=1, state_path=state_path)
+    second = RateLimiter(requests_per_minute=1, state_path=state_path)
+    first.acquire(0)
+    assert clock.sleeps == []
+    second.acquire(0)
+    assert clock.sleeps == [pytest.approx(60)]
+
+
+def test_corrupt_state_file_is_reset(clock, tmp_path):
+    state_path = tmp_path / 'rate_limits.json'
+    state_path.write_text('{"requests": 0.5, "tok')
+    rate_limiter = RateLimiter(requests_per_minute=1, state_path=str(state_path))
+    rate_limiter.acquire(0)
+    assert clock.sleeps == []
+    assert json.loads(state_path.read_text())['requests'] == pytest.approx(0)
+
+
+def test_rate_limit_waits_are_not_counted_as_latency(clock, monkeypatch):
+    monkeypatch.setattr(time, 'monotonic', clock.time)
+    completions_repo = get_completions_repo(
+        publish_service=DummyPublishService(),
+        model='synthetic',
+        latency=2,
+        tokens_per_second=float('inf'),
+        rate_limiter=RateLimiter(requests_per_minute=1),
+    )
+    completions_repo.tokenizer = RegexTokenizer()
+    completions_repo.complete('Hello')
+    completions_repo.complete('World')
+
+    records = completions_repo.usage_tracker.records
+    # The second request waits for the rest of the minute since the first
+    assert [usage.rate_limit_wait for usage in records] == [0, pytest.approx(58)]
+    assert [usage.latency for usage in records] == [pytest.approx(2), pytest.approx(2)]
@@ -0,0 +1,261 @@
+import os
+import random
+
+import pytest
+from git.repo import Repo
+
+import autopr.utils.repo
+from autopr.tests.helpers import RegexTokenizer, quadratic_chunk_file_content, random_file_content
+from autopr.utils.repo import chunk_file_content, repo_to_file_descriptors, configure_indexing, FileDescriptor, \
+    SeenChunkIndex, filter_seen_chunks
+from autopr.utils.tokenizer import Tokenizer
+
+
+@pytest.mark.parametrize("file_chunk_size", [1, 2, 7, 50, 500, 100000])
+def test_chunk_file_content_matches_quadratic(file_chunk_size):
+    rng = random.Random(file_chunk_size)
+    tokenizer = RegexTokenizer()
+    for num_lines in [0, 1, 3, 40, 400]:
+        content = random_file_content(rng, num_lines)
+        assert chunk_file_content(content, tokenizer, file_chunk_size) == \
+            quadratic_chunk_file_content(content, tokenizer, file_chunk_size)
+
+
+def test_file_descriptor_views_share_text():
+    tokenizer = RegexTokenizer()
+    content = random_file_content(random.Random(0), 100).replace('\n', '\r\n', 10)
+    chunks = chunk_file_content(content, tokenizer, 50)
+    file_descriptor = FileDescriptor.from_text('file.py', content, 0, [len(chunk) for chunk in chunks])
+    assert [file_descriptor.chunk_lines(i) for i in range(file_descriptor.num_chunks)] == chunks
+    assert file_descriptor.end_chunk == len(chunks)
+
+    view = file_descriptor.copy()
+    view.start_chunk = 1
+    view.end_chunk = 2
+    assert view.text is file_descriptor.text
+    assert file_descriptor.start_chunk == 0 and file_descriptor.end_chunk == len(chunks)
+    assert view.filenames_and_contents_to_str().startswith(
+        f'>>> Path: file.py:\n\n... #  (omitting 1 chunks)\n{chunks[1][0][0]} {chunks[1][0][1]}'
+    )
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = Repo.init(tmp_path)
+    rng = random.Random(0)
+    for i in range(5):
+        with open(os.path.join(tmp_path, f'file_{i}.py'), 'w') as f:
+            f.write(random_file_content(rng, 100))
+    repo.index.add([f'file_{i}.py' for i in range(5)])
+    repo.index.commit('Initial commit')
+    return repo
+
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    tokenizer = RegexTokenizer()
+    monkeypatch.setattr(autopr.utils.repo, 'get_tokenizer_by_id', lambda tokenizer_id: tokenizer)
+    monkeypatch.setattr(autopr.utils.repo, '_file_descriptor_cache', {})
+    monkeypatch.setattr(autopr.utils.repo, '_last_indexed_trees', {})
+    return tokenizer
+
+
+class FailingTokenizer(Tokenizer):
+    id = 'failing'
+
+    def encode(self, text: str):
+        raise AssertionError("Cached blobs should not be tokenized")
+
+
+def test_blob_cache_persists_chunks(repo, tokenizer, tmp_path_factory, monkeypatch):
+    configure_indexing(cache_dir=str(tmp_path_factory.mktemp('cache')))
+    try:
+        file_descriptors = repo_to_file_descriptors(repo, 5000, 50)
+
+        # Tokenizing should not be necessary on a fresh process with the same cache directory
+        monkeypatch.setattr(autopr.utils.repo, 'get_tokenizer_by_id', lambda tokenizer_id: FailingTokenizer())
+        monkeypatch.setattr(autopr.utils.repo, '_file_descriptor_cache', {})
+        monkeypatch.setattr(autopr.utils.repo, '_last_indexed_trees', {})
+        assert repo_to_file_descriptors(repo, 5000, 50) == file_descriptors
+    finally:
+        configure_indexing()
+
+
+def test_incremental_refresh_after_commit(repo, tokenizer, monkeypatch):
+    repo_to_file_descriptors(repo, 5000, 50)
+
+    # Modify, add and delete files
+    working_dir = repo.working_tree_dir
+    assert working_dir is not None
+    with open(os.path.join(working_dir, 'file_0.py'), 'a') as f:
+        f.write('\nmodified = True')
+    with open(os.path.join(working_dir, 'new_file.py'), 'w') as f:
+        f.write('added = True')
+    repo.index.add(['file_0.py', 'new_file.py'])
+    repo.index.remove(['file_1.py'], working_tree=True)
+    repo.index.commit('Second commit')
+
+    encoded_texts = []
+
+    class RecordingTokenizer(RegexTokenizer):
+        def encode(self, text: str) -> list[int]:
+            encoded_texts.append(text)
+            return super().encode(text)
+
+    monkeypatch.setattr(autopr.utils.repo, 'get_tokenizer_by_id', lambda tokenizer_id: RecordingTokenizer())
+    file_descriptors = repo_to_file_descriptors(repo, 5000, 50)
+
+    # Only the modified and added files should have been tokenized
+    with open(os.path.join(working_dir, 'file_2.py')) as f:
+        unchanged_content = f.read()
+    assert unchanged_content not in encoded_texts
+    assert 'added = True' in encoded_texts
+
+    # Compare against indexing from scratch
+    monkeypatch.setattr(autopr.utils.repo, '_file_descriptor_cache', {})
+    monkeypatch.setattr(autopr.utils.repo, '_last_indexed_trees', {})
+    assert file_descriptors == repo_to_file_descriptors(repo, 5000, 50)
+    assert [fd.path for fd in file_descriptors] == \
+        ['file_0.py', 'file_2.py', 'file_3.py', 'file_4.py', 'new_file.py']
+
+
+def test_changing_the_tokenizer_reindexes(repo, tokenizer, monkeypatch):
+    encoded_texts = []
+
+    class RecordingTokenizer(RegexTokenizer):
+        def encode(self, text: str) -> list[int]:
+            encoded_texts.append(text)
+            return super().encode(text)
+
+    monkeypatch.setattr(autopr.utils.repo, 'get_tokenizer_by_id', lambda tokenizer_id: RecordingTokenizer())
+    monkeypatch.setattr(autopr.utils.repo, 'get_tokenizer_id', lambda: 'cl100k_base')
+    repo_to_file_descriptors(repo, 5000, 50)
+    num_encoded = len(encoded_texts)
+    repo_to_file_descriptors(repo, 5000, 50)
+    assert len(encoded_texts) == num_encoded
+
+    # Token counts of another tokenizer can't be reused
+    monkeypatch.setattr(autopr.utils.repo, 'get_tokenizer_id', lambda: 'char_ratio')
+    repo_to_file_descriptors(repo, 5000, 50)
+    assert len(encoded_texts) > num_encoded
+
+
+def test_deleting_an_ignore_file_reindexes(repo, tokenizer, monkeypatch):
+    working_dir = repo.working_tree_dir
+    assert working_dir is not None
+    files = {
+        '.gptignore': 'build/\n',
+        'build/gen.py': 'generated = True',
+    }
+    for path, content in files.items():
+        os.makedirs(os.path.join(working_dir, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(working_dir, path), 'w') as f:
+            f.write(content)
+    repo.index.add(list(files))
+    repo.index.commit('Ignore build')
+    assert 'build/gen.py' not in [fd.path for fd in repo_to_file_descriptors(repo, 5000, 50)]
+
+    # Files that were ignored are indexed once the ignore file is deleted
+    repo.index.remove(['.gptignore'], working_tree=True)
+    repo.index.commit('Stop ignoring build')
+    file_descriptors = repo_to_file_descriptors(repo, 5000, 50)
+    assert 'build/gen.py' in [fd.path for fd in file_descriptors]
+
+    monkeypatch.setattr(autopr.utils.repo, '_file_descriptor_cache', {})
+    monkeypatch.setattr(autopr.utils.repo, '_last_indexed_trees', {})
+    assert file_descriptors == repo_to_file_descriptors(repo, 5000, 50)
+
+
+def test_parallel_indexing_matches_serial(repo, tokenizer, monkeypatch):
+    serial_file_descriptors = repo_to_file_descriptors(repo, 5000, 50)
+
+    monkeypatch.setattr(autopr.utils.repo, '_file_descriptor_cache', {})
+    monkeypatch.setattr(autopr.utils.repo, '_last_indexed_trees', {})
+    configure_indexing(num_workers=2)
+    try:
+        assert repo_to_file_descriptors(repo, 5000, 50) == serial_file_descriptors
+    finally:
+        configure_indexing()
+
+
+def test_ignored_files_are_skipped(repo, tokenizer):
+    working_dir = repo.working_tree_dir
+    assert working_dir is not None
+    files = {
+        '.gitignore': 'build/\n*.log\n',
+        '.gptignore': 'docs/\n',
+        'build/output.py': 'built = True',
+        'app/.gitignore': '# Nested patterns apply relative to app/\ngenerated.py\n!keep.log\n',
+        'app/generated.py': 'generated = True',
+        'app/keep.log': 'kept = True',
+        'app/debug.log': 'debug = True',
+        'app/main.py': 'main = True',
+        'docs/index.md': 'docs = True',
+        'generated.py': 'not_generated = True',
+        'web/node_modules/lib/index.js': 'lib = True',
+        'web/package-lock.json': '{}',
+        'web/app.min.js': 'minified = true',
+        'web/app.js': 'app = true',
+    }
+    for path, content in files.items():
+        os.makedirs(os.path.join(working_dir, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(working_dir, path), 'w') as f:
+            f.write(content)
+    repo.index.add(list(files))
+    repo.index.commit('Add ignored files')
+
+    file_descriptors = repo_to_file_descriptors(repo, 5000, 50)
+    assert [fd.path for fd in file_descriptors] == [
+        '.gitignore', '.gptignore',
+        'file_0.py', 'file_1.py', 'file_2.py', 'file_3.py', 'file_4.py',
+        'generated.py',
+        'app/.gitignore', 'app/keep.log', 'app/main.py',
+        'web/app.js',
+    ]
+
+
+def test_binary_and_large_files_are_listed_without_contents(repo, tokenizer):
+    working_dir = repo.working_tree_dir
+    assert working_dir is not None
+    files = {
+        'image.png': b'not actually an image',
+        'data.bin.txt': b'header\0' + b'x' * 1000,
+        'large.py': b'x = 1\n' * 1000,
+        'small.py': b'x = 1\n',
+    }
+    for path, content in files.items():
+        with open(os.path.join(working_dir, path), 'wb') as f:
+            f.write(content)
+    repo.index.add(list(files))
+    repo.index.commit('Add binary files')
+
+    configure_indexing(max_file_size=5000)
+    try:
+        file_descriptors = {fd.path: fd for fd in repo_to_file_descriptors(repo, 5000, 50)}
+    finally:
+        configure_indexing()
+
+    assert file_descriptors['image.png'].filepaths_with_token_lengths_to_str() == 'image.png (binary, 21 bytes)'
+    assert file_descriptors['data.bin.txt'].filepaths_with_token_lengths_to_str() == 'data.bin.txt (binary, 1007 bytes)'
+    assert file_descriptors['large.py'].filepaths_with_token_lengths_to_str() == 'large.py (too large, 6000 bytes)'
+    assert file_descriptors['small.py'].skipped_reason is None
+    assert file_descriptors['small.py'].chunk_lines(0) == [(0, 'x = 1')]
+
+
+def test_seen_chunk_index_omits_seen_chunks():
+    def fd(path: str, num_chunks: int) -> FileDescriptor:
+        return FileDescriptor.from_text(path, '\n'.join(['x'] * num_chunks), 0, [1] * num_chunks)
+
+    files = [fd('a.py', 3), fd('b.py', 3), fd('c.py', 3), fd('d.png', 0)]
+    seen = [f.copy() for f in files[:2] + files[3:]]
+    seen[0].end_chunk = 1
+
+    index = SeenChunkIndex(seen)
+    unseen = index.unseen(files)
+    assert [(f.path, f.start_chunk, f.end_chunk) for f in unseen] == [('a.py', 1, 3), ('c.py', 0, 3)]
+    assert unseen == filter_seen_chunks(seen, files)
+    assert files[0].start_chunk == 0
+
+    # Chunks that are seen in the current prompt don't update the index
+    assert index.unseen(files, also_seen_fds=[files[2]]) == unseen[:1]
+    assert index.seen_up_to('c.py') is None
@@ -0,0 +1,48 @@
+from autopr.repos.completions_repo import CompletionsRepo
+from autopr.tests.helpers import RegexTokenizer
+from autopr.utils.response_cache import ResponseCache
+
+
+class CountingCompletionsRepo(CompletionsRepo):
+    models = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokenizer = RegexTokenizer()
+        self.num_completions = 0
+
+    def _complete(self, system_prompt, examples, prompt, max_tokens, temperature) -> str:
+        self.num_completions += 1
+        return f'Response {self.num_completions} to {prompt}'
+
+
+def test_cached_responses_persist_across_runs(tmp_path):
+    def complete(prompt: str, temperature: float) -> tuple[str, int]:
+        completions_repo = CountingCompletionsRepo(
+            publish_service=None,  # type: ignore
+            model='counting',
+            response_cache=ResponseCache(str(tmp_path), policy='temperature_0'),
+        )
+        return completions_repo.complete(prompt, temperature=temperature), completions_repo.num_completions
+
+    assert complete('hello', 0) == ('Response 1 to hello', 1)
+    assert complete('hello', 0) == ('Response 1 to hello', 0)
+    assert complete('goodbye', 0) == ('Response 1 to goodbye', 1)
+
+    # Responses sampled at a non-zero temperature aren't cached
+    assert complete('hello', 0.5) == ('Response 1 to hello', 1)
+    assert complete('hello', 0.5) == ('Response 1 to hello', 1)
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path):
+    response_cache = ResponseCache(str(tmp_path), policy='always', max_entries=2)
+    response_cache.set('a', 'A')
+    response_cache.set('b', 'B')
+    assert response_cache.get('a') == 'A'
+    response_cache.set('c', 'C')
+    assert response_cache.get('b') is None
+    assert response_cache.get('a') == 'A'
+    assert response_cache.get('c') == 'C'
+
+    expired_response_cache = ResponseCache(str(tmp_path), policy='always', ttl=-1)
+    assert expired_response_cache.get('a') is None
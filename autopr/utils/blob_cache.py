@@ -0,0 +1,66 @@
+import json
+import os
+import sqlite3
+from typing import Optional
+
+import structlog
+
+log = structlog.get_logger()
+
+
+class BlobCache:
+    """
+    On-disk cache of how blobs are tokenized and chunked, persisted across runs.
+
+    Entries are content-addressed by the blob's git sha, the tokenizer, and the chunk size,
+    so a run only tokenizes blobs that no previous run has seen.
+    Point `cache_dir` at a directory outside the repository, and restore it between runs (e.g., with actions/cache).
+    """
+
+    filename = 'blobs.sqlite3'
+
+    def __init__(self, cache_dir: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.filename)
+        self.connection = sqlite3.connect(self.path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS blobs ('
+                '  blob_sha TEXT NOT NULL,'
+                '  tokenizer_id TEXT NOT NULL,'
+                '  file_chunk_size INTEGER NOT NULL,'
+                '  token_length INTEGER NOT NULL,'
+                '  chunk_line_counts TEXT NOT NULL,'
+                '  PRIMARY KEY (blob_sha, tokenizer_id, file_chunk_size)'
+                ')'
+            )
+
+    def get(self, blob_sha: str, tokenizer_id: str, file_chunk_size: int) -> Optional[tuple[int, list[int]]]:
+        """
+        Get the token length and the number of lines in each chunk of a blob, if it has been cached.
+        """
+        row = self.connection.execute(
+            'SELECT token_length, chunk_line_counts FROM blobs '
+            'WHERE blob_sha = ? AND tokenizer_id = ? AND file_chunk_size = ?',
+            (blob_sha, tokenizer_id, file_chunk_size),
+        ).fetchone()
+        if row is None:
+            return None
+        token_length, chunk_line_counts = row
+        return token_length, json.loads(chunk_line_counts)
+
+    def set_many(self, entries: list[tuple[str, str, int, int, list[int]]]):
+        """
+        Store (blob sha, tokenizer id, file chunk size, token length, chunk line counts) entries.
+        """
+        if not entries:
+            return
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)',
+                [
+                    (blob_sha, tokenizer_id, file_chunk_size, token_length, json.dumps(chunk_line_counts))
+                    for blob_sha, tokenizer_id, file_chunk_size, token_length, chunk_line_counts in entries
+                ],
+            )
+        log.debug("Cached blobs", num_blobs=len(entries), path=self.path)
@@ -0,0 +1,243 @@
+import base64
+import collections
+import io
+import json
+import threading
+from typing import Any, Iterator, Optional
+
+import requests
+import structlog
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+log = structlog.get_logger()
+
+
+class Cassette:
+    """
+    Records the HTTP exchanges of a run to a file, or replays them from it, so that runs can be reproduced offline.
+
+    This covers every request made with `requests`, i.e., the OpenAI API (for rails and chains alike)
+    and the GitHub API (via `GitHubEventService` and `GitHubPublishService`).
+    Request headers are not recorded, so that tokens don't end up in the cassette.
+    Streamed responses (e.g., streamed completions) are recorded as far as the caller reads them,
+    so that a completion stopped early is recorded, and replayed, as it was received.
+
+    Installing the cassette patches `HTTPAdapter.send` for the whole process,
+    so every `requests` session records or replays until it's uninstalled; install one cassette per run.
+
+    When replaying, requests are matched by method, URL and body,
+    and identical requests are answered in the order they were recorded.
+    Writes to the GitHub API are matched by method and URL only, because the published bodies
+    depend on timing (updates are debounced and published in the background).
+    As they may be published more or less often than when recording, the last of their responses is replayed
+    once they run out.
+
+    Parameters
+    ----------
+    path: str
+        Path of the cassette file, with one recorded exchange per line.
+    mode: str
+        `record` to make requests and write them to the cassette,
+        or `replay` to answer requests from the cassette without making them.
+    """
+
+    modes = ['record', 'replay']
+
+    # Headers describing how the body was transferred, which no longer apply to the recorded body
+    transfer_headers = ['content-encoding', 'content-length', 'transfer-encoding']
+
+    # Writes to these URLs are matched without their body
+    unmatched_body_url_prefix = 'https://api.github.com/'
+    read_methods = ['GET', 'HEAD', 'OPTIONS']
+
+    def __init__(self, path: str, mode: str):
+        if mode not in self.modes:
+            raise ValueError(f"Cassette mode {mode} not implemented")
+        self.path = path
+        self.mode = mode
+
+        self._lock = threading.Lock()
+        self._original_send = None
+        self._file: Optional[io.TextIOWrapper] = None
+        self._open_streams: list['_RecordingStream'] = []
+        self._recorded: dict[tuple[str, str, str], collections.deque[dict[str, Any]]] = \
+            collections.defaultdict(collections.deque)
+
+    def install(self):
+        """
+        Start recording or replaying requests made with `requests`.
+        """
+        if self._original_send is not None:
+            return
+        if self.mode == 'record':
+            self._file = open(self.path, 'w')
+        else:
+            with open(self.path) as f:
+                for line in f:
+                    exchange = json.loads(line)
+                    request = exchange['request']
+                    key = self._match_key(request['method'], request['url'], request['body'])
+                    self._recorded[key].append(exchange['response'])
+
+        cassette = self
+        original_send = self._original_send = HTTPAdapter.send
+
+        def send(adapter: HTTPAdapter, request: requests.PreparedRequest, *args, **kwargs) -> requests.Response:
+            if cassette.mode == 'record':
+                response = original_send(adapter, request, *args, **kwargs)
+                cassette._record(request, response, stream=kwargs.get('stream', False))
+                return response
+            return cassette._replay(adapter, request)
+
+        HTTPAdapter.send = send  # type: ignore
+        log.info("Installed cassette", path=self.path, mode=self.mode)
+
+    def uninstall(self):
+        """
+        Stop recording or replaying requests.
+        """
+        if self._original_send is None:
+            return
+        HTTPAdapter.send = self._original_send  # type: ignore
+        self._original_send = None
+        # Record streams the caller stopped reading without closing
+        for stream in list(self._open_streams):
+            stream.finish()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> 'Cassette':
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+    @staticmethod
+    def _request_key(request: requests.PreparedRequest) -> tuple[str, str, str]:
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode(errors='replace')
+        return request.method or '', request.url or '', body or ''
+
+    def _matches_body(self, method: str, url: str) -> bool:
+        return method in self.read_methods or not url.startswith(self.unmatched_body_url_prefix)
+
+    def _match_key(self, method: str, url: str, body: str) -> tuple[str, str, str]:
+        if not self._matches_body(method, url):
+            return method, url, ''
+        return method, url, body
+
+    def _record(self, request: requests.PreparedRequest, response: requests.Response, stream: bool = False):
+        method, url, body = self._request_key(request)
+        exchange = {
+            'request': {
+                'method': method,
+                'url': url,
+                'body': body,
+            },
+            'response': {
+                'status_code': response.status_code,
+                'reason': response.reason,
+                'headers': {
+                    name: value for name, value in response.headers.items()
+                    if name.lower() not in self.transfer_headers
+                },
+            },
+        }
+        if stream:
+            # Record the body as the caller reads it, instead of reading it all before the caller sees any of it
+            recording_stream = _RecordingStream(self, exchange, response.raw)
+            with self._lock:
+                self._open_streams.append(recording_stream)
+            response.raw = recording_stream
+            return
+        # Reading the content here keeps it available to the caller
+        self._write(exchange, response.content)
+
+    def _write(self, exchange: dict[str, Any], content: bytes):
+        try:
+            exchange['response']['text'] = content.decode()
+        except UnicodeDecodeError:
+            exchange['response']['content_base64'] = base64.b64encode(content).decode()
+        with self._lock:
+            assert self._file is not None
+            self._file.write(json.dumps(exchange) + '\n')
+            self._file.flush()
+
+    def _replay(self, adapter: HTTPAdapter, request: requests.PreparedRequest) -> requests.Response:
+        key = self._match_key(*self._request_key(request))
+        with self._lock:
+            recorded_responses = self._recorded.get(key)
+            if not recorded_responses:
+                raise RuntimeError(f"No recorded response left in cassette {self.path} for {key[0]} {key[1]}")
+            if len(recorded_responses) == 1 and not self._matches_body(key[0], key[1]):
+                recorded_response = recorded_responses[0]
+            else:
+                recorded_response = recorded_responses.popleft()
+
+        response = requests.Response()
+        response.status_code = recorded_response['status_code']
+        response.reason = recorded_response['reason']
+        response.headers = CaseInsensitiveDict(recorded_response['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        if 'text' in recorded_response:
+            content = recorded_response['text'].encode()
+        else:
+            content = base64.b64decode(recorded_response['content_base64'])
+        response.raw = io.BytesIO(content)
+        response.url = request.url or ''
+        response.request = request
+        response.connection = adapter
+        return response
+
+
+class _RecordingStream:
+    """
+    Wraps the raw body of a streamed response, recording it to the cassette as far as it's read.
+    """
+
+    def __init__(self, cassette: Cassette, exchange: dict[str, Any], raw: Any):
+        self._cassette = cassette
+        self._exchange = exchange
+        self._raw = raw
+        self._content = bytearray()
+        self._finished = False
+
+    def stream(self, *args, **kwargs) -> Iterator[bytes]:
+        try:
+            for chunk in self._raw.stream(*args, **kwargs):
+                self._content += chunk
+                yield chunk
+        finally:
+            self.finish()
+
+    def read(self, *args, **kwargs) -> bytes:
+        # Record the body without its transfer encoding, like the headers
+        kwargs.setdefault('decode_content', True)
+        chunk = self._raw.read(*args, **kwargs)
+        self._content += chunk
+        if not chunk:
+            self.finish()
+        return chunk
+
+    def close(self):
+        self.finish()
+        self._raw.close()
+
+    def finish(self):
+        """
+        Record what's been read so far, once.
+        """
+        with self._cassette._lock:
+            if self._finished:
+                return
+            self._finished = True
+            self._cassette._open_streams.remove(self)
+        self._cassette._write(self._exchange, bytes(self._content))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._raw, name)
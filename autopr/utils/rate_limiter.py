@@ -0,0 +1,133 @@
+import contextlib
+import json
+import threading
+import time
+from typing import Optional, Iterator
+
+import structlog
+
+log = structlog.get_logger()
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter for language model requests, smoothing requests instead of retrying them after 429s.
+
+    Keeps a token bucket for requests per minute, and another for tokens per minute,
+    each refilling continuously and holding up to a minute's worth.
+    Before each call, `acquire` waits until both buckets hold enough for it.
+
+    To share the limits between processes (e.g., several AutoPR jobs on one runner with the same API key),
+    set `state_path` to the same file in each; the buckets are kept in that file, behind a file lock.
+
+    Parameters
+    ----------
+    requests_per_minute: int
+        Maximum number of requests per minute, or 0 for no limit.
+    tokens_per_minute: int
+        Maximum number of tokens per minute, or 0 for no limit.
+        Calls are counted by their estimated usage (prompt tokens plus max tokens), as actual usage isn't known upfront.
+    state_path: str, optional
+        File to keep the buckets in, to share them between processes.
+        If None, the buckets are only shared within the process.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = 0,
+        tokens_per_minute: int = 0,
+        state_path: Optional[str] = None,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_path = state_path
+
+        self._lock = threading.Lock()
+        self._state = self._full_state()
+
+    def _full_state(self) -> dict[str, float]:
+        return {
+            'requests': self.requests_per_minute,
+            'tokens': self.tokens_per_minute,
+            'updated_at': time.time(),
+        }
+
+    def acquire(self, num_tokens: int) -> float:
+        """
+        Wait until a request of `num_tokens` tokens fits in the rate limits, and count it against them.
+        Returns the number of seconds waited.
+        """
+        # A request larger than a minute's worth of tokens would never fit, so let it through when the bucket is full
+        if self.tokens_per_minute:
+            num_tokens = min(num_tokens, self.tokens_per_minute)
+
+        waited_seconds = 0.0
+        while True:
+            with self._locked_state() as state:
+                # Refill the buckets for the time that passed
+                now = time.time()
+                elapsed_minutes = max(now - state['updated_at'], 0) / 60
+                state['requests'] = min(
+                    state['requests'] + elapsed_minutes * self.requests_per_minute,
+                    self.requests_per_minute,
+                )
+                state['tokens'] = min(
+                    state['tokens'] + elapsed_minutes * self.tokens_per_minute,
+                    self.tokens_per_minute,
+                )
+                state['updated_at'] = now
+
+                # Count the request against the buckets, or find out how long to wait until it fits
+                wait_seconds = 0.0
+                if self.requests_per_minute and state['requests'] < 1:
+                    wait_seconds = (1 - state['requests']) / self.requests_per_minute * 60
+                if self.tokens_per_minute and state['tokens'] < num_tokens:
+                    wait_seconds = max(
+                        wait_seconds,
+                        (num_tokens - state['tokens']) / self.tokens_per_minute * 60,
+                    )
+                if wait_seconds == 0:
+                    if self.requests_per_minute:
+                        state['requests'] -= 1
+                    if self.tokens_per_minute:
+                        state['tokens'] -= num_tokens
+                    return waited_seconds
+
+            log.debug("Waiting for rate limit", wait_seconds=wait_seconds, num_tokens=num_tokens)
+            time.sleep(wait_seconds)
+            waited_seconds += wait_seconds
+
+    @contextlib.contextmanager
+    def _locked_state(self) -> Iterator[dict[str, float]]:
+        with self._lock:
+            if self.state_path is None:
+                yield self._state
+                return
+
+            import fcntl
+
+            with open(self.state_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    state = self._parse_state(f.read())
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _parse_state(self, content: str) -> dict[str, float]:
+        if not content:
+            return self._full_state()
+        try:
+            state = json.loads(content)
+        except json.JSONDecodeError:
+            state = None
+        if not isinstance(state, dict) or not {'requests', 'tokens', 'updated_at'} <= state.keys():
+            # E.g., a process was killed while writing it
+            log.warning("Resetting corrupt rate limit state", state_path=self.state_path)
+            return self._full_state()
+        return state
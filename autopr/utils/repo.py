@@ -1,69 +1,134 @@
-from typing import Optional
+import bisect
+import collections
+import itertools
+import os
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Callable, Iterable, Iterator
 
-from git import Blob
+from git import Blob, Tree
 from git.repo import Repo
 import pydantic
 
 import structlog
-import os
 
-from pathspec import PathSpec
 from pathspec.patterns.gitwildmatch import GitWildMatchPattern
-from autopr.utils.tokenizer import get_tokenizer
+from autopr.utils.blob_cache import BlobCache
+from autopr.utils.tokenizer import Tokenizer, get_tokenizer_by_id, get_tokenizer_id
 
 log = structlog.get_logger()
 
 
 class FileDescriptor(pydantic.BaseModel):
+    """
+    A file's contents split into chunks, viewed from `start_chunk` to `end_chunk`.
+
+    Lines and chunks are offsets into the file's text, so copies share the text instead of duplicating it.
+    Copy with `.copy()` to get another view of the same file in O(1).
+    """
+
     path: str
     token_length: int
-    chunks: list[list[tuple[int, str]]]  # list of (line number, line content) pairs
+    text: str = ''
+    line_starts: array = pydantic.Field(default_factory=lambda: array('q'))  # offset of each line in text
+    line_ends: array = pydantic.Field(default_factory=lambda: array('q'))  # offset of each line's end, without its newline
+    chunk_starts: array = pydantic.Field(default_factory=lambda: array('q', [0]))  # index of each chunk's first line, and the number of lines
     start_chunk: int = 0
     end_chunk: int = -1  # this will be overwritten by the root validator
+    size: Optional[int] = None  # in bytes, set for files whose contents were skipped
+    skipped_reason: Optional[str] = None  # why the contents were skipped (e.g., binary), if they were
+
+    class Config:
+        arbitrary_types_allowed = True
 
     @pydantic.root_validator(pre=True)
     def validate_end_chunk(cls, values):
         if 'end_chunk' not in values:
-            values['end_chunk'] = len(values['chunks'])
+            values['end_chunk'] = len(values.get('chunk_starts', [0])) - 1
         return values
 
+    @classmethod
+    def from_text(cls, path: str, text: str, token_length: int, chunk_line_counts: list[int]) -> 'FileDescriptor':
+        line_starts = array('q')
+        line_ends = array('q')
+        offset = 0
+        for line_with_newline, line in zip(text.splitlines(keepends=True), text.splitlines()):
+            line_starts.append(offset)
+            line_ends.append(offset + len(line))
+            offset += len(line_with_newline)
+        return cls(
+            path=path,
+            token_length=token_length,
+            text=text,
+            line_starts=line_starts,
+            line_ends=line_ends,
+            chunk_starts=array('q', [0, *itertools.accumulate(chunk_line_counts)]),
+        )
+
+    @property
+    def num_chunks(self) -> int:
+        return len(self.chunk_starts) - 1
+
     def filepaths_with_token_lengths_to_str(self) -> str:
+        if self.skipped_reason is not None:
+            return f'{self.path} ({self.skipped_reason}, {self.size} bytes)'
         # TODO give info on what chunks we've already seen
         return f'{self.path} ({str(self.token_length)} tokens)'
         # chunks_left = self.end_chunk - self.start_chunk
         # return f'{self.path} ({str(self.token_length)} tokens) ({str(chunks_left)} chunks left)'
 
     def filenames_and_contents_to_str(self) -> str:
+        if self.skipped_reason is not None:
+            return f'>>> Path: {self.path}:\n\n... #  ({self.skipped_reason}, {self.size} bytes, contents omitted)'
         contents = ''
         if self.start_chunk > 0:
             contents += f'... #  (omitting {self.start_chunk} chunks)\n'
+        contents += '\n'.join([
+            self.chunk_to_str(chunk_index)
+            for chunk_index in range(self.start_chunk, self.end_chunk)
+        ])
+        if self.end_chunk < self.num_chunks:
+            contents += f'\n... #  (omitting {self.num_chunks - self.end_chunk} chunks)'
+        return f'>>> Path: {self.path}:\n\n{contents}'
+
+    def chunk_lines(self, chunk_index: int) -> list[tuple[int, str]]:
+        """
+        Get the (line number, line content) pairs of a chunk.
+        """
+        return [
+            (line_number, self.text[self.line_starts[line_number]:self.line_ends[line_number]])
+            for line_number in range(self.chunk_starts[chunk_index], self.chunk_starts[chunk_index + 1])
+        ]
+
+    def chunk_to_str(self, chunk_index: int) -> str:
         # TODO make the line numbers right-aligned with padded spaces,
         #  so that the line numbers don't change the start of the line
-        contents += '\n'.join([
+        return '\n'.join([
             f'{str(line_number)} {line_content}'
-            for chunk in self.chunks[self.start_chunk:self.end_chunk]
-            for line_number, line_content in chunk
+            for line_number, line_content in self.chunk_lines(chunk_index)
         ])
-        if self.end_chunk < len(self.chunks):
-            contents += f'\n... #  (omitting {len(self.chunks) - self.end_chunk} chunks)'
-        return f'>>> Path: {self.path}:\n\n{contents}'
+
+
+def _longest_file_desc_index(file_descs: list[FileDescriptor]) -> int:
+    # Find file with most chunks
+    longest_num = 0
+    longest_i = 0
+    for i, desc in enumerate(file_descs):
+        num_chunks = desc.end_chunk - desc.start_chunk
+        if num_chunks > longest_num:
+            longest_num = num_chunks
+            longest_i = i
+    return longest_i
 
 
 def trim_chunk(file_desc_with_chunk_start_end: list[FileDescriptor]) -> bool:
     if file_desc_with_chunk_start_end:
-        # Find file with most chunks
-        longest_num = 0
-        longest_i = 0
-        for i, desc in enumerate(file_desc_with_chunk_start_end):
-            num_chunks = desc.end_chunk - desc.start_chunk
-            if num_chunks > longest_num:
-                longest_num = num_chunks
-                longest_i = i
-
+        longest_i = _longest_file_desc_index(file_desc_with_chunk_start_end)
         desc = file_desc_with_chunk_start_end[longest_i]
 
         # If we've already looked at the whole file, remove it from the list
-        if desc.start_chunk == desc.end_chunk - 1:
+        if desc.end_chunk - desc.start_chunk <= 1:
             del file_desc_with_chunk_start_end[longest_i]
             return True
 
@@ -74,101 +139,479 @@ def trim_chunk(file_desc_with_chunk_start_end: list[FileDescriptor]) -> bool:
     return False
 
 
-def filter_seen_chunks(seen_fds: list[FileDescriptor], prospective_fds: list[FileDescriptor]) -> list[FileDescriptor]:
-    fds_copy = [f.copy(deep=True) for f in prospective_fds]
-    omit_prospective_fd_indices = []
-    for selected_fd in seen_fds:
-        # If it's in prospective_file_descriptors, update its start_chunk
-        for prospective_fd in fds_copy:
-            if prospective_fd.path == selected_fd.path:
-                # If we've already looked at the whole file, remove it from the list
-                if prospective_fd.end_chunk == selected_fd.end_chunk:
-                    omit_prospective_fd_indices.append(fds_copy.index(prospective_fd))
-                else:
-                    prospective_fd.start_chunk = selected_fd.end_chunk
-                break
-    for i in sorted(omit_prospective_fd_indices, reverse=True):
-        del fds_copy[i]
-    return fds_copy
+def trim_chunks(
+    file_desc_with_chunk_start_end: list[FileDescriptor],
+    num_tokens: int,
+    tokenizer: Tokenizer,
+) -> bool:
+    """
+    Trim chunks like `trim_chunk`, until the trimmed chunks add up to `num_tokens` tokens.
+    Only counts the tokens of the chunks being trimmed, instead of the whole prompt after every chunk.
+    """
+    if not file_desc_with_chunk_start_end:
+        return False
+
+    trimmed_tokens = 0
+    while file_desc_with_chunk_start_end and trimmed_tokens < num_tokens:
+        longest_i = _longest_file_desc_index(file_desc_with_chunk_start_end)
+        desc = file_desc_with_chunk_start_end[longest_i]
+
+        # If we've already looked at the whole file, remove it from the list
+        if desc.end_chunk - desc.start_chunk <= 1:
+            trimmed_tokens += tokenizer.count_tokens(desc.filenames_and_contents_to_str())
+            del file_desc_with_chunk_start_end[longest_i]
+            continue
+
+        # Otherwise, shave a chunk off the end
+        trimmed_tokens += tokenizer.count_tokens('\n' + desc.chunk_to_str(desc.end_chunk - 1))
+        desc.end_chunk -= 1
+    return True
+
+
+class SeenChunkIndex:
+    """
+    Tracks up to which chunk each file has been looked at, keyed by path.
+
+    Share one index across consecutive file-viewing prompts,
+    and update it with the file descriptors each prompt ended up showing.
+    """
+
+    def __init__(self, seen_fds: Optional[list[FileDescriptor]] = None):
+        self._end_chunks: dict[str, int] = {}
+        if seen_fds:
+            self.update(seen_fds)
+
+    def update(self, seen_fds: list[FileDescriptor]):
+        for fd in seen_fds:
+            self._end_chunks[fd.path] = max(fd.end_chunk, self._end_chunks.get(fd.path, 0))
+
+    def seen_up_to(self, path: str) -> Optional[int]:
+        """
+        Get the index of the chunk that the file at `path` has been seen up to, or None if it hasn't been seen.
+        """
+        return self._end_chunks.get(path)
+
+    def unseen(
+        self,
+        prospective_fds: Iterable[FileDescriptor],
+        also_seen_fds: Iterable[FileDescriptor] = (),
+    ) -> list[FileDescriptor]:
+        """
+        Get views of the chunks of `prospective_fds` that haven't been seen yet,
+        omitting files that have been seen in full.
+        Chunks of `also_seen_fds` count as seen, without updating the index.
+        """
+        also_seen_end_chunks = {fd.path: fd.end_chunk for fd in also_seen_fds}
+        unseen_fds = []
+        for fd in prospective_fds:
+            seen_up_to = self._end_chunks.get(fd.path)
+            if fd.path in also_seen_end_chunks:
+                seen_up_to = max(also_seen_end_chunks[fd.path], seen_up_to or 0)
+            if seen_up_to is not None:
+                # If we've already looked at the whole file, omit it
+                if seen_up_to >= fd.end_chunk:
+                    continue
+                if seen_up_to > fd.start_chunk:
+                    fd = fd.copy()
+                    fd.start_chunk = seen_up_to
+            unseen_fds.append(fd)
+        return unseen_fds
 
 
-_file_descriptor_cache: dict[tuple[bytes, int, int], list[FileDescriptor]] = {}
+def filter_seen_chunks(seen_fds: list[FileDescriptor], prospective_fds: list[FileDescriptor]) -> list[FileDescriptor]:
+    return SeenChunkIndex(seen_fds).unseen(prospective_fds)
+
+
+def chunk_file_content(content: str, tokenizer: Tokenizer, file_chunk_size: int) -> list[list[tuple[int, str]]]:
+    """
+    Split the lines of `content` into chunks of (line number, line content) pairs.
+    Each chunk ends at the first line where the chunk's newline-joined lines reach `file_chunk_size` tokens.
+
+    Instead of re-encoding the chunk after every line,
+    estimates chunk ends from cumulative per-line token lengths,
+    and pinpoints the exact end with a few encodes around the estimate.
+    """
+    lines = content.splitlines()
+
+    def reaches_chunk_size(start: int, end: int) -> bool:
+        return tokenizer.count_tokens('\n'.join(lines[start:end])) >= file_chunk_size
+
+    # Count each line as it appears after a newline, so the sums approximate the joined token length
+    cumulative_lengths = [0, *itertools.accumulate(
+        tokenizer.count_tokens('\n' + line) for line in lines
+    )]
+
+    chunks: list[list[tuple[int, str]]] = []
+    start = 0
+    while start < len(lines):
+        # The joined chunk is one token shorter than the sum, as its first line isn't preceded by a newline
+        estimated_end = bisect.bisect_left(
+            cumulative_lengths,
+            cumulative_lengths[start] + file_chunk_size + 1,
+            lo=start + 1,
+        )
+        end = _find_chunk_end(
+            lambda e: reaches_chunk_size(start, e),
+            start=start,
+            guess=min(estimated_end, len(lines)),
+            stop=len(lines),
+        )
+        chunks.append([(i, lines[i]) for i in range(start, end)])
+        start = end
+    return chunks
+
+
+def _find_chunk_end(reaches_chunk_size: Callable[[int], bool], start: int, guess: int, stop: int) -> int:
+    """
+    Find the first end in (start, stop] at which the chunk reaches its size, or `stop` if it never does.
+    Gallops away from `guess` until the end is bracketed, then bisects.
+    """
+    step = 1
+    if reaches_chunk_size(guess):
+        lo, hi = guess - step, guess
+        while lo > start and reaches_chunk_size(lo):
+            hi = lo
+            step *= 2
+            lo = hi - step
+        lo = max(lo, start)
+    else:
+        lo, hi = guess, guess + step
+        while hi < stop and not reaches_chunk_size(hi):
+            lo = hi
+            step *= 2
+            hi = lo + step
+        if hi >= stop:
+            if lo == stop or not reaches_chunk_size(stop):
+                return stop
+            hi = stop
+
+    # Invariant: the chunk ending at `lo` is too short, the chunk ending at `hi` is long enough
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if reaches_chunk_size(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+_file_descriptor_cache: dict[tuple[bytes, str, int, int], list[FileDescriptor]] = {}
+
+_last_indexed_trees: dict[tuple[str, str, int, int], Tree] = {}
+
+_blob_cache: Optional[BlobCache] = None
+
+_num_indexing_workers = 1
+
+#: Extensions of files that are listed without reading their contents.
+DEFAULT_SKIPPED_FILE_EXTENSIONS = frozenset([
+    # Images
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.webp', '.tif', '.tiff', '.psd',
+    # Audio and video
+    '.mp3', '.wav', '.ogg', '.flac', '.mp4', '.mov', '.avi', '.mkv', '.webm',
+    # Archives
+    '.zip', '.tar', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jar', '.whl',
+    # Compiled code
+    '.exe', '.dll', '.so', '.dylib', '.o', '.a', '.class', '.pyc', '.wasm',
+    # Fonts
+    '.ttf', '.otf', '.woff', '.woff2', '.eot',
+    # Documents and data
+    '.pdf', '.sqlite', '.sqlite3', '.db', '.npy', '.npz', '.parquet', '.pkl', '.h5', '.bin',
+])
+
+_max_file_size = 1_000_000
+
+_skipped_file_extensions = DEFAULT_SKIPPED_FILE_EXTENSIONS
+
+# Number of bytes to sniff for NUL bytes, like git does to tell binary files apart
+_binary_sniff_size = 8000
+
+
+def configure_indexing(
+    cache_dir: Optional[str] = None,
+    num_workers: int = 1,
+    max_file_size: int = 1_000_000,
+    skipped_file_extensions: Optional[list[str]] = None,
+):
+    """
+    Configure how `repo_to_file_descriptors` indexes blobs.
+
+    Parameters
+    ----------
+    cache_dir: str, optional
+        Persist how blobs are chunked to this directory, so that later runs don't tokenize them again.
+        If None, only cache in memory.
+    num_workers: int
+        Number of processes to decode and tokenize blobs in.
+    max_file_size: int
+        Size in bytes above which files are listed without reading their contents.
+    skipped_file_extensions: list[str], optional
+        Extensions of files to list without reading their contents, in addition to `DEFAULT_SKIPPED_FILE_EXTENSIONS`.
+    """
+    global _blob_cache, _num_indexing_workers, _max_file_size, _skipped_file_extensions
+    _blob_cache = BlobCache(cache_dir) if cache_dir else None
+    _num_indexing_workers = num_workers
+    _max_file_size = max_file_size
+    _skipped_file_extensions = DEFAULT_SKIPPED_FILE_EXTENSIONS | {
+        ext.lower() if ext.startswith('.') else f'.{ext.lower()}'
+        for ext in skipped_file_extensions or []
+    }
+
+    # Which files are skipped might have changed, so don't reuse previously indexed trees
+    _file_descriptor_cache.clear()
+    _last_indexed_trees.clear()
 
 
 def repo_to_file_descriptors(repo: Repo, context_window: int, file_chunk_size: int) -> list[FileDescriptor]:
     repo_tree = repo.head.commit.tree
+    tokenizer_id = get_tokenizer_id()
 
-    key = (repo_tree.binsha, context_window, file_chunk_size)
-    ignore_patterns = parse_gptignore(repo)
+    key = (repo_tree.binsha, tokenizer_id, context_window, file_chunk_size)
 
     if key in _file_descriptor_cache:
-        return [fd.copy(deep=True) for fd in _file_descriptor_cache[key]]
-
-    file_descriptor_list = []
-    for blob in repo_tree.traverse():
-        if not isinstance(blob, Blob):
+        return [fd.copy() for fd in _file_descriptor_cache[key]]
+
+    # If we've indexed another tree of this repo (e.g., before committing), only re-index the blobs that changed
+    last_indexed_key = (repo.git_dir, tokenizer_id, context_window, file_chunk_size)
+    last_indexed_tree = _last_indexed_trees.get(last_indexed_key)
+    previous_file_descriptors: Optional[dict[str, FileDescriptor]] = None
+    changed_paths: set[str] = set()
+    if last_indexed_tree is not None:
+        # Paths before and after each change, including deleted and renamed-away paths
+        touched_paths: set[str] = set()
+        for diff in last_indexed_tree.diff(repo_tree):
+            if not diff.deleted_file and diff.b_path is not None:
+                changed_paths.add(diff.b_path)
+            touched_paths.update(path for path in (diff.a_path, diff.b_path) if path is not None)
+        # Ignored paths might change along with the ignore files, so index from scratch
+        if not any(_is_ignore_file(path) for path in touched_paths):
+            previous_file_descriptors = {
+                fd.path: fd
+                for fd in _file_descriptor_cache[(last_indexed_tree.binsha, *last_indexed_key[1:])]
+            }
+
+    # Collect file descriptors in tree order, leaving placeholders for blobs that need to be tokenized
+    file_descriptor_list: list[Optional[FileDescriptor]] = []
+    uncached_blobs: list[tuple[int, Blob, bytes]] = []
+    for blob in walk_unignored_blobs(repo_tree, get_ignore_matcher(repo)):
+        if previous_file_descriptors is not None and blob.path not in changed_paths:
+            if blob.path in previous_file_descriptors:
+                file_descriptor_list.append(previous_file_descriptors[blob.path])
             continue
 
-        if blob.type == 'tree':
+        # Check the size and extension before reading the blob, and the first bytes before reading the rest
+        if os.path.splitext(blob.name)[1].lower() in _skipped_file_extensions:
+            file_descriptor_list.append(_to_skipped_file_descriptor(blob, 'binary'))
             continue
-
-        if is_path_ignored(blob.path, ignore_patterns):
+        if blob.size > _max_file_size:
+            file_descriptor_list.append(_to_skipped_file_descriptor(blob, 'too large'))
             continue
-
-        try:
-            content = blob.data_stream.read().decode()
-        except UnicodeDecodeError:
-            log.debug(f"Error decoding file: {blob.path}")
+        data_stream = blob.data_stream
+        data = data_stream.read(_binary_sniff_size)
+        if b'\0' in data:
+            file_descriptor_list.append(_to_skipped_file_descriptor(blob, 'binary'))
             continue
-
-        tokenizer = get_tokenizer()
-
-        tokens = tokenizer.encode(content)
-        # Split into chunks up to the last newline
-        chunks: list[list[tuple[int, str]]] = []
-        line_buffer = []
-        for i, line in enumerate(content.splitlines()):
-            line_buffer.append((i, line))
-            # FIXME speed this up
-            token_length = len(tokenizer.encode(
-                '\n'.join([l[1] for l in line_buffer])
+        data += data_stream.read()
+
+        cached = None
+        if _blob_cache is not None:
+            cached = _blob_cache.get(blob.hexsha, tokenizer_id, file_chunk_size)
+        if cached is not None:
+            file_descriptor_list.append(_to_file_descriptor(blob.path, data, *cached))
+        else:
+            uncached_blobs.append((len(file_descriptor_list), blob, data))
+            file_descriptor_list.append(None)
+
+    # Decode and tokenize uncached blobs, in parallel if configured
+    blob_datas = [data for _, _, data in uncached_blobs]
+    if _num_indexing_workers > 1 and len(uncached_blobs) > 1:
+        with ProcessPoolExecutor(max_workers=_num_indexing_workers) as executor:
+            results = list(executor.map(
+                _chunk_blob_data,
+                blob_datas,
+                itertools.repeat(tokenizer_id),
+                itertools.repeat(file_chunk_size),
+                chunksize=max(1, len(blob_datas) // (_num_indexing_workers * 4)),
             ))
-            if token_length >= file_chunk_size:
-                chunks.append(line_buffer)
-                line_buffer = []
-        if line_buffer:
-            chunks.append(line_buffer)
-
-        token_length = len(tokens)
-        file_descriptor_list.append(FileDescriptor(
-            path=blob.path,
-            token_length=token_length,
-            chunks=chunks,
-        ))
+    else:
+        results = [_chunk_blob_data(data, tokenizer_id, file_chunk_size) for data in blob_datas]
 
-    _file_descriptor_cache[key] = file_descriptor_list
-    return file_descriptor_list
+    new_blob_cache_entries = []
+    for (i, blob, data), result in zip(uncached_blobs, results):
+        if result is None:
+            log.debug(f"Error decoding file: {blob.path}")
+            file_descriptor_list[i] = _to_skipped_file_descriptor(blob, 'binary')
+            continue
+        token_length, chunk_line_counts = result
+        file_descriptor_list[i] = _to_file_descriptor(blob.path, data, token_length, chunk_line_counts)
+        new_blob_cache_entries.append(
+            (blob.hexsha, tokenizer_id, file_chunk_size, token_length, chunk_line_counts)
+        )
+    if _blob_cache is not None:
+        _blob_cache.set_many(new_blob_cache_entries)
+
+    file_descriptors = [fd for fd in file_descriptor_list if fd is not None]
+    log.debug(
+        "Indexed files",
+        num_files=len(file_descriptors),
+        num_skipped=sum(fd.skipped_reason is not None for fd in file_descriptors),
+    )
+    _file_descriptor_cache[key] = file_descriptors
+    _last_indexed_trees[last_indexed_key] = repo_tree
+    return [fd.copy() for fd in file_descriptors]
+
+
+def _chunk_blob_data(data: bytes, tokenizer_id: str, file_chunk_size: int) -> Optional[tuple[int, list[int]]]:
+    """
+    Decode and tokenize a blob, returning its token length and the number of lines in each chunk.
+    Returns None if the blob can't be decoded.
+    Runs in indexing worker processes, so it only takes and returns picklable values.
+    """
+    try:
+        content = data.decode()
+    except UnicodeDecodeError:
+        return None
+
+    tokenizer = get_tokenizer_by_id(tokenizer_id)
+    token_length = tokenizer.count_tokens(content)
+    chunks = chunk_file_content(content, tokenizer, file_chunk_size)
+    return token_length, [len(chunk) for chunk in chunks]
+
+
+def _to_file_descriptor(path: str, data: bytes, token_length: int, chunk_line_counts: list[int]) -> FileDescriptor:
+    return FileDescriptor.from_text(path, data.decode(), token_length, chunk_line_counts)
+
+
+def _to_skipped_file_descriptor(blob: Blob, reason: str) -> FileDescriptor:
+    return FileDescriptor(
+        path=blob.path,
+        token_length=0,
+        size=blob.size,
+        skipped_reason=reason,
+    )
+
+
+#: Patterns ignored in every repository, on top of `.gitignore` and `.gptignore` files.
+DEFAULT_IGNORE_PATTERNS = [
+    # Dependencies
+    'node_modules/',
+    # Lockfiles
+    'package-lock.json',
+    'yarn.lock',
+    'pnpm-lock.yaml',
+    'poetry.lock',
+    'Pipfile.lock',
+    'Cargo.lock',
+    'composer.lock',
+    'Gemfile.lock',
+    'go.sum',
+    # Minified and generated assets
+    '*.min.js',
+    '*.min.css',
+    '*.map',
+]
+
+
+class IgnoreMatcher:
+    """
+    Matches paths against gitignore-style patterns, compiled once.
+
+    Like nested `.gitignore` files, patterns only apply within the directory they were declared in,
+    and later patterns take precedence over earlier ones (e.g., to negate them with `!`).
+    Override patterns (from `.gptignore`) take precedence over all others.
+    """
+
+    def __init__(
+        self,
+        patterns: Optional[list[tuple[str, re.Pattern, bool]]] = None,
+        override_patterns: Optional[list[tuple[str, re.Pattern, bool]]] = None,
+    ):
+        # (directory prefix, compiled pattern, whether it ignores or un-ignores) tuples
+        self.patterns = patterns or []
+        self.override_patterns = override_patterns or []
+
+    @staticmethod
+    def _compile(lines: list[str], base_dir: str) -> list[tuple[str, re.Pattern, bool]]:
+        prefix = f'{base_dir}/' if base_dir else ''
+        compiled = []
+        for line in lines:
+            pattern = GitWildMatchPattern(line)
+            if pattern.include is not None and pattern.regex is not None:
+                compiled.append((prefix, pattern.regex, pattern.include))
+        return compiled
+
+    def with_patterns(self, lines: list[str], base_dir: str = '') -> 'IgnoreMatcher':
+        """
+        Return a matcher that also applies `lines` to paths in `base_dir`.
+        """
+        return IgnoreMatcher(self.patterns + self._compile(lines, base_dir), self.override_patterns)
+
+    def with_override_patterns(self, lines: list[str]) -> 'IgnoreMatcher':
+        """
+        Return a matcher that applies `lines` to all paths, regardless of other patterns.
+        """
+        return IgnoreMatcher(self.patterns, self.override_patterns + self._compile(lines, ''))
+
+    def is_ignored(self, path: str, is_dir: bool = False) -> bool:
+        if is_dir:
+            path += '/'
+        for patterns in (self.override_patterns, self.patterns):
+            # The last matching pattern decides
+            for prefix, regex, include in reversed(patterns):
+                if path.startswith(prefix) and regex.match(path[len(prefix):]):
+                    return include
+        return False
+
+
+def get_ignore_matcher(repo: Repo) -> IgnoreMatcher:
+    """
+    Get a matcher for the default ignore patterns and the repository's `.gptignore`.
+    `.gitignore` files are added while walking the tree (see `walk_unignored_blobs`).
+    """
+    return IgnoreMatcher().with_patterns(DEFAULT_IGNORE_PATTERNS).with_override_patterns(parse_gptignore(repo))
+
+
+def walk_unignored_blobs(tree: Tree, matcher: IgnoreMatcher) -> Iterator[Blob]:
+    """
+    Yield the blobs of `tree` that aren't ignored, in the same order as `tree.traverse()`.
+    Applies each `.gitignore` to the directory it's in, and doesn't walk into ignored directories.
+    """
+    queue = collections.deque([(tree, matcher)])
+    while queue:
+        tree, matcher = queue.popleft()
+        for blob in tree.blobs:
+            if blob.name == '.gitignore':
+                matcher = matcher.with_patterns(_parse_ignore_lines(blob), base_dir=tree.path)
+                break
 
+        for item in tree:
+            if isinstance(item, Tree):
+                if not matcher.is_ignored(item.path, is_dir=True):
+                    queue.append((item, matcher))
+            elif isinstance(item, Blob):
+                if not matcher.is_ignored(item.path):
+                    yield item
 
-def is_path_ignored(path: str, ignore_patterns: list[str]) -> bool:
-    # Ensure we're working with a relative path
-    relative_path = os.path.relpath(path)
-    pathspec = PathSpec.from_lines(GitWildMatchPattern, ignore_patterns)
-    return pathspec.match_file(relative_path)
 
+def _is_ignore_file(path: str) -> bool:
+    return path == '.gptignore' or path == '.gitignore' or path.endswith('/.gitignore')
 
-def parse_gptignore(repo: Repo, gptignore_file: str = ".gptignore") -> list[str]:
-    if gptignore_file not in repo.head.commit.tree:
-        return []
 
-    gptignore_blob = repo.head.commit.tree / gptignore_file
-    gptignore_content = gptignore_blob.data_stream.read().decode()
+def _parse_ignore_lines(blob: Blob) -> list[str]:
+    content = blob.data_stream.read().decode()
 
     ignore_patterns = []
-    for line in gptignore_content.splitlines():
+    for line in content.splitlines():
         line = line.strip()
         if line and not line.startswith("#"):
             ignore_patterns.append(line)
 
     return ignore_patterns
 
+
+def parse_gptignore(repo: Repo, gptignore_file: str = ".gptignore") -> list[str]:
+    if gptignore_file not in repo.head.commit.tree:
+        return []
+
+    gptignore_blob = repo.head.commit.tree / gptignore_file
+    return _parse_ignore_lines(gptignore_blob)
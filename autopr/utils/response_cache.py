@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import structlog
+
+log = structlog.get_logger()
+
+
+class ResponseCache:
+    """
+    On-disk cache of language model responses, persisted across runs.
+
+    Entries are keyed by everything that determines a response (model, system prompt, examples, prompt,
+    temperature, and max tokens), so rerunning AutoPR on the same issue doesn't pay for identical prompts again.
+    Entries expire after `ttl` seconds, and the least recently used entries are evicted beyond `max_entries`.
+
+    Parameters
+    ----------
+    cache_dir: str
+        Directory to persist the cache in, outside the repository.
+    policy: str
+        Which responses to cache:
+        - `always`: cache every response
+        - `temperature_0`: only cache responses sampled at temperature 0, which are (nearly) deterministic
+        - `off`: don't cache responses
+    ttl: int
+        Number of seconds after which cached responses expire.
+    max_entries: int
+        Maximum number of cached responses.
+    """
+
+    filename = 'responses.sqlite3'
+
+    policies = ['always', 'temperature_0', 'off']
+
+    def __init__(
+        self,
+        cache_dir: str,
+        policy: str = 'temperature_0',
+        ttl: int = 7 * 24 * 60 * 60,
+        max_entries: int = 10000,
+    ):
+        if policy not in self.policies:
+            raise ValueError(f"Response cache policy {policy} not implemented")
+        self.policy = policy
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, self.filename)
+        # Completions might run concurrently in threads (see `CompletionsRepo.acomplete`)
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                '  key TEXT PRIMARY KEY,'
+                '  response TEXT NOT NULL,'
+                '  created_at REAL NOT NULL,'
+                '  accessed_at REAL NOT NULL'
+                ')'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)'
+            )
+
+    def should_cache(self, temperature: float) -> bool:
+        if self.policy == 'always':
+            return True
+        if self.policy == 'temperature_0':
+            return temperature == 0
+        return False
+
+    @staticmethod
+    def get_key(
+        model: str,
+        system_prompt: Optional[str],
+        examples: list[tuple[str, str]],
+        prompt: str,
+        temperature: float,
+        max_tokens: int,
+    ) -> str:
+        key_json = json.dumps([model, system_prompt, examples, prompt, temperature, max_tokens])
+        return hashlib.sha256(key_json.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                'SELECT response FROM responses WHERE key = ? AND created_at >= ?',
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?',
+                (now, key),
+            )
+        return row[0]
+
+    def set(self, key: str, response: str):
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, response, now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        expired = self.connection.execute(
+            'DELETE FROM responses WHERE created_at < ?',
+            (now - self.ttl,),
+        ).rowcount
+        evicted = self.connection.execute(
+            'DELETE FROM responses WHERE key IN ('
+            '  SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?'
+            ')',
+            (self.max_entries,),
+        ).rowcount
+        if expired or evicted:
+            log.debug("Evicted cached responses", num_expired=expired, num_evicted=evicted, path=self.path)
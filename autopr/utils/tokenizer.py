@@ -1,15 +1,138 @@
-from typing import Optional
+import math
+import zlib
+from typing import Optional, Callable
 
-import transformers
 
-# FIXME use tiktoken instead
+class Tokenizer:
+    """
+    Counts tokens the way a family of models does.
 
-_cached_tokenizer = None
+    Backends load lazily, on first use, so that importing AutoPR doesn't import them.
+    """
 
+    #: Identifies the tokenizer (e.g., to key caches).
+    id: str
 
-def get_tokenizer():
-    global _cached_tokenizer
+    def encode(self, text: str) -> list[int]:
+        raise NotImplementedError
 
-    if _cached_tokenizer is None:
-        _cached_tokenizer = transformers.GPT2TokenizerFast.from_pretrained('gpt2')
-    return _cached_tokenizer
+    def count_tokens(self, text: str) -> int:
+        return len(self.encode(text))
+
+
+class TiktokenTokenizer(Tokenizer):
+    """
+    OpenAI's tiktoken encodings (e.g., `cl100k_base` for gpt-4 and gpt-3.5-turbo).
+    """
+
+    def __init__(self, encoding_name: str):
+        self.id = encoding_name
+        self._encoding = None
+
+    def encode(self, text: str) -> list[int]:
+        if self._encoding is None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(self.id)
+        # Count special tokens in the text (e.g., `<|endoftext|>`) as ordinary text
+        return self._encoding.encode(text, disallowed_special=())
+
+
+class GPT2Tokenizer(Tokenizer):
+    """
+    The GPT-2 tokenizer from transformers, the fallback for models without a known encoding.
+    """
+
+    id = 'gpt2'
+
+    def __init__(self):
+        self._tokenizer = None
+
+    def encode(self, text: str) -> list[int]:
+        if self._tokenizer is None:
+            import transformers
+            self._tokenizer = transformers.GPT2TokenizerFast.from_pretrained('gpt2')
+        return self._tokenizer.encode(text)
+
+
+class CharRatioTokenizer(Tokenizer):
+    """
+    Cheaply estimates token counts from the number of characters, without a vocabulary.
+    """
+
+    id = 'char_ratio'
+
+    def __init__(self, chars_per_token: float = 4):
+        self.chars_per_token = chars_per_token
+
+    def encode(self, text: str) -> list[int]:
+        # Split the text into pseudo-tokens of `chars_per_token` characters each, identified by their content
+        num_tokens = self.count_tokens(text)
+        boundaries = [round(i * self.chars_per_token) for i in range(num_tokens)] + [len(text)]
+        return [
+            zlib.crc32(text[start:end].encode())
+            for start, end in zip(boundaries, boundaries[1:])
+        ]
+
+    def count_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+
+_tokenizer_factories: dict[str, Callable[[], Tokenizer]] = {
+    'cl100k_base': lambda: TiktokenTokenizer('cl100k_base'),
+    'p50k_base': lambda: TiktokenTokenizer('p50k_base'),
+    'gpt2': GPT2Tokenizer,
+    'char_ratio': CharRatioTokenizer,
+}
+
+# Model name prefixes mapped to the ID of their tokenizer
+_model_tokenizer_ids = {
+    'gpt-4': 'cl100k_base',
+    'gpt-3.5-turbo': 'cl100k_base',
+    'text-davinci-003': 'p50k_base',
+    # Count tokens for the synthetic stand-in like for the model it stands in for
+    'synthetic': 'cl100k_base',
+}
+
+_default_tokenizer_id = 'cl100k_base'
+
+# The tokenizer configured for every model, if any
+_configured_tokenizer_id: Optional[str] = None
+
+_cached_tokenizers: dict[str, Tokenizer] = {}
+
+
+def configure_tokenizer(model: str, tokenizer_id: Optional[str] = None):
+    """
+    Set the tokenizer to count tokens with, for every model and when no model is specified
+    (e.g., to index the repository).
+    Defaults to the tokenizer of `model` when no model is specified, and of each model otherwise.
+    """
+    global _default_tokenizer_id, _configured_tokenizer_id
+    if tokenizer_id is not None and tokenizer_id not in _tokenizer_factories:
+        raise ValueError(f"Tokenizer {tokenizer_id} not implemented")
+    _configured_tokenizer_id = tokenizer_id
+    _default_tokenizer_id = get_tokenizer_id(model)
+
+
+def get_tokenizer_id(model: Optional[str] = None) -> str:
+    """
+    Identify the tokenizer of `model` without loading it (e.g., to key caches).
+    """
+    if _configured_tokenizer_id is not None:
+        return _configured_tokenizer_id
+    if model is None:
+        return _default_tokenizer_id
+    for model_prefix, tokenizer_id in _model_tokenizer_ids.items():
+        if model.startswith(model_prefix):
+            return tokenizer_id
+    return 'gpt2'
+
+
+def get_tokenizer(model: Optional[str] = None) -> Tokenizer:
+    return get_tokenizer_by_id(get_tokenizer_id(model))
+
+
+def get_tokenizer_by_id(tokenizer_id: str) -> Tokenizer:
+    if tokenizer_id not in _cached_tokenizers:
+        _cached_tokenizers[tokenizer_id] = _tokenizer_factories[tokenizer_id]()
+    return _cached_tokenizers[tokenizer_id]
@@ -0,0 +1,165 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+from typing import Iterator, Optional
+
+import pydantic
+import structlog
+
+log = structlog.get_logger()
+
+
+class CompletionUsage(pydantic.BaseModel):
+    """
+    Usage of a single language model call.
+    """
+    stage: str
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0
+    rate_limit_wait: float = 0
+    retries: int = 0
+    cache_hit: bool = False
+
+
+# The call that's currently running in this context, for retry hooks deep in the call stack to count against
+_current_usage: contextvars.ContextVar[Optional[CompletionUsage]] = \
+    contextvars.ContextVar('current_usage', default=None)
+
+
+def count_retry(retry_state=None):
+    """
+    Count a retry against the current call. Pass as tenacity's `before_sleep` to retries around API calls.
+    """
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.retries += 1
+
+
+def report_usage(prompt_tokens: int, completion_tokens: int):
+    """
+    Record the token usage reported by the API for the current call, in place of the tokenizer's estimate.
+    """
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.prompt_tokens = prompt_tokens
+        usage.completion_tokens = completion_tokens
+
+
+class UsageTracker:
+    """
+    Collects the usage of every language model call in a run, to find out which stages are expensive.
+
+    Calls are attributed to the outermost stage they run in (e.g., the rail or chain being run).
+    Calls answered from the response cache are counted, but don't use any tokens.
+    """
+
+    def __init__(self):
+        self.records: list[CompletionUsage] = []
+        self._lock = threading.Lock()
+        self._stage: contextvars.ContextVar[Optional[str]] = \
+            contextvars.ContextVar(f'usage_stage_{id(self)}', default=None)
+
+    @property
+    def current_stage(self) -> str:
+        return self._stage.get() or 'other'
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Attribute the calls made within the context to the stage `name`, unless they're already in a stage.
+        """
+        if self._stage.get() is not None:
+            yield
+            return
+        token = self._stage.set(name)
+        try:
+            yield
+        finally:
+            self._stage.reset(token)
+
+    @contextlib.contextmanager
+    def track(self, model: str) -> Iterator[CompletionUsage]:
+        """
+        Record a call made within the context, timing it and counting its retries.
+        Set the usage's token counts within the context, and the seconds spent waiting for rate limits,
+        which don't count towards its latency.
+        """
+        usage = CompletionUsage(stage=self.current_stage, model=model)
+        token = _current_usage.set(usage)
+        start = time.monotonic()
+        try:
+            yield usage
+        finally:
+            usage.latency = time.monotonic() - start - usage.rate_limit_wait
+            _current_usage.reset(token)
+            with self._lock:
+                self.records.append(usage)
+            log.debug("Recorded usage", **usage.dict())
+
+    def summarize(self) -> dict[str, dict[str, float]]:
+        """
+        Aggregate the recorded calls by stage, in the order the stages first ran.
+        """
+        summary: dict[str, dict[str, float]] = defaultdict(lambda: dict(
+            calls=0,
+            cache_hits=0,
+            prompt_tokens=0,
+            completion_tokens=0,
+            latency=0.0,
+            rate_limit_wait=0.0,
+            retries=0,
+        ))
+        with self._lock:
+            records = list(self.records)
+        for usage in records:
+            stage_summary = summary[usage.stage]
+            stage_summary['calls'] += 1
+            stage_summary['cache_hits'] += usage.cache_hit
+            stage_summary['prompt_tokens'] += usage.prompt_tokens
+            stage_summary['completion_tokens'] += usage.completion_tokens
+            stage_summary['latency'] += usage.latency
+            stage_summary['rate_limit_wait'] += usage.rate_limit_wait
+            stage_summary['retries'] += usage.retries
+        return dict(summary)
+
+    def to_markdown(self) -> str:
+        """
+        Render the summary as a markdown table, with a row per stage and a total.
+        """
+        summary = self.summarize()
+        total = {
+            key: sum(stage_summary[key] for stage_summary in summary.values())
+            for key in ['calls', 'cache_hits', 'prompt_tokens', 'completion_tokens', 'latency', 'retries']
+        }
+        lines = [
+            '| Stage | Calls | Cache hits | Prompt tokens | Completion tokens | Latency (s) | Retries |',
+            '| --- | ---: | ---: | ---: | ---: | ---: | ---: |',
+        ]
+        for stage, stage_summary in [*summary.items(), ('**Total**', total)]:
+            lines.append(
+                f"| {stage} "
+                f"| {stage_summary['calls']} "
+                f"| {stage_summary['cache_hits']} "
+                f"| {stage_summary['prompt_tokens']} "
+                f"| {stage_summary['completion_tokens']} "
+                f"| {stage_summary['latency']:.1f} "
+                f"| {stage_summary['retries']} |"
+            )
+        return '\n'.join(lines)
+
+    def write_json(self, path: str):
+        """
+        Write every recorded call and the summary by stage to a JSON file.
+        """
+        with self._lock:
+            records = [usage.dict() for usage in self.records]
+        with open(path, 'w') as f:
+            json.dump({
+                'calls': records,
+                'stages': self.summarize(),
+            }, f, indent=2)
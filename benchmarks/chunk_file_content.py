@@ -0,0 +1,45 @@
+"""
+Benchmark chunking a synthetic file into `FileDescriptor` chunks.
+
+Compares `chunk_file_content` against the original implementation,
+which re-encoded the growing chunk after every line.
+
+Usage:
+    python -m benchmarks.chunk_file_content [--lines 50000] [--chunk-size 500] [--tokenizer cl100k_base]
+"""
+import argparse
+import random
+import time
+
+from autopr.tests.helpers import quadratic_chunk_file_content, random_file_content
+from autopr.utils.repo import chunk_file_content
+from autopr.utils.tokenizer import get_tokenizer_by_id
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=50000)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--tokenizer', default='cl100k_base')
+    args = parser.parse_args()
+
+    tokenizer = get_tokenizer_by_id(args.tokenizer)
+    content = random_file_content(random.Random(0), args.lines)
+
+    start = time.perf_counter()
+    chunks = chunk_file_content(content, tokenizer, args.chunk_size)
+    linear_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference_chunks = quadratic_chunk_file_content(content, tokenizer, args.chunk_size)
+    quadratic_seconds = time.perf_counter() - start
+
+    assert chunks == reference_chunks, "Chunks differ from the original implementation"
+    print(f"{args.lines} lines, {len(chunks)} chunks of {args.chunk_size} tokens")
+    print(f"original:           {quadratic_seconds:.2f}s")
+    print(f"chunk_file_content: {linear_seconds:.2f}s")
+    print(f"speedup:            {quadratic_seconds / linear_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    main()